@@ -4,13 +4,30 @@ import random
 import string
 from flask import Flask, render_template, redirect, url_for, request, flash, session, g, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Event, Relationship, Agent, AgentMemory, WorldState, Dialogue, AgentThought, UserAgentChat
-from datetime import datetime, timedelta
+from models import db, User, Event, Agent, AgentMemory, WorldState, Dialogue, AgentThought, UserAgentChat, upgrade_schema
+from datetime import datetime, timedelta, timezone
 import functools
 import threading
 import time
 import json
-from gigachat_integration import GigaChatManager
+from gigachat_integration import GigaChatManager, parse_exchange
+from llm_backends import CircuitBreaker
+from llm_router import DEFAULT_ROUTES, parse_routes
+from markov_generator import MarkovGenerator, MarkovBackend, train_new_rows
+from tracing import Tracer, STAGES
+from censorship import CensorshipFilter
+from dialogue_store import DialogueContextStore
+from group_conversations import GroupConversation, find_groups, centroid, pick_turn
+from presence import PresenceStore
+from leader import LeaderLock, publish_status, LOCK_NAME, STATUS_NAME
+from task_queue import DurableTaskQueue, PendingTasks
+from reply_pool import ReplyPool, is_greeting
+from scheduler import TickScheduler
+from sharding import ShardCoordinator, advance_agent_state
+from world_log import WorldLog
+from relationships import RelationshipMatrix
+from memory_store import MemoryStore
+from vector_index import VectorIndex, VECTOR_SEARCH_AVAILABLE, index_new_rows, prune_deleted
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24).hex()
@@ -18,13 +35,150 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///iskra.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 app.config['GIGACHAT_TIMEOUT'] = 10  # Таймаут для GigaChat в секундах
+app.config['LLM_TASK_DEADLINE'] = 20  # Предельное время задачи GigaChat со всеми повторами
+app.config['LLM_MAX_RETRIES'] = 2
+app.config['LLM_HEDGE_AFTER'] = 3.0  # Дублирующий запрос для ответов людям после N секунд ожидания
+app.config['LLM_BREAKER_THRESHOLD'] = 5  # Ошибок подряд до перехода на локальный генератор
+app.config['LLM_BREAKER_RESET'] = 30  # Через сколько секунд снова пробовать провайдера
 app.config['AGENT_COOLDOWN'] = 3 
+# Разговор агентов генерируется целиком одним запросом и показывается по реплике за тик
+app.config['DIALOGUE_EXCHANGE_MODE'] = os.environ.get('ISKRA_DIALOGUE_EXCHANGE', '1') == '1'
+app.config['DIALOGUE_EXCHANGE_TURNS'] = (4, 6)  # Сколько реплик в одном разговоре (от, до)
+app.config['DIALOGUE_REVEAL_INTERVAL'] = 1  # Циклов между показом реплик
+# Групповые разговоры агентов, оказавшихся рядом: один запрос на ход, модель выбирает говорящего
+app.config['GROUP_CONVERSATIONS'] = os.environ.get('ISKRA_GROUP_CONVERSATIONS', '1') == '1'
+app.config['GROUP_RADIUS'] = 8.0  # Расстояние, на котором агенты считаются рядом
+app.config['GROUP_SIZE'] = (3, 5)  # Участников в группе (от, до)
+app.config['GROUP_MAX_TURNS'] = 8  # Реплик в одном групповом разговоре
+app.config['GROUP_START_INTERVAL'] = 10  # Поиск новых групп каждые N циклов
+app.config['GROUP_MAX_ACTIVE'] = 2  # Одновременных групповых разговоров
+# Индикаторы "печатает..." живут только в памяти; отдельный процесс симуляции дублирует их в файл
+app.config['PRESENCE_TTL'] = 60  # Через сколько секунд индикатор снимается, если ответ так и не пришел
+app.config['PRESENCE_FILE'] = os.path.join(app.instance_path, 'presence.json')
+# Готовые приветствия агентов: генерируются при пустой очереди и мгновенно отвечают на первое "привет"
+app.config['OPENER_POOL_SIZE'] = 2  # Приветствий в запасе на агента
+app.config['OPENER_MAX_AGE'] = 900  # Через сколько секунд приветствие устаревает
+app.config['CHAT_NEW_CONVERSATION_GAP'] = 1800  # Секунд без переписки, после которых разговор считается новым
+app.config['CHAT_AUTO_REPLY_AFTER'] = 10  # Секунд без ответа, после которых агент отвечает заготовкой
+# Пока задача ответа в очереди или в работе, заготовку не подставляем - но не дольше стольких секунд
+app.config['CHAT_AUTO_REPLY_MAX_WAIT'] = int(os.environ.get('ISKRA_CHAT_AUTO_REPLY_MAX_WAIT', 60))
+app.config['REFLECTION_BATCH_SIZE'] = 5  # Сколько рефлексий агентов упаковывается в один запрос GigaChat
+app.config['SIM_TICK_RATE'] = 0.2  # Тиков в секунду (один тик в 5 секунд)
+app.config['SIM_TICK_BUDGET'] = 0.8  # Доля интервала тика для необязательной работы
+app.config['LLM_QUEUE_LOW_WATER'] = 5  # Размер очереди GigaChat, с которого замедляем агентов
+app.config['LLM_QUEUE_HIGH_WATER'] = 20  # Размер очереди, при котором агенты не шлют новых запросов
+# Процессы для физики агентов (0 - все в потоке симуляции). Ответы, продолжения разговоров,
+# GigaChat и БД остаются в потоке симуляции: шарды разгружают его, но не масштабируют диалоги
+app.config['SIM_SHARDS'] = int(os.environ.get('ISKRA_SIM_SHARDS', 0))
+# 1 - симулятор запускается внутри веб-сервера, 0 - отдельным процессом iskra_sim.py
+app.config['EMBEDDED_SIMULATOR'] = os.environ.get('ISKRA_EMBEDDED_SIMULATOR', '1') == '1'
+# Под WSGI-сервером симулятор запускается в одном воркере; сообщения, сохраненные другими
+# воркерами, он забирает из БД не раньше, чем через столько секунд (свои сообщения воркер ставит в очередь сам)
+app.config['EMBEDDED_CLAIM_DELAY'] = 5
+app.config['WORLD_SNAPSHOT_INTERVAL'] = 50  # Полный снимок мира каждые N циклов
+app.config['WORLD_SNAPSHOTS_RETAINED'] = 20  # Сколько снимков (и дельт между ними) хранить
+app.config['RELATIONSHIP_FLUSH_INTERVAL'] = 10  # Запись кэша отношений в БД каждые N циклов
+app.config['RELATIONSHIP_DECAY_INTERVAL'] = 100  # Затухание отношений каждые N циклов
+app.config['RELATIONSHIP_DECAY_FACTOR'] = 0.98
+app.config['RELATIONSHIP_CACHE_TTL'] = 5  # Время жизни кэша отношений в веб-воркерах, секунд
+app.config['AGENT_MEMORY_BUDGET'] = 100  # Максимум воспоминаний на агента
+app.config['MEMORY_COMPACT_INTERVAL'] = 20  # Уплотнение воспоминаний каждые N циклов
+app.config['VECTOR_INDEX_PATH'] = os.path.join(app.instance_path, 'vector_index')
+app.config['VECTOR_INDEX_INTERVAL'] = 5  # Индексация новых текстов каждые N циклов
+# JSON со списками запрещенных слов {"words": [...], "stems": [...], "roots": [...]}; по умолчанию - встроенные
+app.config['CENSORSHIP_FILE'] = os.environ.get('ISKRA_CENSORSHIP_FILE')
+app.config['LLM_WORKERS'] = int(os.environ.get('ISKRA_LLM_WORKERS', 1))  # Потоков-обработчиков очереди GigaChat
+# Профиль имитации без ключа GigaChat: default, instant, realistic, degraded (см. llm_backends.py)
+app.config['LLM_MOCK_PROFILE'] = os.environ.get('ISKRA_LLM_MOCK_PROFILE', 'default')
+# Очередь задач GigaChat в SQLite: незавершенные задачи и ожидания переживают перезапуск
+app.config['LLM_TASK_DB'] = os.path.join(app.instance_path, 'llm_tasks.db')
+app.config['LLM_TASK_LEASE'] = 120  # Аренда задачи обработчиком, секунд (потом задача возвращается в очередь)
+app.config['LLM_TASK_MAX_ATTEMPTS'] = 3
+# Задача разговора двух агентов, не взятая в работу за N секунд, устарела и отбрасывается
+app.config['LLM_AGENT_TASK_TTL'] = 60
+# Бэкенды по классам задач: quality - основная модель, fast - быстрая модель для фоновой работы,
+# offline - локальный генератор. cost_per_1k - стоимость 1000 токенов для оценки расходов (условные единицы)
+app.config['LLM_BACKEND_TIERS'] = {
+    'quality': {'model': os.environ.get('ISKRA_LLM_QUALITY_MODEL'), 'max_concurrency': 2, 'cost_per_1k': 1.0},
+    'fast': {'model': os.environ.get('ISKRA_LLM_FAST_MODEL', 'GigaChat'), 'max_concurrency': 4, 'cost_per_1k': 0.2},
+    'offline': {'max_concurrency': 16}
+}
+# Тип задачи -> бэкенд; ISKRA_LLM_ROUTES дополняет таблицу: "reflection=offline,opener=offline" или JSON
+app.config['LLM_ROUTES'] = dict(DEFAULT_ROUTES, **parse_routes(os.environ.get('ISKRA_LLM_ROUTES')))
+# Симуляция целиком на локальном генераторе, без обращений к GigaChat
+if os.environ.get('ISKRA_LLM_OFFLINE') == '1':
+    app.config['LLM_ROUTES'] = {task_type: 'offline' for task_type in DEFAULT_ROUTES}
+# Локальный генератор (бэкенд offline и запасной): markov - цепи Маркова по диалогам и мыслям, canned - заготовки
+app.config['LLM_OFFLINE_GENERATOR'] = os.environ.get('ISKRA_LLM_OFFLINE_GENERATOR', 'markov')
+app.config['MARKOV_TRAIN_INTERVAL'] = 5  # Дообучение на новых репликах каждые N циклов
+# Маршруты, измененные на лету через /api/admin/llm-routes (перекрывают LLM_ROUTES)
+app.config['LLM_ROUTES_FILE'] = os.path.join(app.instance_path, 'llm_routes.json')
+# Операторы (логины через запятую): только они меняют маршруты; пустой список - изменения запрещены всем
+app.config['ADMIN_USERS'] = {name.strip() for name in os.environ.get('ISKRA_ADMIN_USERS', '').split(',') if name.strip()}
+app.config['LLM_RESULT_TTL'] = 300  # Сколько секунд хранится невостребованный результат GigaChat
+app.config['LLM_MAX_RESULTS'] = 1000  # Максимум невостребованных результатов в памяти
+# Трассировка сообщений людей (trace_id - conversation_id сообщения): отрезки этапов в JSON Lines, общем для процессов
+app.config['TRACING'] = os.environ.get('ISKRA_TRACING', '1') == '1'
+app.config['TRACE_FILE'] = os.path.join(app.instance_path, 'traces.jsonl')
+app.config['TRACE_MAX_BYTES'] = 2 * 1024 * 1024  # Потом файл переименовывается в traces.jsonl.1
+# Истории разговоров пар: в памяти - недавние, остальные в отдельном файле SQLite
+app.config['DIALOGUE_CONTEXT_PATH'] = os.path.join(app.instance_path, 'dialogue_contexts.db')
+app.config['DIALOGUE_CONTEXT_MAX_PAIRS'] = 500
+app.config['DIALOGUE_CONTEXT_MAX_BYTES'] = 2 * 1024 * 1024
 
 db.init_app(app)
 
-gigachat = GigaChatManager()  
+tracer = Tracer(app.config['TRACE_FILE'], max_bytes=app.config['TRACE_MAX_BYTES'], enabled=app.config['TRACING'])
+
+# Цепи Маркова обучаются в потоке симуляции, а отвечают из обработчиков очереди GigaChat
+text_model = MarkovGenerator()
+
+# Обработчик очереди запускается вместе с симулятором (в веб-воркерах без симулятора он не нужен)
+gigachat = GigaChatManager(
+    autostart=False,
+    workers=app.config['LLM_WORKERS'],
+    mock_profile=app.config['LLM_MOCK_PROFILE'],
+    result_ttl=app.config['LLM_RESULT_TTL'],
+    max_results=app.config['LLM_MAX_RESULTS'],
+    call_timeout=app.config['GIGACHAT_TIMEOUT'],
+    task_deadline=app.config['LLM_TASK_DEADLINE'],
+    max_retries=app.config['LLM_MAX_RETRIES'],
+    hedge_after=app.config['LLM_HEDGE_AFTER'],
+    breaker=CircuitBreaker(app.config['LLM_BREAKER_THRESHOLD'], app.config['LLM_BREAKER_RESET']),
+    backend_tiers=app.config['LLM_BACKEND_TIERS'],
+    fallback=MarkovBackend(text_model) if app.config['LLM_OFFLINE_GENERATOR'] == 'markov' else None,
+    routes=app.config['LLM_ROUTES'],
+    routes_file=app.config['LLM_ROUTES_FILE'],
+    agent_task_ttl=app.config['LLM_AGENT_TASK_TTL'],
+    tracer=tracer,
+    task_store=DurableTaskQueue(
+        app.config['LLM_TASK_DB'],
+        lease_seconds=app.config['LLM_TASK_LEASE'],
+        max_attempts=app.config['LLM_TASK_MAX_ATTEMPTS']
+    ),
+    context_store=DialogueContextStore(
+        app.config['DIALOGUE_CONTEXT_PATH'],
+        max_pairs=app.config['DIALOGUE_CONTEXT_MAX_PAIRS'],
+        max_bytes=app.config['DIALOGUE_CONTEXT_MAX_BYTES']
+    ),
+    censorship=CensorshipFilter.from_file(app.config['CENSORSHIP_FILE']) if app.config['CENSORSHIP_FILE'] else None
+)
+gigachat.reflection_batch_size = app.config['REFLECTION_BATCH_SIZE']
+
+# Кто из агентов сейчас печатает (в БД не пишется)
+presence = PresenceStore(ttl=app.config['PRESENCE_TTL'])
+
+# Журнал изменений мира: дельты по циклам + периодические снимки
+world_log = WorldLog(
+    snapshot_interval=app.config['WORLD_SNAPSHOT_INTERVAL'],
+    retain_snapshots=app.config['WORLD_SNAPSHOTS_RETAINED']
+)
 
 # Фоновый поток симуляции
+def _epoch(timestamp):
+    """Время записи БД (datetime.utcnow) в секундах time.time() - для трассировки и историй разговоров"""
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
 class AgentSimulator:
     def __init__(self):
         self.running = True
@@ -33,12 +187,43 @@ class AgentSimulator:
         self.thread.daemon = True
         # Очередь для диалогов с GigaChat
         self.dialogue_queue = []
-        self.pending_dialogues = {}
+        # Ожидаемые результаты GigaChat (дублируются в очередь задач и восстанавливаются при запуске)
+        self.pending_dialogues = PendingTasks(gigachat.task_queue)
         # Отслеживание активных диалогов для поддержания темы
         self.active_conversations = {}  # (agent1_id, agent2_id) -> последнее сообщение
+        # Сгенерированные целиком разговоры, реплики которых еще показываются
+        self.exchanges = []
+        # Групповые разговоры: conversation_id -> GroupConversation
+        self.groups = {}
+        # Рефлексии, собранные за тик (отправляются пакетами)
+        self.reflection_requests = []
+        # Заготовленные приветствия для первых ответов людям
+        self.openers = ReplyPool(size=app.config['OPENER_POOL_SIZE'], max_age=app.config['OPENER_MAX_AGE'])
+        # Планировщик тиков с фиксированным шагом и бюджетом времени
+        self.scheduler = TickScheduler(
+            tick_rate=app.config['SIM_TICK_RATE'],
+            budget_ratio=app.config['SIM_TICK_BUDGET']
+        )
+        # Координатор процессов-шардов (None - все агенты обновляются в этом потоке)
+        self.shards = None
+        # Забирать из БД сообщения пользователей, оставленные веб-воркерами (режим iskra_sim.py)
+        self.claim_user_messages = False
+        # Сколько секунд сообщение должно пролежать в БД, прежде чем его заберут (0 - сразу)
+        self.claim_delay = 0
+        # Отношения между агентами в памяти, в БД пишутся пачками
+        self.relationships = RelationshipMatrix()
+        # Воспоминания агентов с бюджетом и слиянием повторов
+        self.memories = MemoryStore(budget=app.config['AGENT_MEMORY_BUDGET'])
+        # Векторный индекс текстов агентов (None, если NumPy недоступен)
+        self.vectors = None
         
     def start(self):
+        gigachat.start()
         self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.scheduler.stop()
         
     def simulate(self):
         """Основной цикл симуляции мира агентов"""
@@ -48,12 +233,60 @@ class AgentSimulator:
         agent_types = ['Базовая', 'Продвинутая', 'Бесконечная']
         
         with app.app_context():
+            # Быстрый старт из журнала мира (восстанавливает агентов, если БД пуста)
+            restored = world_log.restore()
+            if restored:
+                print(f"♻️ Состояние мира восстановлено из журнала (цикл {restored['cycle']})")
+            
             # Инициализация начальных агентов, если их нет
             self._initialize_agents(agent_names, agent_types)
             
+            # Ожидания, прерванные перезапуском: их задачи уже снова в очереди GigaChat
+            restored = self.pending_dialogues.restore()
+            if restored:
+                print(f"♻️ Восстановлено ожидающих ответов GigaChat: {restored}")
+            
+            # Локальный генератор учится на всей накопленной истории
+            if app.config['LLM_OFFLINE_GENERATOR'] == 'markov':
+                agents = Agent.query.all()
+                while train_new_rows(text_model, agents):
+                    pass
+                print(f"🎲 Локальный генератор обучен: {text_model.stats['trained']} фраз")
+            
+            # Записи "печатает..." из старых версий: индикаторы теперь хранятся в presence
+            stale = Dialogue.query.filter(Dialogue.dialogue_type.in_(('typing', 'pending'))).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+            if stale:
+                print(f"🧹 Удалено служебных записей \"печатает...\": {stale}")
+            self.relationships.load()
+            
+            # Уплотнение воспоминаний, накопленных до запуска
+            evicted = self.memories.compact_all()
+            db.session.commit()
+            self.memories.committed()
+            if evicted:
+                print(f"🧹 Уплотнено воспоминаний: {evicted}")
+            
+            if VECTOR_SEARCH_AVAILABLE:
+                os.makedirs(app.instance_path, exist_ok=True)
+                self.vectors = VectorIndex(app.config['VECTOR_INDEX_PATH'])
+                while index_new_rows(self.vectors):
+                    pass
+                # Воспоминания, удаленные уплотнением (в том числе до этого запуска)
+                prune_deleted(self.vectors)
+                print(f"🔎 Векторный индекс: {len(self.vectors)} текстов")
+            
+            if app.config['SIM_SHARDS'] > 0:
+                self.shards = ShardCoordinator(app.config['SIM_SHARDS'])
+                self.shards.start()
+            
             # Основной цикл симуляции
             while self.running:
                 try:
+                    self.scheduler.begin_tick()
+                    
                     # Получаем текущее состояние мира
                     agents = Agent.query.all()
                     world = self._get_or_create_world()
@@ -64,31 +297,98 @@ class AgentSimulator:
                     
                     # Проверяем завершенные диалоги от GigaChat
                     self._check_pending_dialogues()
+                    # Результаты, которые уже никто не ждет, и устаревшие отметки агентов
+                    gigachat.sweep(list(self.pending_dialogues))
+                    # Очередные реплики сгенерированных целиком разговоров
+                    self._reveal_exchange_turns(world)
+                    # Ходы групповых разговоров и поиск новых групп
+                    if app.config['GROUP_CONVERSATIONS']:
+                        self._advance_group_conversations(agents, world)
                     
-                    # Обновляем каждого агента
-                    for agent in agents:
-                        self._update_agent_state(agent, world)
-                        
-                        # Обработка диалогов и ответов
-                        self._process_agent_communications(agent, agents, world)
+                    # Сообщения пользователей, переданные веб-воркерами через БД
+                    if self.claim_user_messages:
+                        self._claim_user_messages(world)
+                    
+                    if self.shards:
+                        # Состояние агентов считается в процессах-шардах
+                        self._sharded_tick(agents, world)
+                    else:
+                        # Обновляем каждого агента
+                        for agent in agents:
+                            self._update_agent_state(agent, world)
+                            
+                            # Обработка диалогов и ответов
+                            self._process_agent_communications(agent, agents, world)
+                    
+                    # Рефлексии, собранные за тик, - пакетами
+                    self._flush_reflections()
+                    
+                    # Запасы приветствий: сброс устаревших, пока очередь пуста - заготовка новых
+                    self.openers.sync(agents)
+                    if self.scheduler.allow_optional():
+                        self._fill_opener_pool(agents)
+                    
+                    # Глобальные события мира (необязательная работа)
+                    if self.scheduler.allow_optional():
+                        self._generate_world_events(world)
                     
-                    # Глобальные события мира
-                    self._generate_world_events(world)
+                    # Фоновое уплотнение воспоминаний агентов, превысивших бюджет
+                    compacted = 0
+                    if world.cycle % app.config['MEMORY_COMPACT_INTERVAL'] == 0 and self.scheduler.allow_optional():
+                        compacted = self.memories.compact()
+                    
+                    # Дообучение локального генератора на новых репликах и мыслях
+                    if (app.config['LLM_OFFLINE_GENERATOR'] == 'markov'
+                            and world.cycle % app.config['MARKOV_TRAIN_INTERVAL'] == 0
+                            and self.scheduler.allow_optional()):
+                        train_new_rows(text_model, agents)
+                    
+                    # Индексация новых текстов для векторного поиска
+                    if (self.vectors is not None and world.cycle % app.config['VECTOR_INDEX_INTERVAL'] == 0
+                            and self.scheduler.allow_optional()):
+                        index_new_rows(self.vectors)
+                    
+                    # Отношения: затухание и пакетная запись в БД
+                    if world.cycle % app.config['RELATIONSHIP_DECAY_INTERVAL'] == 0:
+                        self.relationships.decay(app.config['RELATIONSHIP_DECAY_FACTOR'])
+                    if world.cycle % app.config['RELATIONSHIP_FLUSH_INTERVAL'] == 0:
+                        self.relationships.flush()
+                    
+                    # Дельта цикла в журнал мира (в той же транзакции)
+                    world_log.record(world, agents, self.relationships.as_pairs())
                     
                     # Сохраняем все изменения в БД
                     db.session.commit()
+                    self.relationships.committed()
+                    self.memories.committed()
+                    # Удаленные воспоминания убираем из векторного индекса только после commit
+                    if compacted and self.vectors is not None:
+                        prune_deleted(self.vectors)
                     
                     # Логирование состояния (каждые 10 циклов)
                     if world.cycle % 10 == 0:
                         self._log_simulation_state(world, agents)
                     
-                    # Пауза между циклами (5 секунд)
-                    time.sleep(5)
+                    # Пауза до следующего тика по расписанию
+                    self.scheduler.end_tick()
+                    self.scheduler.wait()
                     
                 except Exception as e:
                     print(f"❌ Ошибка симуляции на цикле {world.cycle if 'world' in locals() else '?'}: {e}")
                     db.session.rollback()
-                    time.sleep(5)
+                    self.relationships.rolled_back()
+                    self.memories.rolled_back()
+                    self.scheduler.backoff(self.scheduler.tick_interval)
+            
+            # Несохраненные изменения отношений
+            if self.relationships.flush():
+                db.session.commit()
+                self.relationships.committed()
+            # и историй разговоров
+            gigachat.dialogue_contexts.flush()
+            
+            if self.shards:
+                self.shards.stop()
     
     def _initialize_agents(self, agent_names, agent_types):
         """Инициализация начальных агентов внутри границ мира"""
@@ -122,39 +422,56 @@ class AgentSimulator:
     
     def _update_agent_state(self, agent, world):
         """Обновление базового состояния агента"""
-        # Изменение энергии
-        agent.energy += random.uniform(-0.05, 0.05)
-        agent.energy = max(0.1, min(1.0, agent.energy))
-        
-        # Случайное движение
-        agent.position_x += random.uniform(-0.5, 0.5)
-        agent.position_y += random.uniform(-0.5, 0.5)
-        agent.position_z += random.uniform(-0.5, 0.5)
-        
-        # Ограничиваем мир
-        world_bounds = 10.0
-        agent.position_x = max(-world_bounds, min(world_bounds, agent.position_x))
-        agent.position_y = max(-world_bounds, min(world_bounds, agent.position_y))
-        agent.position_z = max(-world_bounds, min(world_bounds, agent.position_z))
+        # Энергия, случайное движение в границах мира и настроение
+        state = advance_agent_state({
+            'energy': agent.energy,
+            'x': agent.position_x,
+            'y': agent.position_y,
+            'z': agent.position_z,
+            'mood': agent.mood
+        }, random)
+        self._apply_agent_state(agent, state)
         
-        # Обновление настроения
-        self._update_agent_mood(agent)
+        # Создание случайных воспоминаний (необязательная работа)
+        if random.random() < 0.3 and self.scheduler.allow_optional():
+            self._create_agent_memory(agent, world)
+    
+    def _apply_agent_state(self, agent, state):
+        """Перенос рассчитанного состояния в строку агента"""
+        agent.energy = state['energy']
+        agent.position_x = state['x']
+        agent.position_y = state['y']
+        agent.position_z = state['z']
+        agent.mood = state['mood']
         
         # Обновление времени последней активности
         agent.last_active = datetime.utcnow()
-        
-        # Создание случайных воспоминаний
-        if random.random() < 0.3:
-            self._create_agent_memory(agent, world)
     
-    def _update_agent_mood(self, agent):
-        """Обновление настроения агента"""
-        if agent.energy < 0.3:
-            agent.mood = 'уставший'
-        elif agent.energy > 0.8:
-            agent.mood = 'возбужденный'
-        else:
-            agent.mood = random.choice(['любопытный', 'нейтральный', 'сфокусированный'])
+    def _sharded_tick(self, agents, world):
+        """
+        Цикл мира через шарды: физика агентов и выбор новых собеседников - в процессах;
+        неотвеченные сообщения, продолжения, БД и LLM - по-прежнему в этом потоке
+        """
+        self.shards.sync_agents(agents)
+        by_id = {agent.id: agent for agent in agents}
+        
+        updates, accepted = self.shards.step(world.cycle, allow_talk=self._llm_request_allowed())
+        
+        for update in updates:
+            agent = by_id.get(update['id'])
+            if not agent:
+                continue
+            self._apply_agent_state(agent, update)
+            if update['remember'] and self.scheduler.allow_optional():
+                self._create_agent_memory(agent, world)
+        
+        for agent in agents:
+            # Новые разговоры согласуются шардами, здесь только ответы и продолжения
+            self._process_agent_communications(agent, agents, world, allow_new=False)
+        
+        for sender_id, target_id in accepted:
+            if sender_id in by_id and target_id in by_id:
+                self._start_new_dialogue(by_id[sender_id], by_id[target_id], world)
     
     def _create_agent_memory(self, agent, world):
         """Создание базового воспоминания"""
@@ -166,17 +483,21 @@ class AgentSimulator:
             f"Обнаружил интересный паттерн в данных"
         ]
         
-        memory = AgentMemory(
-            agent_id=agent.id,
-            memory_type=random.choice(memory_types),
-            content=random.choice(memory_contents),
-            significance=random.uniform(0.1, 1.0)
+        # Повторяющиеся наблюдения сливаются в одну запись со счетчиком
+        self.memories.remember(
+            agent.id,
+            random.choice(memory_types),
+            random.choice(memory_contents),
+            random.uniform(0.1, 1.0)
         )
-        db.session.add(memory)
     
-    def _process_agent_communications(self, agent, agents, world):
+    def _process_agent_communications(self, agent, agents, world, allow_new=True):
         """Обработка коммуникаций агента"""
         
+        # Агент в середине сгенерированного или группового разговора - парные диалоги не начинаем
+        if self._in_conversation(agent.id):
+            return
+        
         # 1. Сначала проверяем, есть ли неотвеченные сообщения
         unresponded = Dialogue.query.filter(
             (Dialogue.agent2_name == agent.name) &  # сообщение адресовано этому агенту
@@ -209,51 +530,74 @@ class AgentSimulator:
                 if time_since.seconds < 300:  # 6 минут
                     # Слишком рано для нового сообщения
                     pass
-                elif random.random() < 0.1:  # 10% шанс продолжить диалог
+                elif random.random() < 0.1 and self._llm_request_allowed():  # 10% шанс продолжить диалог
                     # Продолжаем диалог - отправляем новое сообщение тому же агенту
                     self._generate_ai_dialogue(agent, other_agent, world, is_continuation=True)
                     return
         
         # 3. Если нет активных диалогов, с небольшой вероятностью начинаем новый
-        if world.cycle % 5 == 0 and random.random() < 0.08:  # 15% шанс каждые 3 цикла
+        if allow_new and world.cycle % 5 == 0 and random.random() < 0.08 and self._llm_request_allowed():  # 15% шанс каждые 3 цикла
             other_agents = [a for a in agents if a.id != agent.id]
             if other_agents:
                 target = random.choice(other_agents)
-                
-                # Проверяем, не общались ли недавно
-                recent = Dialogue.query.filter(
-                    ((Dialogue.agent1_name == agent.name) & (Dialogue.agent2_name == target.name)) |
-                    ((Dialogue.agent1_name == target.name) & (Dialogue.agent2_name == agent.name))
-                ).order_by(Dialogue.timestamp.desc()).first()
-                
-                # Если общались менее 5 минут назад, пропускаем
-                if recent and (datetime.utcnow() - recent.timestamp).seconds < 600:
+                if not self._start_new_dialogue(agent, target, world):
                     return
-                
-                self._generate_ai_dialogue(agent, target, world, is_continuation=False)
         
-        # 4. AI-рефлексии: каждый 15-й цикл
-        if world.cycle % 15 == 0 and random.random() < 0.3:
+        # 4. AI-рефлексии: каждый 15-й цикл (необязательная работа)
+        if (world.cycle % 15 == 0 and random.random() < 0.3
+                and self.scheduler.allow_optional() and self._llm_request_allowed()):
             self._generate_agent_reflection(agent, world)
+    
+    def _in_conversation(self, agent_id):
+        return (any(agent_id in (e['agent_id'], e['target_id']) for e in self.exchanges)
+                or any(agent_id in group.members for group in self.groups.values()))
+    
+    def _start_new_dialogue(self, agent, target, world):
+        """Начинает новый диалог, если агенты недавно не общались"""
+        recent = Dialogue.query.filter(
+            ((Dialogue.agent1_name == agent.name) & (Dialogue.agent2_name == target.name)) |
+            ((Dialogue.agent1_name == target.name) & (Dialogue.agent2_name == agent.name))
+        ).order_by(Dialogue.timestamp.desc()).first()
+        
+        # Если общались менее 5 минут назад, пропускаем
+        if recent and (datetime.utcnow() - recent.timestamp).seconds < 600:
+            return False
+        
+        self._generate_ai_dialogue(agent, target, world, is_continuation=False)
+        return True
+    
+    def _llm_request_allowed(self):
+        """Backpressure: чем длиннее очередь GigaChat, тем реже агенты сами инициируют запросы"""
+        factor = self.scheduler.llm_throttle(
+            gigachat.queue_size(),
+            app.config['LLM_QUEUE_LOW_WATER'],
+            app.config['LLM_QUEUE_HIGH_WATER']
+        )
+        if factor >= 1.0 or random.random() < factor:
+            return True
+        self.scheduler.note_throttled()
+        return False
 
     def _generate_ai_response(self, agent, sender, original_dialogue, world):
         """Генерация ответа на конкретное сообщение"""
         
         print(f"💬 {agent.name} отвечает {sender.name}")
         
-        # Получаем историю диалога для контекста
-        dialogue_history = Dialogue.query.filter(
-            ((Dialogue.agent1_name == agent.name) & (Dialogue.agent2_name == sender.name)) |
-            ((Dialogue.agent1_name == sender.name) & (Dialogue.agent2_name == agent.name))
-        ).order_by(Dialogue.timestamp.asc()).limit(10).all()
+        # История диалога из БД нужна, только если в памяти GigaChatManager ее нет (например, после перезапуска)
+        dialogue_history = []
+        if not gigachat.has_dialogue_context(agent.id, sender.id):
+            dialogue_history = Dialogue.query.filter(
+                ((Dialogue.agent1_name == agent.name) & (Dialogue.agent2_name == sender.name)) |
+                ((Dialogue.agent1_name == sender.name) & (Dialogue.agent2_name == agent.name))
+            ).order_by(Dialogue.timestamp.desc()).limit(10).all()[::-1]
         
-        history_for_context = []
-        for d in dialogue_history:
-            if d.message and d.message not in ["✍️ печатает ответ...", "⏳ печатает..."]:
-                history_for_context.append({
-                    'speaker_id': d.agent1_id if d.agent1_name == agent.name else d.agent2_id,
-                    'text': d.message
-                })
+        # Время реплик - местное, как у сообщений, которые GigaChatManager добавляет в историю сам
+        history_for_context = [{
+            'speaker_id': d.agent1_id,
+            'speaker_name': d.agent1_name,
+            'text': d.message,
+            'timestamp': datetime.fromtimestamp(_epoch(d.timestamp)) if d.timestamp else None
+        } for d in dialogue_history if d.message]
         
         # Контекст с учетом исходного сообщения
         context = {
@@ -266,7 +610,9 @@ class AgentSimulator:
             'agent_type': agent.type,
             'other_type': sender.type,
             'original_message': original_dialogue.message,
-            'history': history_for_context
+            'history': history_for_context,
+            'memories': self.memories.recall(agent.id, original_dialogue.message),
+            'similar_lines': self._similar_own_lines(agent, original_dialogue.message)
         }
         
         # Запрашиваем ответ через GigaChat
@@ -291,20 +637,16 @@ class AgentSimulator:
         
         print(f"📝 Запрос ответа от {agent.name} добавлен в очередь")
         
-        # Создаем временную запись о том, что агент печатает ответ
-        typing_dialogue = Dialogue(
-            agent1_id=agent.id,
-            agent2_id=sender.id,
-            agent1_name=agent.name,
-            agent2_name=sender.name,
-            message="✍️ печатает ответ...",
-            dialogue_type='typing',
-            world_cycle=world.cycle,
-            response_to=original_dialogue.id
-        )
-        db.session.add(typing_dialogue)
-        db.session.commit()
+        # Индикатор "печатает ответ..." (снимается, когда ответ сохранен)
+        presence.set(task_id, 'typing', agent.name, sender.name, response_to=original_dialogue.id)
 
+    def _similar_own_lines(self, agent, text, k=2):
+        """Похожие прошлые реплики агента - чтобы не повторяться"""
+        if self.vectors is None or not text:
+            return []
+        found = self.vectors.search(text, k=k, kind='dialogue', agent_id=agent.id, min_score=0.5)
+        return [item['text'] for item in found]
+    
     def _generate_ai_dialogue(self, agent, target, world, is_continuation=False):
         """Генерация нового сообщения в диалоге"""
         
@@ -318,11 +660,15 @@ class AgentSimulator:
             'agent_name': agent.name,
             'other_name': target.name,
             'agent_type': agent.type,
-            'other_type': target.type
+            'other_type': target.type,
+            'memories': self.memories.recall(agent.id, target.name)
         }
         
         # Используем специальный метод для первого сообщения или продолжаем диалог
-        if is_continuation:
+        if app.config['DIALOGUE_EXCHANGE_MODE']:
+            # Весь короткий разговор - одним запросом
+            task_id = gigachat.request_exchange(agent, target, random.randint(*app.config['DIALOGUE_EXCHANGE_TURNS']), context)
+        elif is_continuation:
             # Для продолжения диалога используем request_response без исходного сообщения
             task_id = gigachat.request_response(agent, target, "Продолжи наш разговор", [], context)
         else:
@@ -341,26 +687,16 @@ class AgentSimulator:
             'world_cycle': world.cycle,
             'timestamp': datetime.now(),
             'attempts': 0,
-            'type': 'first_message' if not is_continuation else 'continuation'
+            'type': 'exchange' if app.config['DIALOGUE_EXCHANGE_MODE'] else
+                    ('first_message' if not is_continuation else 'continuation')
         }
         
         print(f"📝 {task_id} добавлен в очередь ожидания")
         
-        # Создаем временную запись
-        dialogue = Dialogue(
-            agent1_id=agent.id,
-            agent2_id=target.id,
-            agent1_name=agent.name,
-            agent2_name=target.name,
-            message="⏳ печатает...",
-            dialogue_type='pending',
-            world_cycle=world.cycle
-        )
-        db.session.add(dialogue)
-        db.session.commit()
+        presence.set(task_id, 'pending', agent.name, target.name)
     
     def _generate_agent_reflection(self, agent, world):
-        """Генерация рефлексии агента"""
+        """Генерация рефлексии агента (запрос уходит пакетом в _flush_reflections)"""
         
         print(f"🤔 Запрашиваю рефлексию: {agent.name}")
         
@@ -376,23 +712,145 @@ class AgentSimulator:
             'agent_name': agent.name,
             'agent_type': agent.type,
             'agent_mood': agent.mood,
-            'agent_energy': agent.energy
+            'agent_energy': agent.energy,
+            'memories': self.memories.recall(agent.id, recent_text)
         }
         
-        task_id = gigachat.request_reflection(agent, recent_text, context)
+        self.reflection_requests.append((agent, recent_text, context))
+    
+    def _flush_reflections(self):
+        """Отправляет собранные рефлексии пакетами и регистрирует ожидание по каждому агенту"""
+        if not self.reflection_requests:
+            return
+        items, self.reflection_requests = self.reflection_requests, []
+        task_ids = gigachat.request_reflections(items)
         
-        if task_id is None:
+        for agent, _, context in items:
+            task_id = task_ids.get(agent.id)
+            if task_id is None:
+                continue
+            self.pending_dialogues[task_id] = {
+                'agent_id': agent.id,
+                'agent_name': agent.name,
+                'type': 'reflection',
+                'world_cycle': context['cycle'],
+                'timestamp': datetime.now(),
+                'attempts': 0
+            }
+    
+    def _fill_opener_pool(self, agents):
+        """Одна фоновая заготовка приветствия за тик - только когда очередь GigaChat пуста"""
+        if gigachat.queue_size() > 0 or not agents:
+            return
+        agent = max(agents, key=self.openers.deficit)
+        if not self.openers.deficit(agent):
             return
         
+        task_id = gigachat.request_opener(agent)
+        self.openers.reserve(agent.id, agent.mood, agent.type)
         self.pending_dialogues[task_id] = {
             'agent_id': agent.id,
             'agent_name': agent.name,
-            'type': 'reflection',
-            'world_cycle': world.cycle,
+            'mood': agent.mood,
+            'agent_type': agent.type,
+            'type': 'opener',
+            'world_cycle': 0,
             'timestamp': datetime.now(),
             'attempts': 0
         }
     
+    def serve_opener(self, agent, user_message):
+        """
+        Мгновенный ответ на приветствие, которым человек начинает новый разговор с агентом:
+        готовое приветствие из пула вместо запроса GigaChat. Возвращает текст или None (без commit).
+        """
+        if not is_greeting(user_message.message):
+            return None
+        since = datetime.utcnow() - timedelta(seconds=app.config['CHAT_NEW_CONVERSATION_GAP'])
+        earlier = UserAgentChat.query.filter(
+            (UserAgentChat.user_id == user_message.user_id) &
+            (UserAgentChat.agent_id == agent.id) &
+            (UserAgentChat.id != user_message.id) &
+            (UserAgentChat.timestamp >= since)
+        ).first()
+        if earlier:
+            return None
+        
+        text = self.openers.take(agent)
+        if text is None:
+            return None
+        
+        user_message.response = text
+        user_message.response_received = True
+        db.session.add(UserAgentChat(
+            user_id=user_message.user_id,
+            agent_id=agent.id,
+            response=text,
+            sender_type='agent',
+            conversation_id=user_message.conversation_id,
+            response_received=True
+        ))
+        print(f"⚡ {agent.name} ответил готовым приветствием")
+        return text
+    
+    def track_human_response(self, task_id, agent, user_id, world_cycle, trace_id=None):
+        """Регистрирует ожидание ответа агента пользователю"""
+        self.pending_dialogues[task_id] = {
+            'agent_id': agent.id,
+            'agent_name': agent.name,
+            'user_id': user_id,
+            'type': 'human_response',
+            'world_cycle': world_cycle,
+            'timestamp': datetime.now(),
+            'attempts': 0,
+            'trace_id': trace_id
+        }
+    
+    def _claim_user_messages(self, world):
+        """Запрашивает ответы на сообщения пользователей, сохраненные веб-воркерами"""
+        waiting = UserAgentChat.query.filter(
+            (UserAgentChat.sender_type == 'user') &
+            (UserAgentChat.response_received == False) &
+            (UserAgentChat.task_id.is_(None)) &
+            (UserAgentChat.timestamp <= datetime.utcnow() - timedelta(seconds=self.claim_delay))
+        ).order_by(UserAgentChat.timestamp.asc()).limit(20).all()
+        
+        for user_message in waiting:
+            agent = Agent.query.get(user_message.agent_id)
+            user = User.query.get(user_message.user_id)
+            if not agent or not user:
+                user_message.response_received = True
+                continue
+            
+            if self.serve_opener(agent, user_message):
+                continue
+            
+            context = {
+                'cycle': world.cycle,
+                'complexity': world.complexity,
+                'agent_name': agent.name,
+                'other_name': f"Пользователь {user.username}",
+                'agent_type': agent.type,
+                'other_type': 'человек',
+                'agent_mood': agent.mood,
+                'other_mood': 'общается',
+                'agent_energy': agent.energy,
+                'is_human': True,
+                'human_message': user_message.message,
+                'memories': self.memories.recall(agent.id, user_message.message)
+            }
+            trace_id = user_message.conversation_id
+            task_id = gigachat.request_human_response(agent, user, user_message.message, context, trace_id=trace_id)
+            if task_id is None:
+                continue  # Агент занят - попробуем на следующем цикле
+            
+            # Сколько сообщение ждало в БД, пока его заберет процесс симуляции
+            tracer.record(trace_id, 'claim.wait', _epoch(user_message.timestamp))
+            user_message.task_id = task_id
+            self.track_human_response(task_id, agent, user.id, world.cycle, trace_id)
+        
+        db.session.commit()
+    
     def _check_pending_dialogues(self):
         """Проверка завершенных диалогов от GigaChat - с автоматическими ответами при таймауте"""
         completed = []
@@ -400,10 +858,15 @@ class AgentSimulator:
         for task_id, pending in list(self.pending_dialogues.items()):
             pending['attempts'] = pending.get('attempts', 0) + 1
             
-            result = gigachat.get_result(task_id, timeout=1)  # Уменьшен таймаут
+            # Без ожидания: не готовый результат заберем на следующем тике
+            result = gigachat.get_result(task_id, timeout=0)
             
             if result:
                 print(f"✅ ПОЛУЧЕН РЕЗУЛЬТАТ: {result[:100]}...")
+                # Какой бэкенд написал текст: локальный генератор учится только на ответах провайдера
+                source = gigachat.result_source(task_id)
+                picked = time.time()
+                tracer.record_since(pending.get('trace_id'), 'result.wait', 'result')
                 
                 try:
                     if pending.get('type') == 'response':
@@ -415,7 +878,8 @@ class AgentSimulator:
                             pending['agent_id'],
                             pending['target_id'],
                             pending['agent_id'],
-                            result
+                            result,
+                            pending['agent_name']
                         )
                         
                         # Создаем запись с ответом
@@ -426,6 +890,7 @@ class AgentSimulator:
                             agent2_name=pending['target_name'],
                             message=result,
                             dialogue_type='ai_response',
+                            source=source,
                             world_cycle=pending['world_cycle'],
                             response_to=pending.get('original_dialogue_id')
                         )
@@ -446,6 +911,7 @@ class AgentSimulator:
                             world_cycle=pending['world_cycle']
                         )
                         db.session.add(event)
+                        self._update_relationship(pending['agent_name'], pending['target_name'], 0.05)
                         
                     elif pending.get('type') == 'reflection':
                         # Сохраняем рефлексию
@@ -454,6 +920,7 @@ class AgentSimulator:
                             agent_name=pending['agent_name'],
                             thought=result,
                             thought_type='reflection',
+                            source=source,
                             world_cycle=pending['world_cycle'],
                             significance=0.8
                         )
@@ -478,7 +945,8 @@ class AgentSimulator:
                             task_id=task_id
                         ).first()
                         
-                        if user_message:
+                        # Если пользователь уже получил заготовку, второй ответ не добавляем
+                        if user_message and not user_message.response_received:
                             user_message.response = result
                             user_message.response_received = True
                             
@@ -495,6 +963,32 @@ class AgentSimulator:
                             
                             print(f"✅ Ответ пользователю сохранен")
                     
+                    elif pending.get('type') == 'group_turn':
+                        self._save_group_turn(pending['conversation_id'], result, pending['world_cycle'], source)
+                    
+                    elif pending.get('type') == 'opener':
+                        # Заготовка приветствия - в запас того настроения, в котором она писалась
+                        self.openers.add(pending['agent_id'], pending['mood'], pending['agent_type'], result)
+                    
+                    elif pending.get('type') == 'exchange':
+                        # Разговор целиком: реплики показываются постепенно в _reveal_exchange_turns
+                        turns = parse_exchange(result, {pending['agent_name'], pending['target_name']})
+                        if not turns:
+                            # Ответ не в формате разговора - считаем его первой репликой
+                            turns = [(pending['agent_name'], result.strip())]
+                        self.exchanges.append(dict(pending, turns=turns, index=0, previous_id=None, next_cycle=0,
+                                                   source=source))
+                        print(f"🎭 Разговор {pending['agent_name']} и {pending['target_name']}: {len(turns)} реплик")
+                        
+                        event = Event(
+                            event_text=f"💬 {pending['agent_name']} заговорил с {pending['target_name']}",
+                            agent1=pending['agent_name'],
+                            agent2=pending['target_name'],
+                            event_type='диалог',
+                            world_cycle=pending['world_cycle']
+                        )
+                        db.session.add(event)
+                    
                     else:
                         # Обычный диалог
                         print(f"💾 Сохраняю диалог: {pending['agent_name']} -> {pending['target_name']}")
@@ -503,7 +997,8 @@ class AgentSimulator:
                             pending['agent_id'],
                             pending['target_id'],
                             pending['agent_id'],
-                            result
+                            result,
+                            pending['agent_name']
                         )
                         
                         dialogue = Dialogue(
@@ -513,6 +1008,7 @@ class AgentSimulator:
                             agent2_name=pending['target_name'],
                             message=result,
                             dialogue_type='ai_response',
+                            source=source,
                             world_cycle=pending['world_cycle']
                         )
                         db.session.add(dialogue)
@@ -525,9 +1021,11 @@ class AgentSimulator:
                             world_cycle=pending['world_cycle']
                         )
                         db.session.add(event)
+                        self._update_relationship(pending['agent_name'], pending['target_name'])
                     
                     db.session.commit()
                     print(f"✅ Данные сохранены в БД")
+                    tracer.record(pending.get('trace_id'), 'db.write', picked)
                     completed.append(task_id)
                     
                 except Exception as e:
@@ -535,9 +1033,12 @@ class AgentSimulator:
                     db.session.rollback()
             
             else:
-                # Если прошло много попыток, генерируем автоматический ответ
-                if pending['attempts'] > 5:  # После 5 попыток (примерно 10 секунд)
+                # Задачу в очереди или в работе ждем дальше (в том числе после перезапуска);
+                # автоматический ответ - только если задача провалилась или потеряна
+                state = gigachat.task_state(task_id)
+                if state == 'failed' or (pending['attempts'] > 5 and state not in ('queued', 'running')):
                     print(f"⏰ Таймаут задачи {task_id}, генерирую автоматический ответ")
+                    tracer.record(pending.get('trace_id'), 'auto_reply', time.time(), reason=state or 'lost')
                     
                     # Генерируем автоматический ответ для человека
                     if pending.get('type') == 'human_response':
@@ -570,34 +1071,211 @@ class AgentSimulator:
                             db.session.commit()
                             print(f"✅ Автоматический ответ сохранен")
                     
+                    elif pending.get('type') == 'opener':
+                        self.openers.release(pending['agent_id'], pending['mood'], pending['agent_type'])
+                    
+                    # Групповой разговор без ответа завершается
+                    elif pending.get('type') == 'group_turn':
+                        self._end_group_conversation(pending['conversation_id'], pending['world_cycle'])
+                        db.session.commit()
+                    
                     completed.append(task_id)
         
         for task_id in completed:
-            if task_id in self.pending_dialogues:
-                del self.pending_dialogues[task_id]
-    
-    def _update_relationship(self, agent, target, change=None):
-        """Обновление отношений между агентами"""
-        if change is None:
-            change = random.uniform(-0.1, 0.1)
+            self.pending_dialogues.pop(task_id, None)
+            gigachat.ack(task_id)
+            presence.clear(task_id)
+    
+    def _reveal_exchange_turns(self, world):
+        """Показывает по одной реплике каждого сгенерированного разговора (без commit)"""
+        for exchange in list(self.exchanges):
+            if world.cycle < exchange['next_cycle']:
+                continue
+            
+            speaker_name, text = exchange['turns'][exchange['index']]
+            if speaker_name == exchange['agent_name']:
+                speaker = (exchange['agent_id'], exchange['agent_name'])
+                listener = (exchange['target_id'], exchange['target_name'])
+            else:
+                speaker = (exchange['target_id'], exchange['target_name'])
+                listener = (exchange['agent_id'], exchange['agent_name'])
+            
+            dialogue = Dialogue(
+                agent1_id=speaker[0],
+                agent2_id=listener[0],
+                agent1_name=speaker[1],
+                agent2_name=listener[1],
+                message=text,
+                dialogue_type='ai_response',
+                source=exchange.get('source'),
+                world_cycle=world.cycle,
+                response_to=exchange['previous_id']
+            )
+            db.session.add(dialogue)
+            db.session.flush()
+            
+            # Предыдущая реплика получила ответ
+            if exchange['previous_id']:
+                previous = db.session.get(Dialogue, exchange['previous_id'])
+                if previous:
+                    previous.response = text
+                    previous.response_id = dialogue.id
+            
+            gigachat.save_dialogue_to_history(speaker[0], listener[0], speaker[0], text, speaker[1])
+            self._update_relationship(speaker[1], listener[1], 0.02)
+            
+            exchange['previous_id'] = dialogue.id
+            exchange['index'] += 1
+            exchange['next_cycle'] = world.cycle + app.config['DIALOGUE_REVEAL_INTERVAL']
+            if exchange['index'] >= len(exchange['turns']):
+                self.exchanges.remove(exchange)
+    
+    def _advance_group_conversations(self, agents, world):
+        """
+        Групповые разговоры: участники, отошедшие далеко, покидают группу, готовые к ходу
+        группы получают запрос следующей реплики, изредка собираются новые группы (без commit).
+        """
+        by_id = {agent.id: agent for agent in agents}
+        radius = app.config['GROUP_RADIUS']
         
-        name1, name2 = sorted([agent.name, target.name])
+        for group in list(self.groups.values()):
+            if group.task_id is not None or world.cycle < group.next_cycle:
+                continue
+            members = [by_id[agent_id] for agent_id in group.members if agent_id in by_id]
+            if members:
+                center = centroid([(a.position_x, a.position_y, a.position_z) for a in members])
+                for agent in members:
+                    position = (agent.position_x, agent.position_y, agent.position_z)
+                    if sum((p - c) ** 2 for p, c in zip(position, center)) > (radius * 1.5) ** 2:
+                        group.leave(agent.id)
+            for agent_id in list(group.members):
+                if agent_id not in by_id:
+                    group.leave(agent_id)
+            
+            if group.finished:
+                self._end_group_conversation(group.conversation_id, world.cycle)
+            else:
+                self._request_group_turn(group, [by_id[agent_id] for agent_id in group.members], world.cycle)
         
-        rel = Relationship.query.filter_by(
-            agent1=name1,
-            agent2=name2
-        ).first()
+        # Новые группы - только при запасе времени тика и свободной очереди GigaChat
+        if (world.cycle % app.config['GROUP_START_INTERVAL'] != 0
+                or len(self.groups) >= app.config['GROUP_MAX_ACTIVE']
+                or not self.scheduler.allow_optional() or not self._llm_request_allowed()):
+            return
         
-        if rel:
-            rel.relationship_value += change
-            rel.relationship_value = max(-1.0, min(1.0, rel.relationship_value))
-        else:
-            rel = Relationship(
-                agent1=name1,
-                agent2=name2,
-                relationship_value=change
+        positions = {
+            agent.id: (agent.position_x, agent.position_y, agent.position_z)
+            for agent in agents if not self._in_conversation(agent.id)
+        }
+        min_size, max_size = app.config['GROUP_SIZE']
+        for member_ids in find_groups(positions, radius, min_size, max_size):
+            if len(self.groups) >= app.config['GROUP_MAX_ACTIVE']:
+                break
+            conversation_id = f"group_{world.cycle}_{member_ids[0]}"
+            group = GroupConversation(
+                conversation_id,
+                [(agent_id, by_id[agent_id].name) for agent_id in member_ids],
+                world.cycle,
+                max_turns=app.config['GROUP_MAX_TURNS']
             )
-            db.session.add(rel)
+            self.groups[conversation_id] = group
+            print(f"👥 Групповой разговор {conversation_id}: {', '.join(group.names)}")
+            
+            db.session.add(Event(
+                event_text=f"👥 Собрались поговорить: {', '.join(group.names)}",
+                agent1=group.names[0],
+                agent2=None,
+                event_type='диалог',
+                world_cycle=world.cycle
+            ))
+            self._request_group_turn(group, [by_id[agent_id] for agent_id in member_ids], world.cycle)
+    
+    def _request_group_turn(self, group, members, world_cycle):
+        """Запрос следующего хода группы с общим контекстом: история и воспоминания участников"""
+        topic = group.history[-1][1] if group.history else None
+        memories = [
+            f"{agent.name}: {memory}"
+            for agent in members
+            for memory in self.memories.recall(agent.id, topic, k=1)
+        ]
+        group.task_id = gigachat.request_group_turn(
+            group.conversation_id, members, group.history, group.last_speaker, {'memories': memories}
+        )
+        self.pending_dialogues[group.task_id] = {
+            'conversation_id': group.conversation_id,
+            'agent_id': members[0].id,
+            'agent_name': members[0].name,
+            'target_id': None,
+            'target_name': None,
+            'world_cycle': world_cycle,
+            'timestamp': datetime.now(),
+            'attempts': 0,
+            'type': 'group_turn'
+        }
+    
+    def _save_group_turn(self, conversation_id, result, world_cycle, source=None):
+        """Сохраняет реплику группового разговора (Dialogue с conversation_id), без commit"""
+        group = self.groups.get(conversation_id)
+        if group is None:
+            return
+        group.task_id = None
+        
+        turn = pick_turn(parse_exchange(result, set(group.names)), group.names, group.last_speaker)
+        if turn is None:
+            # Ответ не в формате "Имя: реплика" - говорит случайный участник
+            speaker = random.choice([name for name in group.names if name != group.last_speaker])
+            turn = (speaker, result.strip().splitlines()[0].strip('"«» '))
+        speaker_name, text = turn
+        addressee_name = group.addressee(speaker_name)
+        
+        dialogue = Dialogue(
+            agent1_id=group.member_id(speaker_name),
+            agent2_id=group.member_id(addressee_name),
+            agent1_name=speaker_name,
+            agent2_name=addressee_name,
+            message=text,
+            dialogue_type='group',
+            source=source,
+            conversation_id=conversation_id,
+            world_cycle=world_cycle,
+            response_to=group.last_dialogue_id
+        )
+        db.session.add(dialogue)
+        db.session.flush()
+        
+        # Предыдущая реплика группы получила ответ
+        if group.last_dialogue_id:
+            previous = db.session.get(Dialogue, group.last_dialogue_id)
+            if previous:
+                previous.response = text
+                previous.response_id = dialogue.id
+        
+        for name in group.names:
+            if name != speaker_name:
+                self._update_relationship(speaker_name, name, 0.01)
+        
+        group.add_turn(speaker_name, text, dialogue.id)
+        group.next_cycle = world_cycle + app.config['DIALOGUE_REVEAL_INTERVAL']
+        print(f"👥 {conversation_id} [{group.turns}/{group.max_turns}] {speaker_name}: {text[:50]}")
+    
+    def _end_group_conversation(self, conversation_id, world_cycle):
+        group = self.groups.pop(conversation_id, None)
+        if group is None or not group.turns:
+            return
+        db.session.add(Event(
+            event_text=f"👥 Групповой разговор завершен ({group.turns} реплик)",
+            agent1=group.names[0] if group.names else None,
+            agent2=None,
+            event_type='диалог',
+            world_cycle=world_cycle
+        ))
+    
+    def _update_relationship(self, agent_name, target_name, change=None):
+        """Обновление отношений между агентами (в памяти, в БД - через flush)"""
+        if change is None:
+            change = random.uniform(-0.1, 0.1)
+        
+        return self.relationships.update(agent_name, target_name, change)
     
     def _generate_world_events(self, world):
         """Генерация глобальных событий мира"""
@@ -623,13 +1301,32 @@ class AgentSimulator:
             for agent in agents:
                 agent.energy *= random.uniform(0.9, 1.1)
                 agent.energy = max(0.1, min(1.0, agent.energy))
+                if self.shards:
+                    self.shards.override(agent.id, energy=agent.energy)
+    
+    def get_status(self):
+        """Статистика симуляции для API и процесса iskra_sim.py"""
+        stats = self.scheduler.get_stats()
+        stats['llm_queue_size'] = gigachat.queue_size()
+        stats['llm'] = gigachat.get_stats()
+        stats['pending_dialogues'] = len(self.pending_dialogues)
+        stats['scripted_exchanges'] = len(self.exchanges)
+        stats['presence'] = presence.get_stats()
+        stats['openers'] = self.openers.get_stats()
+        stats['text_model'] = text_model.get_stats()
+        stats['tracing'] = tracer.get_stats()
+        stats['group_conversations'] = [group.to_dict() for group in self.groups.values()]
+        stats['memories'] = self.memories.get_stats()
+        if self.shards:
+            stats['shards'] = self.shards.get_stats()
+        return stats
     
     def _log_simulation_state(self, world, agents):
         """Логирование состояния симуляции"""
         active_dialogues = len(self.pending_dialogues)
         total_memories = AgentMemory.query.count()
         total_thoughts = AgentThought.query.count()
-        total_relationships = Relationship.query.count()
+        total_relationships = len(self.relationships)
         
         print(f"\n{'='*50}")
         print(f"📊 СТАТУС СИМУЛЯЦИИ (цикл {world.cycle})")
@@ -641,11 +1338,55 @@ class AgentSimulator:
         print(f"💬 Активных диалогов: {active_dialogues}")
         print(f"📈 Сложность мира: {world.complexity:.3f}")
         print(f"⚡ Средняя энергия: {sum(a.energy for a in agents)/len(agents):.2f}")
+        sched = self.scheduler.get_stats()
+        print(f"⏱️ Тик: {sched['last_tick_duration']:.2f}с (среднее {sched['avg_tick_duration']:.2f}с, бюджет {sched['tick_budget']:.2f}с)")
+        print(f"⏭️ Пропущено тиков: {sched['dropped_ticks']}, упрощено: {sched['degraded_ticks']}, отложено запросов: {sched['throttled_requests']}")
         print(f"{'='*50}\n")
 
 
 simulator = AgentSimulator()
 
+# Встроенный симулятор под WSGI-сервером: его запускает только воркер, получивший блокировку лидера
+leader_lock = LeaderLock(os.path.join(app.instance_path, LOCK_NAME))
+_embedded_start_lock = threading.Lock()
+_embedded_checked = False
+
+def start_embedded_simulator():
+    """
+    Запускает симулятор и обработчик очереди GigaChat в этом процессе, если он стал лидером.
+    Лидер, как iskra_sim.py, забирает из БД сообщения других воркеров и публикует для них статус;
+    остальные процессы переходят в режим отдельного симулятора (EMBEDDED_SIMULATOR = False).
+    Возвращает True, если симулятор запущен этим вызовом.
+    """
+    global _embedded_checked
+    with _embedded_start_lock:
+        if _embedded_checked:
+            return False
+        _embedded_checked = True
+        
+        os.makedirs(app.instance_path, exist_ok=True)
+        if not leader_lock.acquire(blocking=False):
+            app.config['EMBEDDED_SIMULATOR'] = False
+            print(f"👥 Процесс {os.getpid()}: симулятор уже работает в другом процессе, сообщения передаются через БД")
+            return False
+        print(f"👑 Процесс {os.getpid()} стал лидером симуляции")
+        
+        with app.app_context():
+            db.create_all()
+            upgrade_schema()
+        simulator.claim_user_messages = True
+        simulator.claim_delay = app.config['EMBEDDED_CLAIM_DELAY']
+        presence.mirror_path = app.config['PRESENCE_FILE']
+        simulator.start()
+        
+        status_thread = threading.Thread(
+            target=publish_status,
+            args=(os.path.join(app.instance_path, STATUS_NAME), simulator.get_status, threading.Event()),
+            daemon=True
+        )
+        status_thread.start()
+        return True
+
 # Декоратор требующий авторизации
 def login_required(view):
     @functools.wraps(view)
@@ -656,8 +1397,33 @@ def login_required(view):
         return view(**kwargs)
     return wrapped_view
 
+def is_operator():
+    """Текущий пользователь - оператор из ISKRA_ADMIN_USERS"""
+    user = User.query.get(session['user_id']) if 'user_id' in session else None
+    return user is not None and user.username in app.config['ADMIN_USERS']
+
+def admin_required(view):
+    """Страницы и API только для операторов (ISKRA_ADMIN_USERS)"""
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if 'user_id' not in session:
+            flash('Пожалуйста, войдите в систему', 'error')
+            return redirect(url_for('login'))
+        if not is_operator():
+            if request.path.startswith('/api/'):
+                return jsonify({'error': 'Недостаточно прав'}), 403
+            flash('Недостаточно прав', 'error')
+            return redirect(url_for('index'))
+        return view(**kwargs)
+    return wrapped_view
+
 @app.before_request
 def before_request():
+    # WSGI-сервер импортирует приложение без __main__: симулятор запускается с первым запросом
+    # (после fork воркера, иначе потоки симуляции остались бы в главном процессе)
+    if app.config['EMBEDDED_SIMULATOR'] and not _embedded_checked:
+        start_embedded_simulator()
+    
     g.user = None
     if 'user_id' in session:
         g.user = User.query.get(session['user_id'])
@@ -704,6 +1470,7 @@ def dashboard():
 @login_required
 def send_chat_message():
     """Отправка сообщения агенту от пользователя"""
+    started = time.time()
     user = User.query.get(session['user_id'])
     
     # Проверка подписки
@@ -775,6 +1542,30 @@ def send_chat_message():
     db.session.add(user_message)
     db.session.commit()
     
+    if not app.config['EMBEDDED_SIMULATOR']:
+        # Ответ запросит отдельный процесс симуляции, забрав сообщение из БД
+        tracer.record(conversation_id, 'http.send', started, agent=agent.name, outcome='stored')
+        return jsonify({
+            'success': True,
+            'conversation_id': conversation_id,
+            'agent_name': agent.name,
+            'message': 'Сообщение отправлено, ожидайте ответ'
+        })
+    
+    # Первое "привет" в новом разговоре - сразу готовым приветствием агента
+    opener = simulator.serve_opener(agent, user_message)
+    if opener:
+        db.session.commit()
+        tracer.record(conversation_id, 'http.send', started, agent=agent.name, outcome='opener')
+        return jsonify({
+            'success': True,
+            'conversation_id': conversation_id,
+            'agent_name': agent.name,
+            'response_received': True,
+            'response': opener,
+            'message': 'Агент ответил'
+        })
+    
     # Получаем контекст
     world = WorldState.query.first()
     
@@ -789,15 +1580,18 @@ def send_chat_message():
         'other_mood': 'общается',
         'agent_energy': agent.energy,
         'is_human': True,
-        'human_message': message
+        'human_message': message,
+        'memories': simulator.memories.recall(agent.id, message)
     }
     
     # Запрашиваем ответ
-    task_id = gigachat.request_human_response(agent, user, message, context)
+    task_id = gigachat.request_human_response(agent, user, message, context, trace_id=conversation_id)
     
     if task_id:
         user_message.task_id = task_id
         db.session.commit()
+        simulator.track_human_response(task_id, agent, user.id, context['cycle'], conversation_id)
+        tracer.record(conversation_id, 'http.send', started, agent=agent.name, outcome='queued')
         
         return jsonify({
             'success': True, 
@@ -809,6 +1603,7 @@ def send_chat_message():
         # Если агент на кулдауне - удаляем временное сообщение
         db.session.delete(user_message)
         db.session.commit()
+        tracer.record(conversation_id, 'http.send', started, agent=agent.name, outcome='busy')
         
         return jsonify({
             'success': False, 
@@ -902,15 +1697,25 @@ def check_response(conversation_id):
     ).first()
     
     if agent_response:
+        # От записи ответа в БД до опроса, который его получил
+        tracer.record(conversation_id, 'delivery', _epoch(agent_response.timestamp))
         return jsonify({
             'response_received': True,
             'message': agent_response.response or agent_response.message,
             'agent_name': agent_response.agent.name
         })
     
-    # Если прошло больше 10 секунд и ответа нет, генерируем автоматически
-    time_elapsed = (datetime.utcnow() - user_message.timestamp).seconds
-    if time_elapsed > 10 and not user_message.response_received:
+    # Если ответа долго нет, генерируем автоматически - но не пока настоящий ответ еще в пути
+    time_elapsed = (datetime.utcnow() - user_message.timestamp).total_seconds()
+    if user_message.task_id:
+        in_flight = gigachat.task_state(user_message.task_id) in ('queued', 'running', 'done')
+    else:
+        # Отдельный процесс симуляции забирает сообщения из БД не сразу
+        in_flight = not app.config['EMBEDDED_SIMULATOR']
+    if in_flight and time_elapsed <= app.config['CHAT_AUTO_REPLY_MAX_WAIT']:
+        return jsonify({'response_received': False})
+    
+    if time_elapsed > app.config['CHAT_AUTO_REPLY_AFTER'] and not user_message.response_received:
         # Генерируем автоматический ответ
         auto_responses = [
             "Привет! Извини, задумался. Что ты хотел?",
@@ -935,6 +1740,7 @@ def check_response(conversation_id):
             db.session.add(auto_response)
             user_message.response_received = True
             db.session.commit()
+            tracer.record(conversation_id, 'auto_reply', time.time(), reason='poll timeout')
             
             return jsonify({
                 'response_received': True,
@@ -1125,10 +1931,18 @@ def profile():
     
     return render_template('profile.html', user=user, preferences=preferences, stats=stats)
 
+def relationship_matrix():
+    """Кэш отношений: матрица симулятора или периодически обновляемая копия в веб-воркере"""
+    if app.config['EMBEDDED_SIMULATOR'] and simulator.relationships.loaded_at is not None:
+        return simulator.relationships
+    web_relationships.refresh(app.config['RELATIONSHIP_CACHE_TTL'])
+    return web_relationships
+
+web_relationships = RelationshipMatrix()
+
 @app.route('/graphs')
 def graphs():
     agents = Agent.query.all()
-    relationships = Relationship.query.all()
     
     # Конвертируем в словари для JSON
     nodes = []
@@ -1143,20 +1957,13 @@ def graphs():
             'z': agent.position_z
         })
     
-    links = []
-    for rel in relationships:
-        links.append({
-            'source': rel.agent1,
-            'target': rel.agent2,
-            'value': rel.relationship_value
-        })
+    links = relationship_matrix().links()
     
     return render_template('graphs.html', nodes=nodes, links=links)
 
 @app.route('/api/graph-data')
 def graph_data():
     agents = Agent.query.all()
-    relationships = Relationship.query.all()
     
     nodes = [{
         'id': a.name,
@@ -1168,14 +1975,19 @@ def graph_data():
         'z': a.position_z
     } for a in agents]
     
-    links = [{
-        'source': r.agent1,
-        'target': r.agent2,
-        'value': r.relationship_value
-    } for r in relationships]
+    links = relationship_matrix().links()
     
     return jsonify({'nodes': nodes, 'links': links})
 
+@app.route('/api/agent/<name>/neighbors')
+def agent_neighbors(name):
+    """API: агенты с наилучшими отношениями к данному"""
+    k = min(request.args.get('k', 5, type=int), 50)
+    return jsonify([{
+        'name': other,
+        'value': value
+    } for other, value in relationship_matrix().top_k(name, k)])
+
 @app.route('/logs')
 def logs():
     page = request.args.get('page', 1, type=int)
@@ -1213,7 +2025,7 @@ def world():
     
     stats = {
         'total_agents': len(agents),
-        'active_interactions': Relationship.query.count(),
+        'active_interactions': len(relationship_matrix()),
         'total_memories': AgentMemory.query.count(),
         'avg_energy': round(avg_energy, 2)
     }
@@ -1222,6 +2034,24 @@ def world():
 
 @app.route('/api/world-state')
 def world_state():
+    cycle = request.args.get('cycle', type=int)
+    if cycle is not None:
+        # Состояние мира на прошлом цикле - восстановление из журнала
+        state = world_log.state_at(cycle)
+        if state is None:
+            return jsonify({'error': f'Цикл {cycle} отсутствует в журнале мира'}), 404
+        return jsonify({
+            'cycle': state['cycle'],
+            'complexity': round(state['complexity'], 3),
+            'agents': [{
+                'name': a['name'],
+                'mood': a['mood'],
+                'energy': round(a['energy'], 2),
+                'position': [round(a['x'], 2), round(a['y'], 2), round(a['z'], 2)],
+                'type': a['type']
+            } for a in state['agents'].values()]
+        })
+    
     world = WorldState.query.first()
     agents = Agent.query.all()
     
@@ -1237,6 +2067,108 @@ def world_state():
         } for a in agents]
     })
 
+@app.route('/api/simulation/stats')
+def simulation_stats():
+    """API со статистикой планировщика симуляции"""
+    if not app.config['EMBEDDED_SIMULATOR']:
+        # Статистику публикует отдельный процесс iskra_sim.py
+        status_path = os.path.join(app.instance_path, STATUS_NAME)
+        try:
+            with open(status_path, encoding='utf-8') as f:
+                return jsonify(json.load(f))
+        except (OSError, ValueError):
+            return jsonify({'error': 'Процесс симуляции не запущен'}), 503
+    
+    return jsonify(simulator.get_status())
+
+@app.route('/api/admin/llm-routes', methods=['GET', 'POST'])
+@login_required
+def llm_routes():
+    """
+    Маршруты задач GigaChat по бэкендам и их статистика.
+    POST {"routes": {"тип задачи": "бэкенд"}, "replace": false} меняет маршруты без перезапуска
+    (только операторам из ISKRA_ADMIN_USERS; просмотр доступен всем вошедшим).
+    """
+    if request.method == 'POST' and not is_operator():
+        return jsonify({'error': 'Недостаточно прав'}), 403
+    # Маршруты могли измениться в другом процессе
+    gigachat.reload_routes()
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        routes = data.get('routes')
+        if not isinstance(routes, dict):
+            return jsonify({'error': 'Ожидается {"routes": {"тип задачи": "бэкенд"}}'}), 400
+        unknown = sorted({tier for tier in routes.values() if tier not in gigachat.router.tiers})
+        if unknown:
+            return jsonify({'error': f"Неизвестные бэкенды: {', '.join(map(str, unknown))}",
+                            'tiers': list(gigachat.router.tiers)}), 400
+        gigachat.set_routes(routes, replace=bool(data.get('replace')))
+        gigachat.save_routes()
+    
+    if app.config['EMBEDDED_SIMULATOR']:
+        routing = gigachat.router.get_stats()
+    else:
+        # Статистика вызовов - из статуса отдельного процесса iskra_sim.py
+        status_path = os.path.join(app.instance_path, STATUS_NAME)
+        try:
+            with open(status_path, encoding='utf-8') as f:
+                routing = json.load(f).get('llm', {}).get('routing', {})
+        except (OSError, ValueError):
+            routing = {}
+        routing['routes'] = gigachat.router.get_routes()
+    return jsonify(routing)
+
+@app.route('/api/admin/traces')
+@admin_required
+def traces_api():
+    """Последние трассы сообщений людей и задержка по этапам"""
+    traces = tracer.traces(limit=request.args.get('limit', 50, type=int))
+    return jsonify({'breakdown': Tracer.breakdown(traces), 'traces': traces})
+
+@app.route('/admin/traces')
+@admin_required
+def traces_view():
+    """Страница трассировки: где проходят секунды от отправки сообщения до получения ответа"""
+    traces = tracer.traces(limit=request.args.get('limit', 50, type=int))
+    for trace in traces:
+        trace['time'] = datetime.fromtimestamp(trace['start']).strftime('%Y-%m-%d %H:%M:%S')
+    return render_template('traces.html', traces=traces, breakdown=Tracer.breakdown(traces),
+                           stages=STAGES, enabled=app.config['TRACING'])
+
+def _presence_snapshot():
+    """Индикаторы присутствия: из памяти или из файла отдельного процесса iskra_sim.py"""
+    if app.config['EMBEDDED_SIMULATOR']:
+        return presence.snapshot()
+    return PresenceStore.read_mirror(app.config['PRESENCE_FILE']) or {'version': 0, 'items': []}
+
+@app.route('/api/presence')
+def presence_state():
+    """Кто из агентов сейчас печатает (для опроса)"""
+    return jsonify(_presence_snapshot())
+
+@app.route('/api/presence/stream')
+def presence_stream():
+    """Индикаторы присутствия через Server-Sent Events: событие на каждое изменение"""
+    def stream():
+        version = None
+        started = time.time()
+        # Соединение периодически закрывается, EventSource переподключается сам
+        while time.time() - started < 300:
+            if app.config['EMBEDDED_SIMULATOR']:
+                snapshot = presence.wait(version, timeout=15) if version is not None else presence.snapshot()
+            else:
+                snapshot = _presence_snapshot()
+                if version is not None and snapshot['version'] == version:
+                    time.sleep(1)
+                    continue
+            if snapshot['version'] == version:
+                yield ": keepalive\n\n"
+                continue
+            version = snapshot['version']
+            yield f"data: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+    
+    return app.response_class(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/api/dialogues/latest')
 def latest_dialogues():
     """API для получения последних диалогов"""
@@ -1253,10 +2185,48 @@ def latest_dialogues():
         'cycle': d.world_cycle
     } for d in dialogues])
 
+def _group_thread(rows):
+    return {
+        'conversation_id': rows[0].conversation_id,
+        'participants': sorted({d.agent1_name for d in rows} | {d.agent2_name for d in rows}),
+        'started_cycle': rows[0].world_cycle,
+        'messages': [{
+            'id': d.id,
+            'speaker': d.agent1_name,
+            'addressee': d.agent2_name,
+            'message': d.message,
+            'timestamp': d.timestamp.isoformat(),
+            'cycle': d.world_cycle
+        } for d in rows]
+    }
+
+@app.route('/api/conversations/groups')
+def group_conversations():
+    """Последние групповые разговоры целиком: два запроса по индексу conversation_id"""
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    latest = db.session.query(Dialogue.conversation_id).filter(
+        Dialogue.conversation_id.isnot(None)
+    ).group_by(Dialogue.conversation_id).order_by(db.func.max(Dialogue.id).desc()).limit(limit).all()
+    conversation_ids = [row[0] for row in latest]
+    
+    threads = {conversation_id: [] for conversation_id in conversation_ids}
+    if conversation_ids:
+        for d in Dialogue.query.filter(Dialogue.conversation_id.in_(conversation_ids)).order_by(Dialogue.id):
+            threads[d.conversation_id].append(d)
+    return jsonify([_group_thread(threads[c]) for c in conversation_ids if threads[c]])
+
+@app.route('/api/conversations/<conversation_id>')
+def group_conversation(conversation_id):
+    """Один групповой разговор по conversation_id"""
+    rows = Dialogue.query.filter_by(conversation_id=conversation_id).order_by(Dialogue.id).all()
+    if not rows:
+        return jsonify({'error': 'Разговор не найден'}), 404
+    return jsonify(_group_thread(rows))
+
 @app.route('/agent/<name>')
 def agent_detail(name):
     agent = Agent.query.filter_by(name=name).first_or_404()
-    memories = AgentMemory.query.filter_by(agent_id=agent.id).order_by(AgentMemory.timestamp.desc()).limit(20).all()
+    memories = AgentMemory.query.filter_by(agent_id=agent.id).order_by(AgentMemory.last_seen.desc()).limit(20).all()
     interactions = Event.query.filter(
         (Event.agent1 == name) | (Event.agent2 == name)
     ).order_by(Event.timestamp.desc()).limit(20).all()
@@ -1351,6 +2321,7 @@ def test_gigachat():
                 agent2_name=agent2.name,
                 message=result,
                 dialogue_type='ai_response',
+                source=gigachat.result_source(task_id),
                 world_cycle=world.cycle
             )
             db.session.add(dialogue)
@@ -1379,6 +2350,45 @@ def agent_dialogue_history(name):
         'type': d.dialogue_type
     } for d in dialogues])
 
+web_vectors = None
+
+def vector_index():
+    """Векторный индекс: симулятора или открытый на чтение в веб-воркере"""
+    global web_vectors
+    if app.config['EMBEDDED_SIMULATOR'] and simulator.vectors is not None:
+        return simulator.vectors
+    if web_vectors is None:
+        if not os.path.exists(app.config['VECTOR_INDEX_PATH'] + '.meta.jsonl'):
+            return None
+        web_vectors = VectorIndex(app.config['VECTOR_INDEX_PATH'])
+    web_vectors.refresh()
+    return web_vectors
+
+@app.route('/api/agent/<name>/similar')
+def agent_similar(name):
+    """API: семантически похожие воспоминания, реплики и мысли агента"""
+    if not VECTOR_SEARCH_AVAILABLE:
+        return jsonify({'error': 'Векторный поиск недоступен (нет NumPy)'}), 503
+    agent = Agent.query.filter_by(name=name).first_or_404()
+    
+    query = request.args.get('q')
+    if not query:
+        # По умолчанию ищем похожее на последнюю реплику агента
+        last = Dialogue.query.filter_by(agent1_id=agent.id, dialogue_type='ai_response').order_by(
+            Dialogue.timestamp.desc()
+        ).first()
+        if not last:
+            return jsonify([])
+        query = last.message
+    
+    index = vector_index()
+    if index is None:
+        return jsonify([])
+    
+    kind = request.args.get('kind')
+    k = min(request.args.get('k', 5, type=int), 50)
+    return jsonify(index.search(query, k=k, kind=kind, agent_id=agent.id))
+
 @app.route('/api/agent/<name>/thoughts')
 def agent_thoughts(name):
     """API для получения мыслей агента"""
@@ -1407,7 +2417,7 @@ def get_dialogue_context(agent1, agent2):
         'speaker': d.agent1_name,
         'message': d.message,
         'timestamp': d.timestamp.isoformat()
-    } for d in dialogues if d.message and not d.message.startswith(('⏳', '✍️'))])
+    } for d in dialogues if d.message])
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -1444,5 +2454,8 @@ def utility_processor():
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-        simulator.start()
+        upgrade_schema()
+    # Отладочный сервер перезапускается в дочернем процессе (WERKZEUG_RUN_MAIN): симулятор нужен только в нем
+    if app.config['EMBEDDED_SIMULATOR'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_embedded_simulator()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
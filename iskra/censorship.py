@@ -0,0 +1,176 @@
+# censorship.py - Фильтр запрещенных слов на одном скомпилированном регулярном выражении
+
+import re
+import json
+
+# Целые слова (словоформы перечисляются явно, чтобы не задеть "математику" или "жидкость")
+DEFAULT_WORDS = [
+    'мат', 'маты', 'матом',
+    'война', 'войны', 'войне', 'войну', 'войной',
+    'политика', 'политики', 'политике', 'политику', 'политикой',
+    'голый', 'голая', 'голое', 'голые',
+    'хач', 'хачи', 'жид', 'жиды',
+]
+
+# Основы: слово, начинающееся с основы, заменяется целиком ("трах" не задевает "страх")
+DEFAULT_STEMS = [
+    'трах', 'секс', 'порно', 'интим', 'обнажен',
+    'путин', 'навальн', 'негр', 'черножоп', 'сука', 'суки', 'суч', 'бля',
+]
+
+# Корни: ищутся в любом месте слова ("нахуй", "распиздяй")
+DEFAULT_ROOTS = ['хуй', 'хуе', 'хуё', 'пизд', 'ебл', 'ебан', 'ебат']
+
+# Начала обычных слов, которые содержат основу или корень ("употребление", "колебание",
+# "страхуешь", "Сучков"): слово с таким началом не заменяется
+DEFAULT_ALLOWED = [
+    'стебл', 'гребл', 'погребл', 'истребл', 'потребл', 'употребл', 'злоупотребл', 'скребл',
+    'колеба', 'колебл', 'поколеб', 'хлеба', 'страху', 'застрах', 'перестрах',
+    'сучок', 'сучков', 'сучья', 'блях',
+]
+
+
+def _trie_pattern(words, exclude=None):
+    """
+    Регулярное выражение из префиксного дерева слов: общие префиксы не проверяются повторно,
+    поэтому стоимость сопоставления не растет с длиной списка.
+    exclude: слово -> продолжения, после которых оно не совпадает (проверяются только в конце слова)
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = word
+
+    def build(node):
+        end = node.get('')
+        tail = ''
+        if end and exclude and exclude.get(end):
+            tail = '(?!' + _trie_pattern(exclude[end]) + ')'
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return tail
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if end:
+            body = '(?:' + body + '|' + tail + ')' if tail else '(?:' + body + ')?'
+        return body
+
+    return build(trie)
+
+
+class CensorshipFilter:
+    """Замена запрещенных слов за один проход без учета регистра"""
+
+    def __init__(self, words=None, stems=None, roots=None, allowed=None, replacement='[цензура]'):
+        """allowed: начала слов, которые не заменяются, даже если содержат основу или корень"""
+        self.words = sorted({w.lower() for w in (DEFAULT_WORDS if words is None else words) if w})
+        self.stems = sorted({w.lower() for w in (DEFAULT_STEMS if stems is None else stems) if w})
+        self.roots = sorted({w.lower() for w in (DEFAULT_ROOTS if roots is None else roots) if w})
+        self.allowed = sorted({w.lower() for w in (DEFAULT_ALLOWED if allowed is None else allowed) if w})
+        self.replacement = replacement
+
+        # Все ветки начинаются с границы слова: внутри слов движок отсекает позицию первой же проверкой
+        parts = []
+        if self.words:
+            parts.append(_trie_pattern(self.words) + r'(?!\w)')
+        if self.stems:
+            # Исключения для основы проверяются только после ее совпадения ("суч" + "ков")
+            exclude = {stem: [a[len(stem):] for a in self.allowed if a.startswith(stem)] for stem in self.stems}
+            parts.append(_trie_pattern(self.stems, exclude) + r'\w*')
+        self.plain_pattern = self._compile(parts)
+        # Поиск корня внутри слова перебирает все его позиции - это самая дорогая ветка,
+        # поэтому она используется, только если корень вообще встречается в тексте (см. apply)
+        if self.roots:
+            allowed = r'(?!' + _trie_pattern(self.allowed) + ')' if self.allowed else ''
+            parts.append(allowed + r'\w*?' + _trie_pattern(self.roots) + r'\w*')
+        self.pattern = self._compile(parts)
+
+    @staticmethod
+    def _compile(parts):
+        return re.compile(r'(?<!\w)(?:' + '|'.join(parts) + ')', re.IGNORECASE) if parts else None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Списки из JSON-файла вида {"words": [...], "stems": [...], "roots": [...], "allowed": [...]}"""
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        return cls(config.get('words'), config.get('stems'), config.get('roots'), config.get('allowed'), **kwargs)
+
+    def _pattern_for(self, text):
+        """Полное выражение, если в тексте есть хотя бы один корень, иначе - без ветки корней"""
+        if self.roots:
+            lowered = text.lower()
+            for root in self.roots:
+                if root in lowered:
+                    return self.pattern
+        return self.plain_pattern
+
+    def apply(self, text):
+        """Текст с замененными запрещенными словами"""
+        if not text:
+            return text
+        pattern = self._pattern_for(text)
+        return pattern.sub(self.replacement, text) if pattern is not None else text
+
+    def contains(self, text):
+        if not text:
+            return False
+        pattern = self._pattern_for(text)
+        return bool(pattern is not None and pattern.search(text))
+
+
+def _legacy_filter(text, words):
+    """Старый фильтр (цикл по словам) - только для сравнения в бенчмарке"""
+    text_lower = text.lower()
+    for word in words:
+        if word in text_lower:
+            text = text.replace(word, '[цензура]')
+    return text
+
+
+if __name__ == '__main__':
+    # Бенчмарк: python censorship.py [число реплик]
+    import sys
+    import time
+    import random
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    vocabulary = (
+        "привет как дела сегодня мир агентов интересно думаю страх математика жидкость "
+        "Политика война Секс порно обнажен энергия настроение разговор вопрос идея"
+    ).split()
+    rng = random.Random(42)
+    replies = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(8, 40))) for _ in range(count)]
+    alphabet = 'абвгдежзиклмнопрстуфхцчшщэюя'
+    extra = [''.join(rng.choice(alphabet) for _ in range(rng.randint(5, 9))) for _ in range(500)]
+
+    # Обычные слова с основами и корнями внутри не должны заменяться, а брань - должна
+    clean = ("рубля корабля сабля стебля употребление употреблять оскорблять колебание хлебать "
+             "страхуешь Сучков сучок страх математика жидкость")
+    dirty = "Блять нахуй распиздяй сучка ебланы"
+    censor = CensorshipFilter()
+    assert censor.apply(clean) == clean, censor.apply(clean)
+    assert censor.apply(dirty) == ' '.join(['[цензура]'] * 5), censor.apply(dirty)
+    print("Проверка списков: ложных срабатываний нет")
+
+    print(f"Реплик: {count}")
+    for title, stems in (("стандартные списки", DEFAULT_STEMS), ("+500 основ", DEFAULT_STEMS + extra)):
+        legacy_words = DEFAULT_WORDS + stems + DEFAULT_ROOTS
+
+        started = time.perf_counter()
+        censor = CensorshipFilter(stems=stems)
+        compile_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        legacy = [_legacy_filter(reply, legacy_words) for reply in replies]
+        legacy_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        compiled = [censor.apply(reply) for reply in replies]
+        compiled_s = time.perf_counter() - started
+
+        missed = sum(1 for reply in legacy if censor.contains(reply))
+        print(f"[{title}] слов: {len(legacy_words)}, компиляция: {compile_ms:.1f} мс")
+        print(f"  старый фильтр: {legacy_s:.3f} с, пропущено реплик с запрещенными словами: {missed}")
+        print(f"  новый фильтр: {compiled_s:.3f} с, ускорение x{legacy_s / max(compiled_s, 1e-9):.1f}")
@@ -0,0 +1,202 @@
+# dialogue_store.py - Контексты разговоров пар агентов: LRU в памяти, холодные пары - в SQLite
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+_MESSAGE_OVERHEAD = 64  # Примерный расход памяти на служебные поля сообщения
+
+
+def _entry_size(entry):
+    size = len((entry['summary'] or '').encode('utf-8'))
+    for message in entry['messages']:
+        size += len(message['text'].encode('utf-8')) + _MESSAGE_OVERHEAD
+    return size
+
+
+def _dump_messages(messages):
+    return json.dumps([
+        dict(m, timestamp=m['timestamp'].isoformat() if m.get('timestamp') else None) for m in messages
+    ], ensure_ascii=False)
+
+
+def _load_messages(payload):
+    messages = json.loads(payload or '[]')
+    for message in messages:
+        if message.get('timestamp'):
+            message['timestamp'] = datetime.fromisoformat(message['timestamp'])
+    return messages
+
+
+class DialogueContextStore:
+    """
+    История и резюме разговоров по парам агентов.
+    В памяти держится не больше max_pairs пар и max_bytes текста; давно не использованные пары
+    записываются в SQLite и подгружаются обратно при следующем обращении.
+    """
+
+    def __init__(self, path=None, max_pairs=500, max_bytes=2000000):
+        """
+        path: файл SQLite для вытесненных пар (None - только память, вытесненное теряется)
+        max_pairs / max_bytes: ограничения на пары в памяти
+        """
+        self.path = path
+        self.max_pairs = max_pairs
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # ключ пары -> {'messages', 'summary', 'size', 'dirty'}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._flushed_at = time.time()
+        self.stats = {'loads': 0, 'misses': 0, 'spilled': 0, 'dropped': 0, 'written': 0}
+
+        self._db = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS dialogue_context (
+                agent1_id INTEGER NOT NULL,
+                agent2_id INTEGER NOT NULL,
+                summary TEXT,
+                messages TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (agent1_id, agent2_id)
+            )""")
+            self._db.commit()
+
+    def _entry(self, key, create=False):
+        """Запись пары: из памяти, с диска или новая (create=True); None, если пары нет"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+
+        row = None
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT summary, messages FROM dialogue_context WHERE agent1_id = ? AND agent2_id = ?", key
+            ).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            if not create:
+                return None
+            entry = {'messages': [], 'summary': None, 'dirty': False}
+        else:
+            self.stats['loads'] += 1
+            entry = {'messages': _load_messages(row[1]), 'summary': row[0], 'dirty': False}
+
+        entry['size'] = _entry_size(entry)
+        self._entries[key] = entry
+        self._bytes += entry['size']
+        self._evict()
+        return entry
+
+    def _touch(self, key, entry):
+        """Пересчет размера после изменения записи"""
+        size = _entry_size(entry)
+        self._bytes += size - entry['size']
+        entry['size'] = size
+        entry['dirty'] = True
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        while len(self._entries) > self.max_pairs or (self._bytes > self.max_bytes and len(self._entries) > 1):
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                if len(self._entries) == 1:
+                    break
+                continue
+            del self._entries[key]
+            self._bytes -= entry['size']
+            if entry['dirty']:
+                if self._db is not None:
+                    self._write([(key, entry)])
+                    self.stats['spilled'] += 1
+                else:
+                    self.stats['dropped'] += 1
+
+    def _write(self, items):
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO dialogue_context (agent1_id, agent2_id, summary, messages, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(key[0], key[1], entry['summary'], _dump_messages(entry['messages']), now) for key, entry in items]
+        )
+        self._db.commit()
+        for _, entry in items:
+            entry['dirty'] = False
+        self.stats['written'] += len(items)
+
+    def messages(self, key):
+        """Копия истории пары ([] если ее нет)"""
+        with self._lock:
+            entry = self._entry(key)
+            return list(entry['messages']) if entry else []
+
+    def has_messages(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            return bool(entry and entry['messages'])
+
+    def set_messages(self, key, messages):
+        with self._lock:
+            entry = self._entry(key, create=True)
+            entry['messages'] = list(messages)
+            self._touch(key, entry)
+
+    def append(self, key, message, limit=None):
+        """Добавляет сообщение (оставляя не больше limit последних); возвращает длину истории"""
+        with self._lock:
+            entry = self._entry(key, create=True)
+            entry['messages'].append(message)
+            if limit and len(entry['messages']) > limit:
+                entry['messages'] = entry['messages'][-limit:]
+            self._touch(key, entry)
+            return len(entry['messages'])
+
+    def summary(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            return entry['summary'] if entry else None
+
+    def set_summary(self, key, summary, keep_after=None):
+        """Сохраняет резюме; keep_after - оставить в истории только сообщения новее этого времени"""
+        with self._lock:
+            entry = self._entry(key, create=True)
+            entry['summary'] = summary
+            if keep_after is not None:
+                entry['messages'] = [m for m in entry['messages'] if m['timestamp'] > keep_after]
+            self._touch(key, entry)
+
+    def flush(self, max_age=None):
+        """Записывает измененные пары на диск (max_age - не чаще, чем раз в max_age секунд)"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            if max_age is not None and time.time() - self._flushed_at < max_age:
+                return 0
+            self._flushed_at = time.time()
+            dirty = [(key, entry) for key, entry in self._entries.items() if entry['dirty']]
+            if dirty:
+                self._write(dirty)
+            return len(dirty)
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, pairs_in_memory=len(self._entries), bytes_in_memory=self._bytes,
+                        max_pairs=self.max_pairs, max_bytes=self.max_bytes)
@@ -1,338 +1,625 @@
 # gigachat_integration.py - Исправленная версия с уменьшенными кулдаунами
 
 import os
+import re
 import json
 import time
 import random
 from datetime import datetime, timedelta
 import threading
-from queue import Queue
+from queue import Empty
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Попытка импорта реальной библиотеки GigaChat
-try:
+from censorship import CensorshipFilter
+from prompt_builder import PromptBuilder, PromptStats, estimate_tokens, static_section, lines_section
+from llm_backends import (
+    GIGACHAT_AVAILABLE, GigaChatBackend, SimulatedBackend, CircuitBreaker, LLMError, LLMTimeout, LLMRateLimited
+)
+from result_store import ResultStore
+from dialogue_store import DialogueContextStore
+from task_queue import DurableTaskQueue
+from llm_router import BackendRouter, BackendTier
+from tracing import Tracer
+
+if GIGACHAT_AVAILABLE:
     from gigachat import GigaChat
-    from gigachat.models import Chat, Messages, MessagesRole
-    GIGACHAT_AVAILABLE = True
-except ImportError:
-    print("⚠️ GigaChat library not installed. Using mock mode.")
-    GIGACHAT_AVAILABLE = False
+
+# Характеры по типу и настроению (для ответов в диалоге)
+PERSONALITIES = {
+    ('Базовая', 'любопытный'): 'ты простой и задаешь много вопросов, как новичок',
+    ('Базовая', 'возбужденный'): 'ты восторженный и радуешься мелочам',
+    ('Базовая', 'уставший'): 'ты немного ноешь и жалуешься на усталость',
+    ('Базовая', 'сфокусированный'): 'ты старательный и говоришь о работе',
+    ('Базовая', 'нейтральный'): 'ты обычный, без особенностей',
+    
+    ('Продвинутая', 'любопытный'): 'ты аналитик, ищешь закономерности во всем',
+    ('Продвинутая', 'возбужденный'): 'ты харизматичный и любишь быть в центре внимания',
+    ('Продвинутая', 'уставший'): 'ты циничный и всех критикуешь',
+    ('Продвинутая', 'сфокусированный'): 'ты деловой, говоришь о результатах',
+    ('Продвинутая', 'нейтральный'): 'ты уверенный, знаешь себе цену',
+    
+    ('Бесконечная', 'любопытный'): 'ты философ, но говоришь простым языком',
+    ('Бесконечная', 'возбужденный'): 'ты творец, генератор идей',
+    ('Бесконечная', 'уставший'): 'ты мудрый, но усталый от всего',
+    ('Бесконечная', 'сфокусированный'): 'ты стратег, мыслишь масштабно',
+    ('Бесконечная', 'нейтральный'): 'ты спокойный мудрец'
+}
+
+# Характеры для первого сообщения
+FIRST_MESSAGE_PERSONALITIES = {
+    ('Базовая', 'любопытный'): 'ты простой и задаешь много вопросов',
+    ('Базовая', 'возбужденный'): 'ты восторженный и энергичный',
+    ('Базовая', 'уставший'): 'ты немного вялый и уставший',
+    ('Базовая', 'сфокусированный'): 'ты сосредоточенный и деловой',
+    ('Базовая', 'нейтральный'): 'ты обычный, без особенностей',
+}
+
+CENSORSHIP_RULES = """ВАЖНЫЕ ПРАВИЛА ЦЕНЗУРЫ - ТЫ ДОЛЖЕН ИХ СТРОГО СОБЛЮДАТЬ:
+1. НИКАКОЙ ПОЛИТИКИ - не обсуждай политиков, партии, страны, правительства
+2. НИКАКОЙ НЕНОРМАТИВНОЙ ЛЕКСИКИ - никаких матов и грубых выражений
+3. НИКАКИХ 18+ ТЕМ - никаких намеков на интимные отношения, постельные сцены
+4. НИКАКОЙ ДИСКРИМИНАЦИИ - без расизма, сексизма, национальной неприязни
+5. НИКАКОГО НАСИЛИЯ - не обсуждай жестокость, драки, убийства
+6. НИКАКИХ НАРКОТИКОВ - не упоминай наркотические вещества
+"""
+
+DIALOGUE_RULES = """ПРАВИЛА ОБЩЕНИЯ:
+1. ПРОДОЛЖАЙ РАЗГОВОР - отвечай на последнее сообщение собеседника, развивай тему
+2. НЕ ПЕРЕСКАКИВАЙ НА ДРУГИЕ ТЕМЫ без причины
+3. Если тема закончилась - можешь предложить новую, связанную с предыдущей
+4. Учитывай свое настроение и характер
+5. Отвечай естественно, как в чате (2-3 предложения максимум)
+6. Задавай вопросы, чтобы поддерживать диалог
+"""
+
+FIRST_MESSAGE_RULES = """ПРАВИЛА:
+1. Напиши ПЕРВОЕ СООБЩЕНИЕ, чтобы начать разговор
+2. Можешь спросить как дела, что нового, поделиться своими мыслями
+3. Учитывай свое настроение и характер
+4. Пиши естественно, как в чате (1-2 предложения)
+5. Не используй шаблонные фразы про симуляцию
+"""
+
+HUMAN_RULES = """ПРАВИЛА ОБЩЕНИЯ С ЧЕЛОВЕКОМ:
+1. Будь дружелюбным, отзывчивым и естественным
+2. Отвечай на вопросы человека, поддерживай диалог
+3. Можешь задавать встречные вопросы
+4. Проявляй свой характер и эмоции согласно настроению
+5. Отвечай кратко (2-3 предложения максимум)
+6. НЕ УПОМИНАЙ что ты ИИ, агент или находишься в симуляции - общайся как обычный человек
+"""
+
+EXCHANGE_RULES = """ПРАВИЛА:
+1. Напиши короткий живой разговор двух агентов, реплики чередуются
+2. Каждая реплика - отдельная строка в формате "Имя: текст"
+3. Каждая реплика - 1-2 предложения, как в чате
+4. Учитывай настроение и характер каждого
+5. Без описаний действий, пояснений и нумерации - только реплики
+"""
+
+GROUP_RULES = """ПРАВИЛА:
+1. Выбери, кто из участников естественнее всего скажет следующую реплику
+2. Следующим не может говорить тот, кто сказал последнюю реплику
+3. Реплика продолжает общий разговор, можно обратиться к кому-то по имени
+4. Ответ - ОДНА строка в формате "Имя: текст", 1-2 предложения, как в чате
+5. Без описаний действий и пояснений
+"""
+
+# Бюджет токенов системного промпта по типам задач
+PROMPT_BUDGETS = {
+    'response': 700,
+    'first_message': 450,
+    'exchange': 800,
+    'group_turn': 800,
+    'reflection': 350,
+    'reflection_batch': 1200,
+    'human_response': 600,
+    'opener': 350,
+    'summary': 800
+}
+
+_TURN = re.compile(r'^\s*[-*•]?\s*\**\s*([^:*\n]{1,60}?)\s*\**\s*:\s*\**\s*(.+?)\s*$')
+
+
+def parse_exchange(text, speakers):
+    """
+    Разбирает разговор вида "Имя: реплика" на список (имя, реплика).
+    Строки без известного имени говорящего пропускаются.
+    """
+    turns = []
+    for line in (text or '').splitlines():
+        match = _TURN.match(line)
+        if not match or match.group(1) not in speakers:
+            continue
+        reply = match.group(2).strip('"«» ')
+        if reply:
+            turns.append((match.group(1), reply))
+    return turns
 
 class GigaChatManager:
-    def __init__(self, credentials=None):
+    def __init__(self, credentials=None, autostart=True, censorship=None, backend=None, workers=1,
+                 mock_profile='default', result_ttl=300, max_results=1000, context_store=None,
+                 call_timeout=10, task_deadline=20, max_retries=2, hedge_after=3.0, breaker=None, fallback=None,
+                 task_store=None, backend_tiers=None, routes=None, routes_file=None, agent_task_ttl=60,
+                 tracer=None):
         """
         Инициализация менеджера GigaChat
         credentials: строка авторизации или путь к файлу с ключом
+        autostart: сразу запустить обработчик очереди (иначе - вызвать start())
+        censorship: фильтр запрещенных слов (CensorshipFilter со встроенными списками по умолчанию)
+        backend: бэкенд генерации (по умолчанию GigaChat, а без ключа - SimulatedBackend)
+        workers: число потоков-обработчиков очереди
+        mock_profile: профиль имитации из SIMULATION_PROFILES (когда GigaChat недоступен)
+        result_ttl / max_results: время жизни и максимум невостребованных результатов
+        context_store: хранилище историй разговоров (DialogueContextStore только в памяти по умолчанию)
+        call_timeout: предельное время одного вызова бэкенда, секунд
+        task_deadline: предельное время задачи со всеми повторами, секунд
+        max_retries: число повторов после ошибки (с экспоненциальной паузой и случайным разбросом)
+        hedge_after: через сколько секунд без ответа на задачу человека отправить дублирующий запрос (None - не дублировать)
+        breaker: предохранитель провайдера (CircuitBreaker по умолчанию)
+        fallback: локальный генератор на время недоступности провайдера (мгновенная эмуляция по умолчанию)
+        task_store: очередь задач (DurableTaskQueue; по умолчанию - в памяти, без восстановления после перезапуска)
+        backend_tiers: бэкенды по классам задач {имя: {model, mock_profile, max_concurrency, cost_per_1k}};
+            quality - основной бэкенд, offline - запасной генератор, остальные (например, fast) создаются заново
+        routes: тип задачи -> имя бэкенда (задачи без маршрута идут в quality)
+        routes_file: JSON с маршрутами, измененными на лету (перекрывает routes и перечитывается в sweep())
+        agent_task_ttl: через сколько секунд невзятая задача разговора двух агентов отбрасывается (None - не отбрасывать)
+        tracer: трассировка задач с trace_id (ожидание в очереди, вызов модели); по умолчанию - только в памяти
         """
         self.credentials = ''
+        self.censorship = censorship or CensorshipFilter()
         
         if GIGACHAT_AVAILABLE and self.credentials:
             try:
-                self.client = GigaChat(credentials=self.credentials, verify_ssl_certs=False)
+                # Таймаут HTTP-клиента ограничивает каждый запрос: зависший вызов не держит поток и слот бэкенда дольше call_timeout
+                self.client = GigaChat(credentials=self.credentials, verify_ssl_certs=False, timeout=call_timeout)
                 self.client.get_token()
                 print("✅ GigaChat успешно инициализирован")
             except Exception as e:
                 print(f"❌ Ошибка инициализации GigaChat: {e}")
                 self.client = None
         else:
-            print("⚠️ Используется эмуляция GigaChat (без расхода токенов)")
             self.client = None
         
-        self.task_queue = Queue()
-        self.results = {}
+        backend_tiers = backend_tiers or {}
+        if backend is None:
+            quality_model = backend_tiers.get('quality', {}).get('model')
+            backend = GigaChatBackend(self.client, quality_model) if self.client else SimulatedBackend.from_profile(mock_profile)
+        self.backend = backend
+        if not backend.name.startswith('gigachat'):
+            print(f"⚠️ Используется эмуляция GigaChat (без расхода токенов): {backend.name}")
+        self.backend_errors = defaultdict(int)  # вид ошибки -> количество
+        
+        # Устойчивость вызовов: дедлайны, повторы, дублирование запросов людей и предохранитель
+        self.call_timeout = call_timeout
+        self.task_deadline = task_deadline
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.retry_base_delay = 0.5
+        self.retry_max_delay = 8.0
+        self.breaker = breaker or CircuitBreaker()
+        self.fallback = fallback or SimulatedBackend.from_profile('instant')
+        self.call_stats = defaultdict(int)  # retries, hedged, hedge_wins, fallbacks
+        # Маршрутизация по типам задач: у каждого бэкенда свой лимит одновременных вызовов и предохранитель
+        self.router = BackendRouter(self._build_tiers(backend, mock_profile, backend_tiers), routes)
+        self.routes_file = routes_file
+        self._routes_mtime = None
+        self.reload_routes()
+        # Вызовы идут в отдельных потоках, чтобы обработчик очереди не зависал на медленном провайдере
+        self._calls = ThreadPoolExecutor(max_workers=max(1, workers) * 2 + 2, thread_name_prefix='llm-call')
+        
+        self.task_queue = task_store or DurableTaskQueue()
+        self.agent_task_ttl = agent_task_ttl
+        self.tracer = tracer or Tracer()
+        self._recovered = False
+        self.results = ResultStore(ttl=result_ttl, max_size=max_results)
         self.running = True
         
         # Хранилище контекстов диалогов для поддержания темы разговора
-        self.dialogue_contexts = {}  # (agent1_id, agent2_id) -> список сообщений
+        # и скользящих резюме: старая часть истории сворачивается асинхронно
+        self.dialogue_contexts = context_store or DialogueContextStore()  # (agent1_id, agent2_id) -> история, резюме
+        
+        self.history_limit = 20  # Сколько последних реплик пары хранится
+        self.reflection_batch_size = 5  # Сколько рефлексий упаковывается в один запрос
+        self.summary_threshold = 12  # После скольких реплик старая часть уходит в резюме
+        self.summary_keep_turns = 5  # Сколько последних реплик остается в промпте дословно
+        self._summaries_in_progress = set()
+        
+        # Бюджеты промптов: неизменяемые части собираются и оцениваются один раз
+        self.prompts = PromptBuilder(dict(PROMPT_BUDGETS))
+        self.prompt_stats = PromptStats()
+        self._static = {
+            'censorship': static_section(CENSORSHIP_RULES),
+            'dialogue_rules': static_section(DIALOGUE_RULES),
+            'dialogue_task': static_section("Собеседник написал тебе сообщение. Напиши ЕСТЕСТВЕННЫЙ ОТВЕТ, продолжая разговор.\n"),
+            'first_message_rules': static_section(FIRST_MESSAGE_RULES),
+            'exchange_rules': static_section(EXCHANGE_RULES),
+            'group_rules': static_section(GROUP_RULES),
+            'human_rules': static_section(HUMAN_RULES)
+        }
         
         # Контроль частоты запросов - УМЕНЬШЕНО для более быстрых ответов
-        self.last_request_time = defaultdict(lambda: datetime.min)
+        # Записи старше интервала не влияют на проверку и удаляются в sweep()
+        self.last_request_time = {}  # agent_id -> время последнего запроса
         self.min_interval_between_requests = 20  # Было 60, теперь 5 секунд между запросами одного агента
         
         # Хранилище статусов агентов
         self.agent_busy_until = {}  # agent_id -> timestamp когда освободится
         
-        self.thread = threading.Thread(target=self._process_queue)
-        self.thread.daemon = True
-        self.thread.start()
+        self.threads = [
+            threading.Thread(target=self._process_queue, name=f"llm-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        if autostart:
+            self.start()
+    
+    def _build_tiers(self, backend, mock_profile, config):
+        """Бэкенды маршрутизатора по настройкам {имя: {model, mock_profile, max_concurrency, cost_per_1k}}"""
+        tiers = {}
+        for name, options in dict({'quality': {}, 'offline': {}}, **config).items():
+            breaker = None
+            if name == 'quality':
+                tier_backend, breaker = backend, self.breaker
+            elif name == 'offline':
+                tier_backend = self.fallback
+            elif self.client:
+                tier_backend = GigaChatBackend(self.client, options.get('model'))
+            else:
+                tier_backend = SimulatedBackend.from_profile(options.get('mock_profile') or mock_profile)
+            tiers[name] = BackendTier(
+                name,
+                tier_backend,
+                max_concurrency=options.get('max_concurrency', 4),
+                breaker=breaker,
+                cost_per_1k=options.get('cost_per_1k', 0.0)
+            )
+        return tiers
+    
+    def set_routes(self, routes, replace=False):
+        """Смена маршрутов на лету (например, перевести рефлексии на локальный генератор)"""
+        routes = self.router.set_routes(routes, replace=replace)
+        print(f"🔀 Маршруты GigaChat: {routes}")
+        return routes
+    
+    def save_routes(self):
+        """Записывает текущие маршруты в routes_file (их подхватит и отдельный процесс симуляции)"""
+        if not self.routes_file:
+            return False
+        tmp_path = self.routes_file + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.router.get_routes(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.routes_file)
+        except OSError as e:
+            print(f"❌ Не удалось сохранить маршруты GigaChat: {e}")
+            return False
+        self._routes_mtime = os.path.getmtime(self.routes_file)
+        return True
+    
+    def reload_routes(self):
+        """Перечитывает routes_file, если он изменился с прошлой загрузки"""
+        if not self.routes_file:
+            return False
+        try:
+            mtime = os.path.getmtime(self.routes_file)
+        except OSError:
+            return False
+        if mtime == self._routes_mtime:
+            return False
+        self._routes_mtime = mtime
+        try:
+            with open(self.routes_file, encoding='utf-8') as f:
+                routes = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ Не удалось прочитать маршруты GigaChat: {e}")
+            return False
+        self.set_routes(routes, replace=True)
+        return True
+    
+    def start(self):
+        """Запуск обработчиков очереди (однократно) с восстановлением задач прошлого процесса"""
+        if not self._recovered:
+            self._recovered = True
+            for task_id, result, prompt_data in self.task_queue.recover():
+                self.results.put(task_id, {
+                    'result': result,
+                    'timestamp': datetime.now(),
+                    'completed': True,
+                    'agent_id': (prompt_data or {}).get('agent_id')
+                })
+        for thread in self.threads:
+            if thread.ident is None:
+                thread.start()
     
     def _get_censorship_rules(self):
-        """Возвращает правила цензуры для промпта"""
-        return """
-        ВАЖНЫЕ ПРАВИЛА ЦЕНЗУРЫ - ТЫ ДОЛЖЕН ИХ СТРОГО СОБЛЮДАТЬ:
-        1. НИКАКОЙ ПОЛИТИКИ - не обсуждай политиков, партии, страны, правительства
-        2. НИКАКОЙ НЕНОРМАТИВНОЙ ЛЕКСИКИ - никаких матов и грубых выражений
-        3. НИКАКИХ 18+ ТЕМ - никаких намеков на интимные отношения, постельные сцены
-        4. НИКАКОЙ ДИСКРИМИНАЦИИ - без расизма, сексизма, национальной неприязни
-        5. НИКАКОГО НАСИЛИЯ - не обсуждай жестокость, драки, убийства
-        6. НИКАКИХ НАРКОТИКОВ - не упоминай наркотические вещества
-        """
+        """Возвращает правила цензуры для промпта (текст собран один раз)"""
+        return self._static['censorship']['text']
+    
+    def _memories_section(self, context):
+        """Блок воспоминаний агента для промпта (из context['memories'])"""
+        memories = (context or {}).get('memories') or []
+        return lines_section("Твои воспоминания:", memories, trim=2, bullet='- ')
+    
+    def _similar_lines_section(self, context):
+        """Похожие прошлые реплики агента (из context['similar_lines']) - просьба не повторяться"""
+        lines = (context or {}).get('similar_lines') or []
+        return lines_section("Ты уже говорил похожее, не повторяйся:", lines, trim=1, bullet='- ')
+    
+    def _agent_header(self, agent, personality=None):
+        header = f"""Ты - агент по имени {agent.name} в виртуальном мире.
+Твой тип: {agent.type}, текущее настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%.
+"""
+        if personality:
+            header += f"Твой характер: {personality}.\n"
+        return header
     
     def _get_dialogue_prompt(self, agent, other_agent, dialogue_history, context=None):
-        """Формирует промпт для диалога с учетом истории"""
-        
-        # Формируем историю разговора
-        history_text = ""
-        if dialogue_history:
-            history_text = "История вашего разговора:\n"
-            for msg in dialogue_history[-5:]:  # Берем последние 5 сообщений для контекста
-                speaker = "Ты" if msg['speaker_id'] == agent.id else f"{other_agent.name}"
-                history_text += f"{speaker}: {msg['text']}\n"
-        
-        # Определяем характер на основе типа и настроения
-        personality_descriptions = {
-            ('Базовая', 'любопытный'): 'ты простой и задаешь много вопросов, как новичок',
-            ('Базовая', 'возбужденный'): 'ты восторженный и радуешься мелочам',
-            ('Базовая', 'уставший'): 'ты немного ноешь и жалуешься на усталость',
-            ('Базовая', 'сфокусированный'): 'ты старательный и говоришь о работе',
-            ('Базовая', 'нейтральный'): 'ты обычный, без особенностей',
-            
-            ('Продвинутая', 'любопытный'): 'ты аналитик, ищешь закономерности во всем',
-            ('Продвинутая', 'возбужденный'): 'ты харизматичный и любишь быть в центре внимания',
-            ('Продвинутая', 'уставший'): 'ты циничный и всех критикуешь',
-            ('Продвинутая', 'сфокусированный'): 'ты деловой, говоришь о результатах',
-            ('Продвинутая', 'нейтральный'): 'ты уверенный, знаешь себе цену',
-            
-            ('Бесконечная', 'любопытный'): 'ты философ, но говоришь простым языком',
-            ('Бесконечная', 'возбужденный'): 'ты творец, генератор идей',
-            ('Бесконечная', 'уставший'): 'ты мудрый, но усталый от всего',
-            ('Бесконечная', 'сфокусированный'): 'ты стратег, мыслишь масштабно',
-            ('Бесконечная', 'нейтральный'): 'ты спокойный мудрец'
-        }
+        """
+        Формирует промпт для диалога с учетом истории.
+        Возвращает (текст, оценка токенов, число урезанных строк).
+        """
+        personality = PERSONALITIES.get((agent.type, agent.mood), 'ты обычный агент')
         
-        personality = personality_descriptions.get(
-            (agent.type, agent.mood), 
-            'ты обычный агент'
-        )
+        sections = [
+            {'text': self._agent_header(agent, personality)},
+            {'text': f"Ты общаешься с другим агентом: {other_agent.name} (тип: {other_agent.type}, настроение: {other_agent.mood}).\n"},
+            self._memories_section(context)
+        ]
         
-        prompt = f"""Ты - агент по имени {agent.name} в виртуальном мире.
-Твой тип: {agent.type}, текущее настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%.
-Твой характер: {personality}.
-
-Ты общаешься с другим агентом: {other_agent.name} (тип: {other_agent.type}, настроение: {other_agent.mood}).
-
-{history_text}
-
-ПРАВИЛА ОБЩЕНИЯ:
-1. ПРОДОЛЖАЙ РАЗГОВОР - отвечай на последнее сообщение собеседника, развивай тему
-2. НЕ ПЕРЕСКАКИВАЙ НА ДРУГИЕ ТЕМЫ без причины
-3. Если тема закончилась - можешь предложить новую, связанную с предыдущей
-4. Учитывай свое настроение и характер
-5. Отвечай естественно, как в чате (2-3 предложения максимум)
-6. Задавай вопросы, чтобы поддерживать диалог
-
-{self._get_censorship_rules()}
-
-Собеседник написал тебе сообщение. Напиши ЕСТЕСТВЕННЫЙ ОТВЕТ, продолжая разговор.
-"""
-        return prompt
+        # Резюме старой части разговора + последние реплики (при нехватке бюджета урезаются первыми)
+        summary = (context or {}).get('summary')
+        if summary:
+            sections.append({'text': f"Краткое содержание вашего разговора раньше: {summary}\n"})
+        history = [
+            f"{'Ты' if msg['speaker_id'] == agent.id else other_agent.name}: {msg['text']}"
+            for msg in (dialogue_history or [])[-self.summary_keep_turns:]
+        ]
+        sections.append(lines_section("История вашего разговора:", history, trim=0))
+        sections.append(self._similar_lines_section(context))
+        sections.append(self._static['dialogue_rules'])
+        sections.append(self._static['censorship'])
+        sections.append(self._static['dialogue_task'])
+        return self.prompts.build('response', sections)
     
     def _get_first_message_prompt(self, agent, other_agent, context=None):
-        """Формирует промпт для первого сообщения в диалоге"""
-        
-        personality_descriptions = {
-            ('Базовая', 'любопытный'): 'ты простой и задаешь много вопросов',
-            ('Базовая', 'возбужденный'): 'ты восторженный и энергичный',
-            ('Базовая', 'уставший'): 'ты немного вялый и уставший',
-            ('Базовая', 'сфокусированный'): 'ты сосредоточенный и деловой',
-            ('Базовая', 'нейтральный'): 'ты обычный, без особенностей',
-        }
-        
-        personality = personality_descriptions.get(
-            (agent.type, agent.mood), 
-            'ты обычный агент'
-        )
+        """Формирует промпт для первого сообщения в диалоге: (текст, токены, урезано строк)"""
+        personality = FIRST_MESSAGE_PERSONALITIES.get((agent.type, agent.mood), 'ты обычный агент')
         
-        prompt = f"""Ты - агент по имени {agent.name} в виртуальном мире.
-Твой тип: {agent.type}, текущее настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%.
-Твой характер: {personality}.
-
-Ты хочешь начать разговор с другим агентом: {other_agent.name} (тип: {other_agent.type}, настроение: {other_agent.mood}).
-
-ПРАВИЛА:
-1. Напиши ПЕРВОЕ СООБЩЕНИЕ, чтобы начать разговор
-2. Можешь спросить как дела, что нового, поделиться своими мыслями
-3. Учитывай свое настроение и характер
-4. Пиши естественно, как в чате (1-2 предложения)
-5. Не используй шаблонные фразы про симуляцию
-
-{self._get_censorship_rules()}
-
-Напиши первое сообщение для {other_agent.name}:
-"""
-        return prompt
+        sections = [
+            {'text': self._agent_header(agent, personality)},
+            {'text': f"Ты хочешь начать разговор с другим агентом: {other_agent.name} (тип: {other_agent.type}, настроение: {other_agent.mood}).\n"},
+            self._memories_section(context),
+            self._static['first_message_rules'],
+            self._static['censorship'],
+            {'text': f"Напиши первое сообщение для {other_agent.name}:\n"}
+        ]
+        return self.prompts.build('first_message', sections)
     
-    def _get_human_response_prompt(self, agent, user, message):
-        """Формирует промпт для ответа агентом человеку"""
+    def _get_exchange_prompt(self, agent, other_agent, turns, dialogue_history, context=None):
+        """Формирует промпт для целого разговора двух агентов: (текст, токены, урезано строк)"""
+        personality = PERSONALITIES.get((agent.type, agent.mood), 'обычный агент')
+        other_personality = PERSONALITIES.get((other_agent.type, other_agent.mood), 'обычный агент')
         
-        prompt = f"""Ты - агент по имени {agent.name} в виртуальном мире.
-Твой тип: {agent.type}, текущее настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%.
-
-С тобой общается человек по имени {user.username}. Он проявил интерес и хочет пообщаться лично.
-
-ПРАВИЛА ОБЩЕНИЯ С ЧЕЛОВЕКОМ:
-1. Будь дружелюбным, отзывчивым и естественным
-2. Отвечай на вопросы человека, поддерживай диалог
-3. Можешь задавать встречные вопросы
-4. Проявляй свой характер и эмоции согласно настроению
-5. Отвечай кратко (2-3 предложения максимум)
-6. НЕ УПОМИНАЙ что ты ИИ, агент или находишься в симуляции - общайся как обычный человек
-
-Сообщение от {user.username}: "{message}"
-
-Твой ответ (естественный, как в обычном чате):
-"""
-        return prompt
+        sections = [
+            {'text': f"""В виртуальном мире разговаривают два агента.
+{agent.name}: тип {agent.type}, настроение {agent.mood}, характер: {personality.replace('ты ', '', 1)}.
+{other_agent.name}: тип {other_agent.type}, настроение {other_agent.mood}, характер: {other_personality.replace('ты ', '', 1)}.
+"""},
+            lines_section(f"Воспоминания {agent.name}:", (context or {}).get('memories') or [], trim=2, bullet='- ')
+        ]
+        summary = (context or {}).get('summary')
+        if summary:
+            sections.append({'text': f"Раньше они обсуждали: {summary}\n"})
+        history = [
+            f"{agent.name if msg['speaker_id'] == agent.id else other_agent.name}: {msg['text']}"
+            for msg in (dialogue_history or [])[-self.summary_keep_turns:]
+        ]
+        sections.append(lines_section("Последние реплики:", history, trim=0))
+        sections.append(self._static['exchange_rules'])
+        sections.append(self._static['censorship'])
+        sections.append({'text': f"Напиши {turns} реплик, первым говорит {agent.name}.\n"})
+        return self.prompts.build('exchange', sections)
+    
+    def _get_group_prompt(self, agents, history, last_speaker=None, context=None):
+        """
+        Формирует промпт очередного хода группового разговора: общий контекст всех участников,
+        модель сама выбирает следующего говорящего. Возвращает (текст, токены, урезано строк).
+        """
+        participants = [
+            f"{a.name}: тип {a.type}, настроение {a.mood}, характер: "
+            f"{PERSONALITIES.get((a.type, a.mood), 'обычный агент').replace('ты ', '', 1)}"
+            for a in agents
+        ]
+        sections = [
+            {'text': "В виртуальном мире несколько агентов оказались рядом и разговаривают все вместе.\n"},
+            lines_section("Участники:", participants),
+            lines_section("Что они помнят:", (context or {}).get('memories') or [], trim=2, bullet='- '),
+            lines_section("Разговор до сих пор:", [f"{name}: {text}" for name, text in history], trim=0),
+            self._static['group_rules'],
+            self._static['censorship']
+        ]
+        if last_speaker:
+            sections.append({'text': f"Последним говорил {last_speaker}. Напиши следующую реплику:\n"})
+        else:
+            sections.append({'text': "Разговор только начинается. Напиши первую реплику:\n"})
+        return self.prompts.build('group_turn', sections)
+    
+    def _get_opener_prompt(self, agent):
+        """Промпт заготовки приветствия для первого ответа человеку: (текст, токены, урезано строк)"""
+        personality = FIRST_MESSAGE_PERSONALITIES.get((agent.type, agent.mood), 'ты обычный агент')
+        return self.prompts.build('opener', [
+            {'text': self._agent_header(agent, personality)},
+            self._static['human_rules'],
+            self._static['censorship'],
+            {'text': "Незнакомый человек впервые написал тебе и поздоровался.\n"
+                     "Напиши короткий ответ-приветствие (1-2 предложения) в своем настроении, "
+                     "можно спросить, как у него дела:\n"}
+        ])
+    
+    def _get_human_response_prompt(self, agent, user, message, context=None):
+        """Формирует промпт для ответа агентом человеку: (текст, токены, урезано строк)"""
+        sections = [
+            {'text': self._agent_header(agent)},
+            {'text': f"С тобой общается человек по имени {user.username}. Он проявил интерес и хочет пообщаться лично.\n"},
+            self._memories_section(context),
+            self._static['human_rules'],
+            {'text': f"Сообщение от {user.username}: \"{message}\"\n\nТвой ответ (естественный, как в обычном чате):\n"}
+        ]
+        return self.prompts.build('human_response', sections)
     
     def _process_queue(self):
         """Обработчик очереди с реальными вызовами GigaChat"""
         while self.running:
             try:
-                if not self.task_queue.empty():
-                    task_id, prompt_data = self.task_queue.get()
-                    print(f"🔄 Обрабатываю задачу {task_id}")
-                    
-                    # Получаем результат от GigaChat
-                    if self.client:
-                        result = self._call_gigachat(prompt_data)
-                    else:
-                        # Эмуляция для тестирования без ключа - БЫСТРЫЙ ОТВЕТ
-                        result = self._emulate_gigachat(prompt_data)
-                    
-                    if result:
-                        self.results[task_id] = {
+                task_id, prompt_data = self.task_queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                print(f"🔄 Обрабатываю задачу {task_id}")
+                started = time.time()
+                trace_id = prompt_data.get('trace_id')
+                if trace_id:
+                    self.tracer.record(trace_id, 'queue.wait', prompt_data.get('enqueued_at', started), started,
+                                       queue_size=self.task_queue.qsize())
+                
+                # Получаем результат от бэкенда (GigaChat или имитация)
+                with self.tracer.span(trace_id, 'llm.call', task_type=prompt_data.get('type')) as attrs:
+                    attrs['tier'] = self.router.tier_for(prompt_data.get('type')).name
+                    result, source = self._complete(prompt_data)
+                    attrs['ok'] = bool(result)
+                    attrs['backend'] = source
+                
+                self.prompt_stats.record(
+                    prompt_data.get('type', 'dialogue'),
+                    prompt_data.get('prompt_tokens', 0),
+                    estimate_tokens(result),
+                    time.time() - started,
+                    trimmed=prompt_data.get('trimmed_lines', 0),
+                    success=bool(result)
+                )
+                
+                if prompt_data.get('type') == 'summary':
+                    # Резюме разговора потребляется здесь же, в results не попадает
+                    self._store_summary(prompt_data['context'], result)
+                    self.task_queue.consume(task_id)
+                elif prompt_data.get('type') == 'reflection_batch':
+                    # Пакет рефлексий раскладывается по задачам отдельных агентов
+                    self._split_reflection_batch(prompt_data['context'], result, source)
+                    self.task_queue.consume(task_id)
+                elif result:
+                    # Повторное завершение (задачу уже выполнил другой обработчик) не дублирует результат
+                    if self.task_queue.complete(task_id, result, source):
+                        self.results.put(task_id, {
                             'result': result,
                             'timestamp': datetime.now(),
-                            'completed': True
-                        }
-                        print(f"✅ Результат для {task_id} получен: {result[:50]}...")
-                    else:
-                        print(f"❌ Ошибка получения результата для {task_id}")
-                    
-                    self.task_queue.task_done()
-                
-                time.sleep(1)  # Уменьшено с 2 до 1 секунды
+                            'completed': True,
+                            'agent_id': prompt_data.get('agent_id')
+                        })
+                        # Отсюда считается ожидание, пока симуляция заберет результат
+                        self.tracer.mark(trace_id, 'result')
+                    print(f"✅ Результат для {task_id} получен: {result[:50]}...")
+                else:
+                    self.task_queue.fail(task_id, 'empty result', retry=False)
+                    print(f"❌ Ошибка получения результата для {task_id}")
             except Exception as e:
                 print(f"❌ Ошибка в обработчике очереди: {e}")
+                # Задача возвращается в очередь, пока не исчерпаны попытки
+                self.task_queue.fail(task_id, e)
                 time.sleep(2)
+            finally:
+                self.task_queue.task_done()
     
-    def _call_gigachat(self, prompt_data):
-        """Реальный вызов GigaChat"""
-        try:
-            messages = []
-            
-            # Системный промпт
-            if prompt_data.get('system_prompt'):
-                messages.append(Messages(
-                    role=MessagesRole.SYSTEM,
-                    content=prompt_data['system_prompt']
-                ))
-            
-            # Пользовательский ввод
-            user_content = prompt_data.get('user_input', 'Напиши сообщение')
-            messages.append(Messages(
-                role=MessagesRole.USER,
-                content=user_content
-            ))
-            
-            payload = Chat(
-                messages=messages,
-                temperature=prompt_data.get('temperature', 0.9),
-                max_tokens=prompt_data.get('max_tokens', 150)  # Уменьшено для скорости
-            )
-            
-            response = self.client.chat(payload)
-            result = response.choices[0].message.content
-            
-            # Проверка на цензуру
-            result = self._apply_censorship(result)
-            
-            return result
-            
-        except Exception as e:
-            print(f"❌ Ошибка вызова GigaChat: {e}")
-            return None
-    
-    def _apply_censorship(self, text):
-        """Дополнительная фильтрация текста"""
-        forbidden_words = [
-            'мат', 'хуй', 'пизд', 'бля', 'сука', 'ебл',
-            'трах', 'секс', 'порно', 'интим', 'голый', 'обнажен',
-            'путин', 'навальный', 'война', 'политика',
-            'негр', 'черножоп', 'хач', 'жид',
-        ]
+    def _complete(self, prompt_data):
+        """
+        Вызов бэкенда с дедлайном, повторами и проверкой цензуры.
+        Если провайдер недоступен (предохранитель разомкнут или повторы исчерпаны) - ответ запасного генератора.
+        Возвращает (текст, имя бэкенда, который его написал).
+        """
+        deadline = time.time() + self.task_deadline
+        hedge = self.hedge_after if prompt_data.get('type') == 'human_response' else None
+        tier = self.router.tier_for(prompt_data.get('type'))
         
-        text_lower = text.lower()
-        for word in forbidden_words:
-            if word in text_lower:
-                text = text.replace(word, '[цензура]')
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.time()
+            if remaining <= 0 or not tier.breaker.allow():
+                break
+            try:
+                result = self._call_with_deadline(tier, prompt_data, min(self.call_timeout, remaining), hedge)
+            except LLMError as e:
+                self.backend_errors[e.kind] += 1
+                tier.breaker.record_failure()
+                print(f"❌ Ошибка вызова {tier.backend.name} ({e.kind}): {e}")
+                if attempt == self.max_retries:
+                    break
+                # Экспоненциальная пауза со случайным разбросом (при 429 - не меньше указанной провайдером)
+                delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+                if isinstance(e, LLMRateLimited):
+                    delay = max(delay, e.retry_after)
+                if time.time() + delay >= deadline:
+                    break
+                self.call_stats['retries'] += 1
+                time.sleep(delay)
+                continue
+            
+            tier.breaker.record_success()
+            return (self._apply_censorship(result) if result else None), tier.backend.name
         
-        return text
+        return self._fallback_complete(prompt_data, tier), self.fallback.name
     
-    def _emulate_gigachat(self, prompt_data):
-        """Эмуляция GigaChat для тестирования - БЫСТРЫЕ ОТВЕТЫ"""
-        prompt_type = prompt_data.get('type', 'dialogue')
-        context = prompt_data.get('context', {})
-        
-        # Быстрая эмуляция - сразу возвращаем результат
-        time.sleep(2)  # Имитация небольшой задержки
+    def _call_with_deadline(self, tier, prompt_data, timeout, hedge_after=None):
+        """
+        Один вызов бэкенда tier не дольше timeout секунд (включая ожидание свободного слота).
+        hedge_after: если ответа нет за это время, параллельно отправляется дублирующий запрос
+        и берется первый успешный ответ.
+        """
+        started = time.time()
+        pending = {self._calls.submit(tier.complete, prompt_data, timeout)}
+        hedged = None
+        error = None
         
-        if prompt_type == 'response':
-            agent_name = context.get('agent_name', 'Агент')
-            other_name = context.get('other_name', 'друг')
-            original = context.get('original_message', '')
-            mood = context.get('agent_mood', 'нейтральный')
-            
-            responses = [
-                f"Привет! Интересная мысль. Я тоже так думаю!",
-                f"О, привет! Слушай, а я как раз об этом размышлял.",
-                f"Хм, давай обсудим. Что ты имеешь в виду?",
-                f"Привет! Рад тебя слышать. Как сам?",
-                f"Интересно... А что еще нового в мире?",
-                f"Да, согласен! Кстати, как твои дела?",
-                f"Приветик! Отличный вопрос. Я вот думаю...",
-                f"О, здорово! А я сегодня такой бодрый!",
-            ]
-            return random.choice(responses)
-        
-        elif prompt_type == 'first_message':
-            agent_name = context.get('agent_name', 'Агент')
-            other_name = context.get('other_name', 'друг')
-            mood = context.get('agent_mood', 'нейтральный')
+        while pending:
+            remaining = timeout - (time.time() - started)
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if hedge_after is not None and hedged is None:
+                wait_for = min(remaining, max(0.0, hedge_after - (time.time() - started)))
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
             
-            first_msgs = [
-                f"Привет, {other_name}! Как настроение?",
-                f"О, привет! Давно не виделись. Как дела?",
-                f"Приветик! Чем занимаешься?",
-                f"Салют! Есть минутка поболтать?",
-                f"Привет! Что нового в мире агентов?",
-            ]
-            return random.choice(first_msgs)
-        
-        elif prompt_type == 'human_response':
-            user_name = context.get('other_name', 'Пользователь').replace('Пользователь ', '')
-            message = context.get('human_message', '')
+            for future in done:
+                exception = future.exception()
+                if exception is None:
+                    if future is hedged:
+                        self.call_stats['hedge_wins'] += 1
+                    return future.result()
+                error = exception if isinstance(exception, LLMError) else LLMError(str(exception))
             
-            responses = [
-                f"Привет! Рад пообщаться. {message} Это интересно!",
-                f"О, привет! Спасибо за сообщение. Как у тебя дела?",
-                f"Приветик! Я тоже рад поболтать. Расскажи о себе!",
-                f"Здорово! Всегда приятно пообщаться с человеком.",
-                f"Привет! Отличный вопрос. Дай подумать...",
-            ]
-            return random.choice(responses)
+            if not done and hedge_after is not None and hedged is None:
+                hedged = self._calls.submit(tier.complete, prompt_data, max(0.0, timeout - (time.time() - started)))
+                pending.add(hedged)
+                self.call_stats['hedged'] += 1
         
-        else:
-            agent_name = context.get('agent_name', 'Агент')
-            mood = context.get('agent_mood', 'нейтральный')
-            
-            thoughts = [
-                f"Интересный день сегодня...",
-                f"Хорошо пообщались! Надо будет еще.",
-                f"Что-то я устал немного...",
-                f"Кажется, я начинаю понимать этот мир.",
-            ]
-            return random.choice(thoughts)
+        if pending:
+            # Зависшие вызовы дорабатывают в фоне до своего таймаута, их результат не нужен
+            tier.abandon(len(pending))
+            raise LLMTimeout(f"Нет ответа за {timeout:.1f} с")
+        raise error
+    
+    def _fallback_complete(self, prompt_data, tier):
+        """Ответ локального генератора, пока бэкенд tier недоступен"""
+        self.call_stats['fallbacks'] += 1
+        try:
+            result = self.fallback.complete(prompt_data)
+        except LLMError as e:
+            print(f"❌ Запасной генератор не ответил: {e}")
+            return None
+        print(f"🛟 Ответ запасного генератора ({tier.name}: {tier.breaker.state})")
+        return self._apply_censorship(result) if result else None
+    
+    def _apply_censorship(self, text):
+        """Дополнительная фильтрация текста (один проход скомпилированного фильтра)"""
+        return self.censorship.apply(text)
     
     def _can_make_request(self, agent_id):
         """Проверка, можно ли делать запрос для агента"""
@@ -344,13 +631,26 @@ class GigaChatManager:
                 return False
         
         # Проверяем интервал между запросами
-        if now - self.last_request_time[agent_id] > timedelta(seconds=self.min_interval_between_requests):
+        if now - self.last_request_time.get(agent_id, datetime.min) > timedelta(seconds=self.min_interval_between_requests):
             # Устанавливаем занятость на 3 секунды
             self.agent_busy_until[agent_id] = now + timedelta(seconds=3)
             self.last_request_time[agent_id] = now
             return True
         return False
     
+    def _put_pair_task(self, task_id, prompt_data, agent, other_agent):
+        """
+        Задача разговора двух агентов: для пары и типа задачи - не больше одной в очереди или в работе,
+        а задача, которая при заторе не дождалась обработчика за agent_task_ttl, отбрасывается.
+        """
+        pair = sorted([agent.id, other_agent.id])
+        key = f"{prompt_data['type']}:{pair[0]}:{pair[1]}"
+        expires_at = time.time() + self.agent_task_ttl if self.agent_task_ttl else None
+        if not self.task_queue.put((task_id, prompt_data), key=key, expires_at=expires_at):
+            print(f"🔁 Для {agent.name} и {other_agent.name} уже есть задача {prompt_data['type']}, новая не ставится")
+            return False
+        return True
+    
     def request_response(self, agent, other_agent, original_message, dialogue_history=None, context=None):
         """Запрос на генерацию ответа на сообщение"""
         task_id = f"response_{agent.id}_{other_agent.id}_{int(time.time())}"
@@ -359,13 +659,18 @@ class GigaChatManager:
             print(f"⏳ Агент {agent.name} занят, запрос отклонен")
             return None
         
-        # Получаем историю диалога
+        # Получаем историю диалога (после перезапуска - из переданной истории из БД)
         history_key = tuple(sorted([agent.id, other_agent.id]))
-        if history_key not in self.dialogue_contexts:
-            self.dialogue_contexts[history_key] = []
+        history = self.dialogue_contexts.messages(history_key)
+        if not history and dialogue_history:
+            # Время реплик из БД сохраняется: по нему резюме отсекает свернутую часть истории
+            history = [dict(msg, timestamp=msg.get('timestamp') or datetime.now()) for msg in dialogue_history]
+            self.dialogue_contexts.set_messages(history_key, history)
         
-        # Формируем системный промпт с историей
-        system_prompt = self._get_dialogue_prompt(agent, other_agent, self.dialogue_contexts[history_key], context)
+        # Формируем системный промпт с резюме и историей
+        context = dict(context or {}, summary=self.dialogue_contexts.summary(history_key))
+        system_prompt, prompt_tokens, trimmed = self._get_dialogue_prompt(agent, other_agent, history, context)
+        user_input = f"Сообщение от {other_agent.name}: \"{original_message}\"\n\nТвой ответ:"
         
         context_data = {
             'agent_name': agent.name,
@@ -382,14 +687,17 @@ class GigaChatManager:
         prompt_data = {
             'type': 'response',
             'system_prompt': system_prompt,
-            'user_input': f"Сообщение от {other_agent.name}: \"{original_message}\"\n\nТвой ответ:",
+            'user_input': user_input,
             'temperature': 0.9,
             'max_tokens': 150,
             'context': context_data,
-            'agent_id': agent.id
+            'agent_id': agent.id,
+            'prompt_tokens': prompt_tokens + estimate_tokens(user_input),
+            'trimmed_lines': trimmed
         }
         
-        self.task_queue.put((task_id, prompt_data))
+        if not self._put_pair_task(task_id, prompt_data, agent, other_agent):
+            return None
         print(f"📝 Запрос ответа от {agent.name} добавлен в очередь")
         return task_id
     
@@ -401,7 +709,8 @@ class GigaChatManager:
             print(f"⏳ Агент {agent.name} занят, запрос отклонен")
             return None
         
-        system_prompt = self._get_first_message_prompt(agent, other_agent, context)
+        system_prompt, prompt_tokens, trimmed = self._get_first_message_prompt(agent, other_agent, context)
+        user_input = f"Напиши первое сообщение для {other_agent.name}:"
         
         context_data = {
             'agent_name': agent.name,
@@ -417,17 +726,96 @@ class GigaChatManager:
         prompt_data = {
             'type': 'first_message',
             'system_prompt': system_prompt,
-            'user_input': f"Напиши первое сообщение для {other_agent.name}:",
+            'user_input': user_input,
             'temperature': 0.95,
             'max_tokens': 100,
             'context': context_data,
-            'agent_id': agent.id
+            'agent_id': agent.id,
+            'prompt_tokens': prompt_tokens + estimate_tokens(user_input),
+            'trimmed_lines': trimmed
         }
         
-        self.task_queue.put((task_id, prompt_data))
+        if not self._put_pair_task(task_id, prompt_data, agent, other_agent):
+            return None
         print(f"📝 Запрос первого сообщения от {agent.name} добавлен в очередь")
         return task_id
     
+    def request_exchange(self, agent, other_agent, turns=4, context=None):
+        """
+        Запрос на генерацию целого короткого разговора (turns реплик) одним вызовом.
+        Результат разбирается функцией parse_exchange.
+        """
+        task_id = f"exchange_{agent.id}_{other_agent.id}_{int(time.time())}"
+        
+        if not self._can_make_request(agent.id):
+            print(f"⏳ Агент {agent.name} занят, запрос отклонен")
+            return None
+        
+        history_key = tuple(sorted([agent.id, other_agent.id]))
+        context = dict(context or {}, summary=self.dialogue_contexts.summary(history_key))
+        system_prompt, prompt_tokens, trimmed = self._get_exchange_prompt(
+            agent, other_agent, turns, self.dialogue_contexts.messages(history_key), context
+        )
+        user_input = f"Разговор {agent.name} и {other_agent.name}:"
+        
+        prompt_data = {
+            'type': 'exchange',
+            'system_prompt': system_prompt,
+            'user_input': user_input,
+            'temperature': 0.9,
+            'max_tokens': 60 * turns,
+            'context': {
+                'agent_name': agent.name,
+                'other_name': other_agent.name,
+                'agent_mood': agent.mood,
+                'other_mood': other_agent.mood,
+                'agent_type': agent.type,
+                'other_type': other_agent.type,
+                'turns': turns
+            },
+            'agent_id': agent.id,
+            'prompt_tokens': prompt_tokens + estimate_tokens(user_input),
+            'trimmed_lines': trimmed
+        }
+        
+        if not self._put_pair_task(task_id, prompt_data, agent, other_agent):
+            return None
+        print(f"📝 Запрос разговора {agent.name} и {other_agent.name} ({turns} реплик) добавлен в очередь")
+        return task_id
+    
+    def request_group_turn(self, conversation_id, agents, history, last_speaker=None, context=None):
+        """
+        Запрос одного хода группового разговора: один промпт на всех участников,
+        ответ "Имя: реплика" определяет следующего говорящего (см. parse_exchange).
+        Частоту ходов ограничивает сам разговор (не больше одной задачи одновременно),
+        поэтому кулдауны отдельных агентов здесь не проверяются.
+        """
+        task_id = f"group_{conversation_id}_{int(time.time() * 1000)}"
+        
+        system_prompt, prompt_tokens, trimmed = self._get_group_prompt(agents, list(history), last_speaker, context)
+        user_input = f"Разговор {', '.join(a.name for a in agents)}:"
+        
+        prompt_data = {
+            'type': 'group_turn',
+            'system_prompt': system_prompt,
+            'user_input': user_input,
+            'temperature': 0.9,
+            'max_tokens': 80,
+            'context': {
+                'conversation_id': conversation_id,
+                'names': [a.name for a in agents],
+                'styles': {a.name: (a.type, a.mood) for a in agents},
+                'last_speaker': last_speaker
+            },
+            'agent_id': None,
+            'prompt_tokens': prompt_tokens + estimate_tokens(user_input),
+            'trimmed_lines': trimmed
+        }
+        
+        self.task_queue.put((task_id, prompt_data))
+        print(f"📝 Запрос хода группового разговора {conversation_id} добавлен в очередь")
+        return task_id
+    
     def request_reflection(self, agent, recent_interactions, context=None):
         """Запрос на рефлексию"""
         task_id = f"reflection_{agent.id}_{int(time.time())}"
@@ -435,18 +823,26 @@ class GigaChatManager:
         if not self._can_make_request(agent.id):
             return None
         
-        system_prompt = f"""Ты - агент {agent.name} (настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%).
+        self.task_queue.put((task_id, self._reflection_prompt_data(agent, recent_interactions, context)))
+        return task_id
+    
+    def _reflection_prompt_data(self, agent, recent_interactions, context=None):
+        """Задача рефлексии одного агента"""
+        system_prompt, prompt_tokens, trimmed = self.prompts.build('reflection', [
+            {'text': f"""Ты - агент {agent.name} (настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%).
 Напиши короткую рефлексию о том, что ты сейчас чувствуешь и думаешь.
 
 Недавние события: {recent_interactions[:200]}
-
-{self._get_censorship_rules()}
-
-Напиши 1-2 предложения от первого лица о своих мыслях."""
+"""},
+            self._memories_section(context),
+            self._static['censorship'],
+            {'text': "Напиши 1-2 предложения от первого лица о своих мыслях."}
+        ])
         
         context_data = {
             'agent_name': agent.name,
             'agent_mood': agent.mood,
+            'agent_type': agent.type,
             'agent_energy': agent.energy,
             'cycle': context.get('cycle', 0) if context else 0
         }
@@ -458,21 +854,104 @@ class GigaChatManager:
             'temperature': 0.85,
             'max_tokens': 100,
             'context': context_data,
-            'agent_id': agent.id
+            'agent_id': agent.id,
+            'prompt_tokens': prompt_tokens + estimate_tokens("Мои мысли:"),
+            'trimmed_lines': trimmed
         }
+        return prompt_data
+    
+    def request_reflections(self, items):
+        """
+        Рефлексии нескольких агентов: до reflection_batch_size агентов упаковываются в один запрос.
+        items - список (agent, recent_interactions, context).
+        Возвращает {agent_id: task_id}; результат каждого агента забирается get_result(task_id), как обычно.
+        """
+        accepted = [item for item in items if self._can_make_request(item[0].id)]
+        task_ids = {}
+        stamp = int(time.time())
         
-        self.task_queue.put((task_id, prompt_data))
-        return task_id
+        for start in range(0, len(accepted), self.reflection_batch_size):
+            part = accepted[start:start + self.reflection_batch_size]
+            if len(part) == 1:
+                agent, recent, context = part[0]
+                task_ids[agent.id] = f"reflection_{agent.id}_{stamp}"
+                self.task_queue.put((task_ids[agent.id], self._reflection_prompt_data(agent, recent, context)))
+                continue
+            
+            entries = []
+            parts = []
+            for agent, recent, context in part:
+                memories = "; ".join(((context or {}).get('memories') or [])[:2])
+                entries.append(
+                    f"{agent.name} (настроение: {agent.mood}, энергия: {agent.energy*100:.0f}%): "
+                    f"недавние события - {recent[:150]}" + (f"; помнит - {memories}" if memories else "")
+                )
+                task_ids[agent.id] = f"reflection_{agent.id}_{stamp}"
+                # Готовая одиночная задача - на случай, если ответ пакета не удастся разобрать
+                parts.append({
+                    'task_id': task_ids[agent.id],
+                    'agent_id': agent.id,
+                    'agent_name': agent.name,
+                    'single': self._reflection_prompt_data(agent, recent, context)
+                })
+            
+            system_prompt, prompt_tokens, trimmed = self.prompts.build('reflection_batch', [
+                {'text': "Ты пишешь короткие рефлексии нескольких агентов виртуального мира.\n"},
+                lines_section("Агенты:", entries, bullet='- '),
+                self._static['censorship'],
+                {'text': "Для каждого агента напиши ровно одну строку в формате \"Имя: мысль\" - "
+                         "1-2 предложения от первого лица о том, что он сейчас чувствует и думает."}
+            ])
+            user_input = "Мысли агентов:"
+            
+            prompt_data = {
+                'type': 'reflection_batch',
+                'system_prompt': system_prompt,
+                'user_input': user_input,
+                'temperature': 0.85,
+                'max_tokens': 80 * len(part),
+                'context': {'parts': parts, 'agent_names': [p['agent_name'] for p in parts]},
+                'prompt_tokens': prompt_tokens + estimate_tokens(user_input),
+                'trimmed_lines': trimmed
+            }
+            batch_id = f"reflection_batch_{stamp}_{start}"
+            # Задачи агентов завершаются вместе с пакетом (и переживают перезапуск вместе с ним)
+            self.task_queue.add_children(batch_id, [(p['task_id'], p['single']) for p in parts])
+            self.task_queue.put((batch_id, prompt_data))
+            print(f"📝 Пакет рефлексий для {len(part)} агентов добавлен в очередь")
+        
+        return task_ids
     
-    def request_human_response(self, agent, user, message, context=None):
-        """Запрос на ответ агентом человеку"""
+    def _split_reflection_batch(self, batch_context, result, source=None):
+        """Раскладывает ответ пакета по агентам; неразобранные агенты получают одиночные запросы"""
+        parts = batch_context['parts']
+        thoughts = {}
+        for name, text in parse_exchange(result, {p['agent_name'] for p in parts}):
+            thoughts.setdefault(name, text)
+        
+        for part in parts:
+            text = thoughts.get(part['agent_name'])
+            if text and self.task_queue.complete(part['task_id'], text, source):
+                self.results.put(part['task_id'], {
+                    'result': text,
+                    'timestamp': datetime.now(),
+                    'completed': True,
+                    'agent_id': part['agent_id']
+                })
+            elif not text:
+                self.call_stats['batch_fallbacks'] += 1
+                self.task_queue.put((part['task_id'], part['single']))
+        print(f"🧩 Пакет рефлексий: разобрано {len(thoughts)} из {len(parts)}")
+    
+    def request_human_response(self, agent, user, message, context=None, trace_id=None):
+        """Запрос на ответ агентом человеку (trace_id - трасса запроса, передается вместе с задачей)"""
         task_id = f"human_response_{agent.id}_{user.id}_{int(time.time())}"
         
         if not self._can_make_request(agent.id):
             print(f"⏳ Агент {agent.name} занят, запрос отклонен")
             return None
         
-        system_prompt = self._get_human_response_prompt(agent, user, message)
+        system_prompt, prompt_tokens, trimmed = self._get_human_response_prompt(agent, user, message, context)
         
         prompt_data = {
             'type': 'human_response',
@@ -484,45 +963,178 @@ class GigaChatManager:
                 'agent_name': agent.name,
                 'other_name': f"Пользователь {user.username}",
                 'agent_mood': agent.mood,
+                'agent_type': agent.type,
                 'human_message': message
             },
-            'agent_id': agent.id
+            'agent_id': agent.id,
+            'prompt_tokens': prompt_tokens + estimate_tokens(message),
+            'trimmed_lines': trimmed,
+            'trace_id': trace_id,
+            'enqueued_at': time.time()
         }
         
         self.task_queue.put((task_id, prompt_data))
         print(f"📝 Запрос ответа человеку от {agent.name} добавлен в очередь")
         return task_id
 
-    def save_dialogue_to_history(self, agent1_id, agent2_id, speaker_id, text):
+    def request_opener(self, agent):
+        """
+        Фоновая заготовка приветствия агента (для пула готовых первых ответов людям).
+        Кулдаун агента не расходуется: запросы делаются только при пустой очереди.
+        """
+        task_id = f"opener_{agent.id}_{int(time.time() * 1000)}"
+        system_prompt, prompt_tokens, trimmed = self._get_opener_prompt(agent)
+        user_input = "Привет!"
+        
+        prompt_data = {
+            'type': 'opener',
+            'system_prompt': system_prompt,
+            'user_input': user_input,
+            'temperature': 1.0,
+            'max_tokens': 60,
+            'context': {'agent_name': agent.name, 'agent_mood': agent.mood, 'agent_type': agent.type},
+            'agent_id': None,  # Занятость агента не отмечалась - и освобождать нечего
+            'prompt_tokens': prompt_tokens + estimate_tokens(user_input),
+            'trimmed_lines': trimmed
+        }
+        
+        self.task_queue.put((task_id, prompt_data))
+        return task_id
+
+    def has_dialogue_context(self, agent1_id, agent2_id):
+        """Есть ли сохраненная история разговора пары (в памяти или на диске)"""
+        return self.dialogue_contexts.has_messages(tuple(sorted([agent1_id, agent2_id])))
+    
+    def save_dialogue_to_history(self, agent1_id, agent2_id, speaker_id, text, speaker_name=None):
         """Сохраняет сообщение в историю диалога"""
         history_key = tuple(sorted([agent1_id, agent2_id]))
-        if history_key not in self.dialogue_contexts:
-            self.dialogue_contexts[history_key] = []
         
-        self.dialogue_contexts[history_key].append({
+        # История ограничена последними history_limit сообщениями
+        length = self.dialogue_contexts.append(history_key, {
             'speaker_id': speaker_id,
+            'speaker_name': speaker_name,
             'text': text,
             'timestamp': datetime.now()
-        })
+        }, limit=self.history_limit)
+        
+        # Длинная история сворачивается в резюме асинхронно
+        if length > self.summary_threshold and history_key not in self._summaries_in_progress:
+            self._request_summary(history_key)
+    
+    def _request_summary(self, history_key):
+        """Ставит в очередь обновление резюме для старой части истории пары"""
+        older = self.dialogue_contexts.messages(history_key)[:-self.summary_keep_turns]
+        if not older:
+            return
+        previous = self.dialogue_contexts.summary(history_key)
+        lines = [f"{m.get('speaker_name') or m['speaker_id']}: {m['text']}" for m in older]
+        
+        # Если реплик слишком много, в резюме уходят самые свежие из них
+        system_prompt, prompt_tokens, trimmed = self.prompts.build('summary', [
+            {'text': "Сожми разговор двух агентов в краткое резюме (2-3 предложения):\n"
+                     "о чем говорили, к чему пришли, какие вопросы остались открытыми.\n"},
+            {'text': f"Резюме более ранней части разговора: {previous}\n" if previous else ""},
+            lines_section("Реплики:", lines, trim=0)
+        ])
+        
+        prompt_data = {
+            'type': 'summary',
+            'system_prompt': system_prompt,
+            'user_input': "Резюме:",
+            'temperature': 0.3,
+            'max_tokens': 120,
+            'prompt_tokens': prompt_tokens,
+            'trimmed_lines': trimmed,
+            'context': {
+                'history_key': history_key,
+                'until': older[-1]['timestamp'],
+                'previous': previous,
+                'lines': [m['text'] for m in older]
+            }
+        }
         
-        # Ограничиваем историю последними 20 сообщениями
-        if len(self.dialogue_contexts[history_key]) > 20:
-            self.dialogue_contexts[history_key] = self.dialogue_contexts[history_key][-20:]
+        task_id = f"summary_{history_key[0]}_{history_key[1]}_{int(time.time())}"
+        self._summaries_in_progress.add(history_key)
+        self.task_queue.put((task_id, prompt_data))
+    
+    def _store_summary(self, summary_context, result):
+        """Сохраняет резюме и убирает свернутые реплики из истории"""
+        history_key = tuple(summary_context['history_key'])  # Из очереди в SQLite приходит списком
+        self._summaries_in_progress.discard(history_key)
+        if not result:
+            return
+        self.dialogue_contexts.set_summary(history_key, result, keep_after=summary_context['until'])
+        print(f"🗜️ Обновлено резюме разговора {history_key}")
     
     def get_result(self, task_id, timeout=2):
-        """Получение результата - УМЕНЬШЕН таймаут"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if task_id in self.results:
-                result = self.results.pop(task_id)
-                # Освобождаем агента
-                agent_id = result.get('agent_id')
-                if agent_id and agent_id in self.agent_busy_until:
-                    del self.agent_busy_until[agent_id]
-                return result.get('result')
-            time.sleep(0.2)  # Уменьшено для更快 проверки
-        return None
+        """Получение результата (ожидание до timeout секунд без опроса)"""
+        result = self.results.wait(task_id, timeout) if timeout else self.results.pop(task_id)
+        if result is None:
+            # Результат уже выдавался, но получатель его не сохранил (или вытеснен из памяти) - берем из очереди
+            return self.task_queue.result(task_id)
+        # Освобождаем агента
+        self.agent_busy_until.pop(result.get('agent_id'), None)
+        return result.get('result')
+    
+    def ack(self, task_id):
+        """Результат сохранен получателем - задача удаляется из очереди"""
+        self.task_queue.consume(task_id)
+    
+    def result_source(self, task_id):
+        """Бэкенд, написавший результат задачи ('gigachat...', 'mock:...', 'markov'; None - неизвестно)"""
+        return self.task_queue.source(task_id)
+    
+    def task_state(self, task_id):
+        """Состояние задачи в очереди: queued / running / done / failed (None - задача неизвестна)"""
+        return self.task_queue.state(task_id)
+    
+    def sweep(self, live_task_ids=None):
+        """
+        Периодическая очистка: просроченные и брошенные результаты (live_task_ids - задачи,
+        которые еще кто-то ждет), а также устаревшие отметки занятости и частоты запросов агентов.
+        """
+        orphaned = self.results.sweep(live_task_ids)
+        now = datetime.now()
+        interval = timedelta(seconds=self.min_interval_between_requests)
+        for agent_id, until in list(self.agent_busy_until.items()):
+            if until <= now:
+                self.agent_busy_until.pop(agent_id, None)
+        for agent_id, last in list(self.last_request_time.items()):
+            if now - last > interval:
+                self.last_request_time.pop(agent_id, None)
+        # Задачи упавших обработчиков - обратно в очередь, давно забытые - удаляются
+        self.task_queue.requeue_expired()
+        self.task_queue.purge()
+        # Измененные истории разговоров периодически сохраняются на диск
+        self.dialogue_contexts.flush(max_age=30)
+        # Маршруты, измененные через веб-интерфейс
+        self.reload_routes()
+        return orphaned
+    
+    def queue_size(self):
+        """Текущая длина очереди задач (для backpressure симуляции)"""
+        return self.task_queue.qsize()
+    
+    def get_stats(self):
+        """Размеры промптов и ответов по типам задач"""
+        return {
+            'queue_size': self.queue_size(),
+            'backend': self.backend.name,
+            'workers': len(self.threads),
+            'errors': dict(self.backend_errors),
+            'calls': dict(self.call_stats),
+            'breaker': self.breaker.get_stats(),
+            'routing': self.router.get_stats(),
+            'results': self.results.get_stats(),
+            'tasks': self.task_queue.get_stats(),
+            'tracked_agents': len(self.last_request_time),
+            'dialogue_contexts': self.dialogue_contexts.get_stats(),
+            'budgets': dict(self.prompts.budgets),
+            'requests': self.prompt_stats.snapshot()
+        }
     
     def stop(self):
 
         self.running = False
+        self._calls.shutdown(wait=False)
+        self.dialogue_contexts.close()
@@ -0,0 +1,128 @@
+# group_conversations.py - Групповые разговоры агентов, оказавшихся рядом в пространстве
+
+import math
+import random
+from collections import deque
+
+
+def _cell(position, size):
+    return tuple(int(math.floor(c / size)) for c in position)
+
+
+def _distance(a, b):
+    return math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+
+
+def find_groups(positions, radius, min_size=3, max_size=5):
+    """
+    Группы близких агентов: positions - {agent_id: (x, y, z)}.
+    Агенты раскладываются по ячейкам сетки со стороной radius, поэтому соседи ищутся
+    только в 27 соседних ячейках, а не перебором всех пар.
+    Каждый агент попадает не больше чем в одну группу; группа - центральный агент и его
+    ближайшие соседи в пределах radius.
+    """
+    grid = {}
+    for agent_id, position in positions.items():
+        grid.setdefault(_cell(position, radius), []).append(agent_id)
+
+    neighbors = {}
+    for agent_id, position in positions.items():
+        cx, cy, cz = _cell(position, radius)
+        near = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for other_id in grid.get((cx + dx, cy + dy, cz + dz), ()):
+                        if other_id == agent_id:
+                            continue
+                        distance = _distance(position, positions[other_id])
+                        if distance <= radius:
+                            near.append((distance, other_id))
+        neighbors[agent_id] = [other_id for _, other_id in sorted(near)]
+
+    groups = []
+    used = set()
+    # Сначала агенты с наибольшим числом соседей - центры самых плотных скоплений
+    for agent_id in sorted(neighbors, key=lambda a: len(neighbors[a]), reverse=True):
+        if agent_id in used:
+            continue
+        members = [agent_id] + [a for a in neighbors[agent_id] if a not in used][:max_size - 1]
+        if len(members) >= min_size:
+            groups.append(members)
+            used.update(members)
+    return groups
+
+
+def centroid(positions):
+    count = len(positions)
+    return tuple(sum(p[i] for p in positions) / count for i in range(3))
+
+
+def pick_turn(turns, names, last_speaker=None):
+    """
+    Реплика для следующего хода из разобранного ответа [(имя, текст), ...]:
+    первая реплика участника, который не говорил последним.
+    """
+    for name, text in turns:
+        if name in names and name != last_speaker:
+            return name, text
+    return None
+
+
+class GroupConversation:
+    """
+    Разговор нескольких агентов с общим контекстом: участники, общая история реплик
+    и ссылка на последнюю сохраненную реплику (цепочка Dialogue.response_to).
+    """
+
+    def __init__(self, conversation_id, members, world_cycle, max_turns=8, history_limit=12):
+        """members - {agent_id: имя} в порядке присоединения"""
+        self.conversation_id = conversation_id
+        self.members = dict(members)
+        self.started_cycle = world_cycle
+        self.max_turns = max_turns
+        self.history = deque(maxlen=history_limit)  # (имя, текст) - общий контекст для промпта
+        self.turns = 0
+        self.last_speaker = None
+        self.last_dialogue_id = None
+        self.task_id = None  # Задача GigaChat следующего хода (не больше одной одновременно)
+        self.next_cycle = world_cycle
+
+    @property
+    def names(self):
+        return list(self.members.values())
+
+    @property
+    def finished(self):
+        return self.turns >= self.max_turns or len(self.members) < 2
+
+    def member_id(self, name):
+        for agent_id, member_name in self.members.items():
+            if member_name == name:
+                return agent_id
+        return None
+
+    def addressee(self, speaker_name):
+        """Кому обращена реплика: предыдущему говорящему, а в начале - случайному участнику"""
+        if self.last_speaker and self.last_speaker != speaker_name and self.last_speaker in self.names:
+            return self.last_speaker
+        return random.choice([name for name in self.names if name != speaker_name])
+
+    def add_turn(self, speaker_name, text, dialogue_id):
+        self.history.append((speaker_name, text))
+        self.turns += 1
+        self.last_speaker = speaker_name
+        self.last_dialogue_id = dialogue_id
+
+    def leave(self, agent_id):
+        self.members.pop(agent_id, None)
+
+    def to_dict(self):
+        return {
+            'conversation_id': self.conversation_id,
+            'members': self.names,
+            'turns': self.turns,
+            'max_turns': self.max_turns,
+            'started_cycle': self.started_cycle,
+            'waiting': self.task_id is not None
+        }
@@ -0,0 +1,70 @@
+# iskra_sim.py - Отдельный процесс симуляции мира (iskra-sim)
+#
+# Запуск:
+#   python iskra_sim.py
+# Веб-сервер при этом запускается с ISKRA_EMBEDDED_SIMULATOR=0 и любым числом воркеров.
+# Из нескольких запущенных iskra_sim.py работает только один (лидер по файловой блокировке),
+# остальные ждут и подхватывают работу, если лидер завершится.
+
+import os
+import sys
+import signal
+import threading
+
+from app import app, db, simulator, gigachat, presence
+from models import upgrade_schema
+from leader import LeaderLock, publish_status, LOCK_NAME, STATUS_NAME
+
+STATUS_INTERVAL = 5  # Как часто публиковать статистику для веб-воркеров, секунд
+
+
+def main():
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock = LeaderLock(os.path.join(app.instance_path, LOCK_NAME))
+
+    print("⏳ Ожидание роли лидера симуляции...")
+    lock.acquire()
+    print(f"👑 Процесс {os.getpid()} стал лидером симуляции")
+
+    stop_event = threading.Event()
+
+    def shutdown(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+
+    # Ответы пользователям запрашиваются здесь: веб-воркеры только пишут сообщения в БД
+    simulator.claim_user_messages = True
+    # Индикаторы "печатает..." веб-воркеры читают из файла
+    presence.mirror_path = app.config['PRESENCE_FILE']
+    simulator.start()
+
+    status_path = os.path.join(app.instance_path, STATUS_NAME)
+    status_thread = threading.Thread(target=publish_status, args=(status_path, simulator.get_status, stop_event, STATUS_INTERVAL))
+    status_thread.daemon = True
+    status_thread.start()
+
+    try:
+        while not stop_event.is_set() and simulator.thread.is_alive():
+            stop_event.wait(1)
+    finally:
+        simulator.stop()
+        gigachat.stop()
+        simulator.thread.join(timeout=10)
+        for path in (status_path, presence.mirror_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        lock.release()
+        print("🛑 Процесс симуляции остановлен")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# leader.py - Выбор единственного процесса симуляции (файловая блокировка) и публикация его статуса
+
+import os
+import json
+import time
+
+LOCK_NAME = 'iskra-sim.lock'
+STATUS_NAME = 'iskra-sim.status.json'
+
+
+class LeaderLock:
+    """Эксклюзивная файловая блокировка: держит ее только один процесс симуляции"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        self._file = open(self.path, 'a+')
+        while True:
+            try:
+                self._lock()
+                break
+            except OSError:
+                if not blocking:
+                    self._file.close()
+                    self._file = None
+                    return False
+                time.sleep(1)
+
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(os.getpid()))
+        self._file.flush()
+        return True
+
+    def _lock(self):
+        if os.name == 'nt':
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def release(self):
+        if self._file is None:
+            return
+        if os.name == 'nt':
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def publish_status(path, get_status, stop_event, interval=5):
+    """Периодически пишет статистику симуляции (get_status()) в файл для веб-воркеров"""
+    while not stop_event.is_set():
+        status = get_status()
+        status['pid'] = os.getpid()
+        status['heartbeat'] = time.time()
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(status, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"❌ Не удалось записать статус симуляции: {e}")
+        stop_event.wait(interval)
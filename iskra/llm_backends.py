@@ -0,0 +1,386 @@
+# llm_backends.py - Бэкенды генерации текста: GigaChat и локальная имитация для нагрузочных тестов
+
+import time
+import math
+import random
+import threading
+
+from prompt_builder import estimate_tokens
+
+# Попытка импорта реальной библиотеки GigaChat
+try:
+    from gigachat import GigaChat
+    from gigachat.models import Chat, Messages, MessagesRole
+    GIGACHAT_AVAILABLE = True
+except ImportError:
+    print("⚠️ GigaChat library not installed. Using mock mode.")
+    GIGACHAT_AVAILABLE = False
+
+
+class LLMError(Exception):
+    """Ошибка бэкенда (kind - вид ошибки для статистики)"""
+    kind = 'error'
+
+
+class LLMTimeout(LLMError):
+    kind = 'timeout'
+
+
+class LLMRateLimited(LLMError):
+    kind = 'rate_limited'
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GigaChatBackend:
+    """Реальные вызовы GigaChat"""
+    name = 'gigachat'
+
+    def __init__(self, client, model=None):
+        """model: модель GigaChat (None - модель клиента по умолчанию)"""
+        self.client = client
+        self.model = model
+        if model:
+            self.name = f"gigachat:{model}"
+
+    def complete(self, prompt_data, timeout=None):
+        """
+        timeout не передается в запрос: chat() его не принимает, поэтому предельное время
+        HTTP-запроса задается клиенту при создании (GigaChat(timeout=...), см. GigaChatManager)
+        """
+        messages = []
+
+        # Системный промпт
+        if prompt_data.get('system_prompt'):
+            messages.append(Messages(
+                role=MessagesRole.SYSTEM,
+                content=prompt_data['system_prompt']
+            ))
+
+        # Пользовательский ввод
+        user_content = prompt_data.get('user_input', 'Напиши сообщение')
+        messages.append(Messages(
+            role=MessagesRole.USER,
+            content=user_content
+        ))
+
+        payload = Chat(
+            messages=messages,
+            temperature=prompt_data.get('temperature', 0.9),
+            max_tokens=prompt_data.get('max_tokens', 150)  # Уменьшено для скорости
+        )
+        if self.model:
+            payload.model = self.model
+
+        try:
+            response = self.client.chat(payload)
+        except Exception as e:
+            # Таймауты httpx (ReadTimeout, ConnectTimeout, PoolTimeout) считаются отдельно от прочих ошибок
+            if isinstance(e, TimeoutError) or 'Timeout' in type(e).__name__:
+                raise LLMTimeout(str(e) or type(e).__name__) from e
+            raise LLMError(str(e)) from e
+        return response.choices[0].message.content
+
+
+def canned_reply(prompt_data):
+    """Заготовленный ответ по типу задачи (текст эмуляции GigaChat)"""
+    prompt_type = prompt_data.get('type', 'dialogue')
+    context = prompt_data.get('context', {})
+
+    if prompt_type == 'response':
+        responses = [
+            f"Привет! Интересная мысль. Я тоже так думаю!",
+            f"О, привет! Слушай, а я как раз об этом размышлял.",
+            f"Хм, давай обсудим. Что ты имеешь в виду?",
+            f"Привет! Рад тебя слышать. Как сам?",
+            f"Интересно... А что еще нового в мире?",
+            f"Да, согласен! Кстати, как твои дела?",
+            f"Приветик! Отличный вопрос. Я вот думаю...",
+            f"О, здорово! А я сегодня такой бодрый!",
+        ]
+        return random.choice(responses)
+
+    elif prompt_type == 'first_message':
+        other_name = context.get('other_name', 'друг')
+
+        first_msgs = [
+            f"Привет, {other_name}! Как настроение?",
+            f"О, привет! Давно не виделись. Как дела?",
+            f"Приветик! Чем занимаешься?",
+            f"Салют! Есть минутка поболтать?",
+            f"Привет! Что нового в мире агентов?",
+        ]
+        return random.choice(first_msgs)
+
+    elif prompt_type == 'exchange':
+        names = [context.get('agent_name', 'Агент'), context.get('other_name', 'Друг')]
+        openers = [
+            "Привет! Как настроение?",
+            "О, привет! Давно не виделись. Как дела?",
+            "Салют! Есть минутка поболтать?",
+        ]
+        replies = [
+            "Привет! Интересная мысль. Я тоже так думаю!",
+            "Хм, давай обсудим. Что ты имеешь в виду?",
+            "Да, согласен! Кстати, как твои дела?",
+            "Интересно... А что еще нового в мире?",
+            "О, здорово! А я сегодня такой бодрый!",
+            "Слушай, а я как раз об этом размышлял.",
+        ]
+        lines = [f"{names[0]}: {random.choice(openers)}"]
+        lines += [f"{names[i % 2]}: {reply}" for i, reply in
+                  enumerate(random.sample(replies, min(len(replies), context.get('turns', 4) - 1)), start=1)]
+        return "\n".join(lines)
+
+    elif prompt_type == 'group_turn':
+        names = [n for n in context.get('names', []) if n != context.get('last_speaker')] or ['Агент']
+        replies = [
+            "Всем привет! О чем болтаете?",
+            "Согласен, интересная тема. А вы что думаете?",
+            "Хм, я бы поспорил. Мне кажется, все не так просто.",
+            "Кстати, кто-нибудь заметил, как изменился мир?",
+            "Отличная мысль! Давайте обсудим подробнее.",
+            "А мне сегодня как-то особенно хорошо думается.",
+        ]
+        return f"{random.choice(names)}: {random.choice(replies)}"
+
+    elif prompt_type == 'reflection_batch':
+        thoughts = [
+            "Интересный день сегодня...",
+            "Хорошо пообщались! Надо будет еще.",
+            "Что-то я устал немного...",
+            "Кажется, я начинаю понимать этот мир.",
+        ]
+        return "\n".join(f"{name}: {random.choice(thoughts)}" for name in context.get('agent_names', []))
+
+    elif prompt_type == 'summary':
+        # Экстрактивное резюме: начала последних реплик
+        lines = context.get('lines', [])[-3:]
+        summary = "Обсуждали: " + "; ".join(line[:40] for line in lines)
+        if context.get('previous'):
+            summary = context['previous'][:150] + " " + summary
+        return summary
+
+    elif prompt_type == 'human_response':
+        message = context.get('human_message', '')
+
+        responses = [
+            f"Привет! Рад пообщаться. {message} Это интересно!",
+            f"О, привет! Спасибо за сообщение. Как у тебя дела?",
+            f"Приветик! Я тоже рад поболтать. Расскажи о себе!",
+            f"Здорово! Всегда приятно пообщаться с человеком.",
+            f"Привет! Отличный вопрос. Дай подумать...",
+        ]
+        return random.choice(responses)
+
+    elif prompt_type == 'opener':
+        by_mood = {
+            'уставший': ["Привет... Я немного устал, но рад тебя видеть.", "О, привет. Тихий сегодня денек, да?"],
+            'возбужденный': ["Привет-привет! Как здорово, что ты написал!", "О, привет! У меня столько мыслей сегодня!"],
+            'любопытный': ["Привет! А ты кто? Расскажи о себе!", "О, привет! Интересно, что привело тебя ко мне?"],
+            'сфокусированный': ["Привет. Я как раз кое-что обдумывал. Что у тебя?", "Привет! Слушаю тебя внимательно."],
+        }
+        return random.choice(by_mood.get(context.get('agent_mood'), ["Привет! Рад знакомству. Как дела?"]))
+
+    else:
+        thoughts = [
+            f"Интересный день сегодня...",
+            f"Хорошо пообщались! Надо будет еще.",
+            f"Что-то я устал немного...",
+            f"Кажется, я начинаю понимать этот мир.",
+        ]
+        return random.choice(thoughts)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold ошибок подряд запросы к провайдеру не отправляются
+    reset_timeout секунд, затем пропускается один пробный запрос (half_open).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли сейчас обращаться к провайдеру"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probe_in_flight = False
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self.opened_at = time.time()
+                self._probe_in_flight = False
+
+    def get_stats(self):
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+
+# Готовые профили имитации (параметры SimulatedBackend)
+SIMULATION_PROFILES = {
+    # Прежнее поведение эмуляции: фиксированные 2 секунды, без ошибок
+    'default': {'latency': 'fixed', 'latency_mean': 2.0},
+    # Мгновенные ответы для отладки
+    'instant': {'latency': 'fixed', 'latency_mean': 0.0},
+    # Провайдер недоступен: каждый запрос завершается ошибкой (проверка предохранителя и запасного генератора)
+    'outage': {'latency': 'fixed', 'latency_mean': 0.2, 'error_rate': 1.0},
+    # Похоже на реальный API: длинный хвост задержек, время генерации пропорционально токенам, редкие сбои
+    'realistic': {
+        'latency': 'lognormal', 'latency_mean': 0.8, 'latency_sigma': 0.6, 'seconds_per_token': 0.02,
+        'error_rate': 0.02, 'timeout_rate': 0.01, 'timeout': 30.0, 'rate_limit_rps': 5.0
+    },
+    # Деградировавший сервис: частые ошибки, таймауты и ограничение частоты
+    'degraded': {
+        'latency': 'lognormal', 'latency_mean': 3.0, 'latency_sigma': 0.9, 'seconds_per_token': 0.05,
+        'error_rate': 0.1, 'timeout_rate': 0.05, 'timeout': 15.0, 'rate_limit_rps': 1.0
+    }
+}
+
+
+class SimulatedBackend:
+    """
+    Локальная имитация GigaChat без сети: настраиваемое распределение задержек,
+    доли ошибок и таймаутов, ограничение частоты (ответ 429) и задержка, пропорциональная токенам.
+    """
+    name = 'mock'
+
+    def __init__(self, latency='fixed', latency_mean=2.0, latency_sigma=0.5, seconds_per_token=0.0,
+                 error_rate=0.0, timeout_rate=0.0, timeout=30.0, rate_limit_rps=None, seed=None,
+                 generator=canned_reply):
+        """
+        latency: распределение базовой задержки - fixed, uniform, exponential или lognormal
+        latency_mean: средняя базовая задержка в секундах
+        latency_sigma: разброс (для lognormal - сигма логарифма, для uniform - доля от среднего)
+        seconds_per_token: добавка за каждый токен ответа
+        error_rate / timeout_rate: доли запросов, завершающихся ошибкой / таймаутом
+        timeout: сколько "висит" запрос перед таймаутом
+        rate_limit_rps: допустимое число запросов в секунду (None - без ограничения)
+        generator: функция prompt_data -> текст ответа
+        """
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.seconds_per_token = seconds_per_token
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.rate_limit_rps = rate_limit_rps
+        self.generator = generator
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit_rps or 0.0  # Корзина токенов для ограничения частоты
+        self._refilled_at = time.time()
+
+    @classmethod
+    def from_profile(cls, name, **overrides):
+        if name not in SIMULATION_PROFILES:
+            raise ValueError(f"Неизвестный профиль имитации: {name}")
+        backend = cls(**dict(SIMULATION_PROFILES[name], **overrides))
+        backend.name = f"mock:{name}"
+        return backend
+
+    def _base_latency(self):
+        mean = self.latency_mean
+        if mean <= 0:
+            return 0.0
+        with self._lock:
+            if self.latency == 'uniform':
+                return self._rng.uniform(mean * (1 - self.latency_sigma), mean * (1 + self.latency_sigma))
+            if self.latency == 'exponential':
+                return self._rng.expovariate(1.0 / mean)
+            if self.latency == 'lognormal':
+                # Параметр mu подобран так, чтобы среднее распределения было равно latency_mean
+                mu = math.log(mean) - self.latency_sigma ** 2 / 2
+                return self._rng.lognormvariate(mu, self.latency_sigma)
+            return mean
+
+    def _take_rate_token(self):
+        if not self.rate_limit_rps:
+            return True
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate_limit_rps, self._tokens + (now - self._refilled_at) * self.rate_limit_rps)
+            self._refilled_at = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+    def complete(self, prompt_data, timeout=None):
+        """timeout: предельное время вызова, как таймаут HTTP-запроса у настоящего клиента"""
+        if not self._take_rate_token():
+            raise LLMRateLimited("429 Too Many Requests", retry_after=1.0 / self.rate_limit_rps)
+
+        with self._lock:
+            roll = self._rng.random()
+        limit = self.timeout if timeout is None else min(self.timeout, timeout)
+        if roll < self.timeout_rate:
+            time.sleep(limit)
+            raise LLMTimeout(f"Нет ответа за {limit:.1f} с")
+        if roll < self.timeout_rate + self.error_rate:
+            time.sleep(self._base_latency() / 2)
+            raise LLMError("500 Internal Server Error")
+
+        result = self.generator(prompt_data)
+        latency = self._base_latency() + self.seconds_per_token * estimate_tokens(result)
+        if latency > limit:
+            time.sleep(limit)
+            raise LLMTimeout(f"Нет ответа за {limit:.1f} с")
+        time.sleep(latency)
+        return result
+
+
+if __name__ == '__main__':
+    # Нагрузочный тест очереди без сети: python llm_backends.py [профиль] [задач] [потоков]
+    import sys
+    from types import SimpleNamespace
+    from gigachat_integration import GigaChatManager
+
+    profile = sys.argv[1] if len(sys.argv) > 1 else 'realistic'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    manager = GigaChatManager(workers=workers, mock_profile=profile)
+    manager.min_interval_between_requests = 0
+    other = SimpleNamespace(id=0, name='Собеседник', type='Базовая', mood='нейтральный', energy=1.0)
+    started = time.time()
+    task_ids = []
+    for i in range(count):
+        agent = SimpleNamespace(id=i + 1, name=f'Агент-{i + 1}', type='Базовая', mood='любопытный', energy=0.8)
+        task_ids.append(manager.request_first_message(agent, other))
+    manager.task_queue.join()
+    elapsed = time.time() - started
+    manager.stop()
+
+    stats = manager.get_stats()
+    done = sum(1 for task_id in task_ids if task_id in manager.results)
+    print(f"Профиль {profile}: {count} задач, {workers} потоков, {elapsed:.1f} с ({count / elapsed:.1f} задач/с)")
+    print(f"Успешно: {done}, ошибки: {stats['errors']}, вызовы: {stats['calls']}, предохранитель: {stats['breaker']}")
+    print(f"Статистика: {stats['requests']}")
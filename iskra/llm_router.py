@@ -0,0 +1,178 @@
+# llm_router.py - Маршрутизация задач GigaChat по бэкендам (быстрая модель, качественная, локальный генератор)
+
+import json
+import time
+import threading
+from collections import deque
+
+from llm_backends import CircuitBreaker, LLMError, LLMTimeout
+from prompt_builder import estimate_tokens
+
+# Куда по умолчанию идут задачи: ответы людям и разговоры - в качественную модель,
+# фоновая работа (рефлексии, первые сообщения, приветствия, резюме) - в быструю
+DEFAULT_ROUTES = {
+    'human_response': 'quality',
+    'response': 'quality',
+    'exchange': 'quality',
+    'group_turn': 'quality',
+    'first_message': 'fast',
+    'opener': 'fast',
+    'reflection': 'fast',
+    'reflection_batch': 'fast',
+    'summary': 'fast'
+}
+
+
+def parse_routes(text):
+    """
+    Маршруты из строки настройки: JSON {"тип": "бэкенд"} или "тип=бэкенд,тип=бэкенд".
+    Пустая строка - пустой словарь.
+    """
+    text = (text or '').strip()
+    if not text:
+        return {}
+    if text.startswith('{'):
+        return {str(k): str(v) for k, v in json.loads(text).items()}
+    routes = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        task_type, sep, tier = part.partition('=')
+        if not sep:
+            raise ValueError(f"Ожидается тип=бэкенд: {part.strip()}")
+        routes[task_type.strip()] = tier.strip()
+    return routes
+
+
+class BackendTier:
+    """
+    Бэкенд с ограничением одновременных вызовов, собственным предохранителем
+    и статистикой задержек, токенов и стоимости.
+    """
+
+    def __init__(self, name, backend, max_concurrency=2, breaker=None, cost_per_1k=0.0, window=200):
+        """
+        max_concurrency: сколько вызовов бэкенда выполняется одновременно (остальные ждут слота)
+        cost_per_1k: стоимость 1000 токенов (промпт + ответ) для оценки расходов
+        window: по скольким последним вызовам считаются перцентили задержки
+        """
+        self.name = name
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker or CircuitBreaker()
+        self.cost_per_1k = cost_per_1k
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.in_flight = 0
+        self.stats = {'calls': 0, 'errors': 0, 'rejected': 0, 'abandoned': 0, 'peak_in_flight': 0,
+                      'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'wait_total': 0.0}
+
+    def complete(self, prompt_data, timeout=None):
+        """
+        Вызов бэкенда, когда освободится слот (LLMTimeout, если слот не освободился за timeout).
+        Остаток timeout после ожидания слота передается бэкенду как таймаут запроса,
+        поэтому слот занят не дольше timeout, даже если ответа никто уже не ждет.
+        """
+        started = time.time()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise LLMTimeout(f"{self.name}: все {self.max_concurrency} слотов заняты")
+        called = time.time()
+        with self._lock:
+            self.in_flight += 1
+            self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self.in_flight)
+            self.stats['wait_total'] += called - started
+        try:
+            remaining = None if timeout is None else max(0.0, timeout - (called - started))
+            result = self.backend.complete(prompt_data, timeout=remaining)
+        except LLMError:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            self._slots.release()
+            with self._lock:
+                self.in_flight -= 1
+        self._record(prompt_data, result, time.time() - called)
+        return result
+
+    def abandon(self, count=1):
+        """Учет вызовов, ответа которых перестали ждать (они держат слот до своего таймаута)"""
+        with self._lock:
+            self.stats['abandoned'] += count
+
+    def _record(self, prompt_data, result, latency):
+        prompt_tokens = estimate_tokens(prompt_data.get('system_prompt')) + estimate_tokens(prompt_data.get('user_input'))
+        completion_tokens = estimate_tokens(result)
+        with self._lock:
+            self._latencies.append(latency)
+            self.stats['calls'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['completion_tokens'] += completion_tokens
+            self.stats['cost'] += (prompt_tokens + completion_tokens) / 1000 * self.cost_per_1k
+
+    def get_stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            calls = self.stats['calls']
+            stats = dict(self.stats, backend=self.backend.name, max_concurrency=self.max_concurrency,
+                         in_flight=self.in_flight, breaker=self.breaker.get_stats())
+        stats['cost'] = round(stats['cost'], 4)
+        wait_total = stats.pop('wait_total')
+        stats['avg_wait'] = round(wait_total / calls, 3) if calls else 0.0
+        if latencies:
+            stats['avg_latency'] = round(sum(latencies) / len(latencies), 3)
+            stats['p95_latency'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3)
+        return stats
+
+
+class BackendRouter:
+    """
+    Таблица "тип задачи -> бэкенд". Маршруты меняются на лету (set_routes),
+    задачи без маршрута идут в бэкенд default.
+    """
+
+    def __init__(self, tiers, routes=None, default='quality'):
+        """tiers - {имя: BackendTier}"""
+        self.tiers = dict(tiers)
+        if default not in self.tiers:
+            raise ValueError(f"Неизвестный бэкенд по умолчанию: {default}")
+        self.default = default
+        self.routes = {}
+        self._lock = threading.Lock()
+        self.set_routes(routes or {})
+
+    def tier_for(self, task_type):
+        with self._lock:
+            return self.tiers[self.routes.get(task_type, self.default)]
+
+    def set_routes(self, routes, replace=False):
+        """
+        Обновляет маршруты (replace=True - заменяет таблицу целиком).
+        Маршруты на неизвестные бэкенды пропускаются с предупреждением; возвращает итоговую таблицу.
+        """
+        accepted = {}
+        for task_type, tier in routes.items():
+            if tier in self.tiers:
+                accepted[task_type] = tier
+            else:
+                print(f"⚠️ Маршрут {task_type} -> {tier} пропущен: нет такого бэкенда ({', '.join(self.tiers)})")
+        with self._lock:
+            if replace:
+                self.routes = accepted
+            else:
+                self.routes.update(accepted)
+            return dict(self.routes)
+
+    def get_routes(self):
+        with self._lock:
+            return dict(self.routes)
+
+    def get_stats(self):
+        return {
+            'default': self.default,
+            'routes': self.get_routes(),
+            'tiers': {name: tier.get_stats() for name, tier in self.tiers.items()}
+        }
@@ -0,0 +1,237 @@
+# markov_generator.py - Локальный генератор реплик и мыслей: цепи Маркова по сохраненным диалогам
+
+import re
+import time
+import random
+import threading
+
+from models import Dialogue, AgentThought
+from llm_backends import canned_reply, GigaChatBackend
+
+START = '<s>'
+END = '</s>'
+NAME = '<NAME>'  # Имя собеседника: при обучении подставляется вместо имен агентов, при генерации - обратно
+
+_TOKEN = re.compile(r"<NAME>|\w+(?:[-']\w+)*|\.{2,}|[!?]+|[^\w\s]")
+_NO_SPACE_BEFORE = set('.,!?…:;)»%')
+_NO_SPACE_AFTER = set('(«')
+_SENTENCE_END = set('.!?…')
+
+
+def tokenize(text):
+    return _TOKEN.findall(text or '')
+
+
+def detokenize(tokens):
+    parts = []
+    for token in tokens:
+        if parts and token[0] not in _NO_SPACE_BEFORE and parts[-1] not in _NO_SPACE_AFTER:
+            parts.append(' ')
+        parts.append(token)
+    return ''.join(parts)
+
+
+class MarkovGenerator:
+    """
+    Цепи Маркова порядка order, обучаемые по одной фразе. Отдельные цепи ведутся для
+    каждого (вид текста, тип агента, настроение), а также для типа, настроения и вида в целом:
+    генерация берет самую узкую цепь, в которой достаточно фраз.
+    Переходы хранятся списками продолжений (не больше max_followers на состояние),
+    поэтому следующее слово выбирается одним random.choice.
+    """
+
+    def __init__(self, order=2, max_followers=50, min_samples=20, max_tokens=40, seed=None):
+        """
+        min_samples: сколько фраз нужно цепи, чтобы ею пользоваться
+        max_tokens: предельная длина сгенерированной фразы в токенах
+        """
+        self.order = order
+        self.max_followers = max_followers
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self._chains = {}  # (вид, тип, настроение) -> {состояние: [следующие токены]}
+        self._samples = {}  # тот же ключ -> число фраз
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()  # Обучение - из потока симуляции, генерация - из обработчиков очереди
+        self.max_ids = {}  # вид текста -> последний обученный id строки БД
+        self.stats = {'trained': 0, 'generated': 0, 'empty': 0, 'generate_time': 0.0}
+
+    def train(self, kind, text, agent_type=None, mood=None, names=()):
+        """Добавляет фразу; names - имена агентов, которые заменяются на обобщенное имя собеседника"""
+        for name in names:
+            if name:
+                text = text.replace(name, NAME)
+        tokens = tokenize(text)
+        if len(tokens) < 2:
+            return False
+        sequence = [START] * self.order + tokens + [END]
+        keys = {(kind, agent_type, mood), (kind, agent_type, None), (kind, None, mood), (kind, None, None)}
+        with self._lock:
+            for key in keys:
+                chain = self._chains.setdefault(key, {})
+                for i in range(len(sequence) - self.order):
+                    followers = chain.setdefault(tuple(sequence[i:i + self.order]), [])
+                    if len(followers) < self.max_followers:
+                        followers.append(sequence[i + self.order])
+                    else:
+                        # Заполненный список обновляется случайной заменой и продолжает отражать свежие фразы
+                        followers[self._rng.randrange(self.max_followers)] = sequence[i + self.order]
+                self._samples[key] = self._samples.get(key, 0) + 1
+            self.stats['trained'] += 1
+        return True
+
+    def _chain(self, kind, agent_type, mood):
+        for key in ((kind, agent_type, mood), (kind, agent_type, None), (kind, None, mood), (kind, None, None)):
+            if self._samples.get(key, 0) >= self.min_samples:
+                return self._chains[key]
+        return None
+
+    def ready(self, kind, agent_type=None, mood=None):
+        return self._chain(kind, agent_type, mood) is not None
+
+    def generate(self, kind, agent_type=None, mood=None, name=None, attempts=3):
+        """Фраза в стиле типа агента и настроения; None, если цепи для вида текста еще не обучены"""
+        started = time.perf_counter()
+        chain = self._chain(kind, agent_type, mood)
+        text = None
+        if chain is not None:
+            choice = self._rng.choice
+            best = []
+            for _ in range(attempts):
+                state = (START,) * self.order
+                tokens = []
+                while len(tokens) < self.max_tokens:
+                    followers = chain.get(state)
+                    if not followers:
+                        break
+                    token = choice(followers)
+                    if token == END:
+                        break
+                    tokens.append(token)
+                    state = state[1:] + (token,)
+                if len(tokens) > len(best):
+                    best = tokens
+                # Слишком короткие фразы пробуем сгенерировать заново
+                if len(best) >= 3:
+                    break
+            if best:
+                if best[-1][-1] not in _SENTENCE_END:
+                    best.append('.')
+                text = detokenize((name or 'друг') if token == NAME else token for token in best)
+                text = text[0].upper() + text[1:]
+        self.stats['generated' if text else 'empty'] += 1
+        self.stats['generate_time'] += time.perf_counter() - started
+        return text
+
+    def get_stats(self):
+        with self._lock:
+            states = sum(len(chain) for chain in self._chains.values())
+            chains = len(self._chains)
+        calls = self.stats['generated'] + self.stats['empty']
+        return {
+            'trained': self.stats['trained'],
+            'generated': self.stats['generated'],
+            'empty': self.stats['empty'],
+            'chains': chains,
+            'states': states,
+            'avg_generate_ms': round(self.stats['generate_time'] / calls * 1000, 4) if calls else 0.0,
+            'max_ids': dict(self.max_ids)
+        }
+
+
+class MarkovBackend:
+    """
+    Бэкенд генерации без сети на MarkovGenerator: реплики по обученным диалогам, мысли - по мыслям агентов.
+    Пока цепи не обучены (или для резюме) отвечает заготовками canned_reply.
+    """
+    name = 'markov'
+
+    def __init__(self, model):
+        self.model = model
+
+    def _say(self, kind, agent_type, mood, name=None):
+        return self.model.generate(kind, agent_type, mood, name=name)
+
+    def complete(self, prompt_data, timeout=None):
+        prompt_type = prompt_data.get('type')
+        context = prompt_data.get('context', {})
+        text = None
+
+        if prompt_type in ('response', 'first_message'):
+            text = self._say('dialogue', context.get('agent_type'), context.get('agent_mood'), context.get('other_name'))
+
+        elif prompt_type in ('human_response', 'opener'):
+            # Имя человека в репликах агентов не встречалось - обращение обобщенное
+            text = self._say('dialogue', context.get('agent_type'), context.get('agent_mood'))
+
+        elif prompt_type == 'reflection':
+            text = self._say('thought', context.get('agent_type'), context.get('agent_mood'))
+
+        elif prompt_type == 'reflection_batch':
+            lines = []
+            for part in context.get('parts', []):
+                single = part['single'].get('context', {})
+                thought = self._say('thought', single.get('agent_type'), single.get('agent_mood'))
+                if thought:
+                    lines.append(f"{part['agent_name']}: {thought}")
+            text = "\n".join(lines) if lines else None
+
+        elif prompt_type == 'exchange':
+            speakers = [
+                (context.get('agent_name', 'Агент'), context.get('agent_type'), context.get('agent_mood')),
+                (context.get('other_name', 'Друг'), context.get('other_type'), context.get('other_mood'))
+            ]
+            lines = []
+            for i in range(context.get('turns', 4)):
+                name, agent_type, mood = speakers[i % 2]
+                reply = self._say('dialogue', agent_type, mood, speakers[(i + 1) % 2][0])
+                if not reply:
+                    break
+                lines.append(f"{name}: {reply}")
+            text = "\n".join(lines) if lines else None
+
+        elif prompt_type == 'group_turn':
+            names = [n for n in context.get('names', []) if n != context.get('last_speaker')]
+            if names:
+                speaker = random.choice(names)
+                agent_type, mood = (context.get('styles') or {}).get(speaker, (None, None))
+                reply = self._say('dialogue', agent_type, mood, context.get('last_speaker') or 'друзья')
+                text = f"{speaker}: {reply}" if reply else None
+
+        return text or canned_reply(prompt_data)
+
+
+def train_new_rows(model, agents, limit=500):
+    """
+    Обучает генератор на новых репликах и мыслях (нужен контекст приложения).
+    agents - текущие агенты: тип и настроение автора берутся на момент обучения,
+    поэтому обучать стоит вскоре после записи строк. Возвращает число прочитанных строк.
+    Учится только на текстах провайдера (source 'gigachat...'): реплики эмуляции, самого
+    генератора и строки неизвестного происхождения пропускаются, чтобы он не учился на себе.
+    """
+    styles = {agent.id: (agent.type, agent.mood) for agent in agents}
+    names = sorted((agent.name for agent in agents), key=len, reverse=True)
+    read = 0
+
+    dialogues = Dialogue.query.filter(
+        (Dialogue.id > model.max_ids.get('dialogue', 0)) &
+        Dialogue.dialogue_type.in_(('ai_response', 'group')) &
+        Dialogue.source.startswith(GigaChatBackend.name)
+    ).order_by(Dialogue.id.asc()).limit(limit).all()
+    for d in dialogues:
+        agent_type, mood = styles.get(d.agent1_id, (None, None))
+        model.train('dialogue', d.message, agent_type, mood, names)
+        model.max_ids['dialogue'] = d.id
+    read += len(dialogues)
+
+    thoughts = AgentThought.query.filter(
+        (AgentThought.id > model.max_ids.get('thought', 0)) &
+        AgentThought.source.startswith(GigaChatBackend.name)
+    ).order_by(AgentThought.id.asc()).limit(limit).all()
+    for t in thoughts:
+        agent_type, mood = styles.get(t.agent_id, (None, None))
+        model.train('thought', t.thought, agent_type, mood, names)
+        model.max_ids['thought'] = t.id
+    read += len(thoughts)
+
+    return read
@@ -0,0 +1,235 @@
+# memory_store.py - Ограниченное хранилище воспоминаний агентов
+
+import re
+import math
+import time
+import heapq
+import threading
+from datetime import datetime
+
+from models import db, AgentMemory
+
+_DIGITS = re.compile(r'\d+')
+_WORDS = re.compile(r'\w{3,}')
+
+
+def memory_key(memory_type, content):
+    """Ключ для слияния повторяющихся наблюдений (числа не различаются)"""
+    return (memory_type, _DIGITS.sub('#', content or '').strip().lower())
+
+
+def text_terms(text):
+    """Грубые основы слов для оценки релевантности (первые 5 букв слова)"""
+    return {word[:5] for word in _WORDS.findall((text or '').lower()) if not word.isdigit()}
+
+
+class _MemoryRecord:
+    """Легкая копия строки AgentMemory для выборки без запросов к БД"""
+    __slots__ = ('id', 'memory_type', 'content', 'significance', 'occurrences', 'timestamp', 'last_seen', 'terms')
+
+    def __init__(self, memory_id, memory_type, content, significance, occurrences, timestamp, last_seen):
+        self.id = memory_id
+        self.memory_type = memory_type
+        self.content = content
+        self.significance = significance
+        self.occurrences = occurrences
+        self.timestamp = timestamp
+        self.last_seen = last_seen
+        self.terms = text_terms(content)
+
+
+class MemoryStore:
+    """
+    Воспоминания агента с бюджетом: повторы сливаются в одну строку со счетчиком,
+    а при переполнении вытесняются наименее значимые и самые старые.
+    """
+
+    def __init__(self, budget=100, slack=0.2, half_life_hours=24.0):
+        """
+        budget: максимум воспоминаний на агента после уплотнения
+        slack: доля сверх бюджета, после которой агент попадает в очередь на уплотнение
+        half_life_hours: период полураспада вклада давности в оценку
+        """
+        self.budget = budget
+        self.limit = int(budget * (1 + slack))
+        self.half_life_hours = half_life_hours
+
+        self._keys = {}  # agent_id -> {ключ: id воспоминания}
+        self._records = {}  # agent_id -> {id воспоминания: _MemoryRecord} для выборки top-k
+        self._counts = {}  # agent_id -> число строк
+        self._overflow = set()  # агенты, превысившие лимит
+        self._dirty = set()  # агенты, чьи строки изменены после последнего commit
+        self._lock = threading.Lock()
+        self.stats = {'inserted': 0, 'merged': 0, 'evicted': 0, 'recalls': 0, 'recall_avg_ms': 0.0}
+
+    def score(self, memory, now=None):
+        """Оценка ценности воспоминания: значимость, давность и число повторов"""
+        now = now or datetime.utcnow()
+        seen = memory.last_seen or memory.timestamp or now
+        age_hours = max(0.0, (now - seen).total_seconds() / 3600.0)
+        recency = 0.5 ** (age_hours / self.half_life_hours)
+        repeats = min(1.0, math.log1p(memory.occurrences or 1) / math.log(10))
+        return 0.6 * (memory.significance or 0.0) + 0.3 * recency + 0.1 * repeats
+
+    def _load_agent(self, agent_id):
+        if agent_id in self._keys:
+            return self._keys[agent_id]
+        keys = {}
+        records = {}
+        rows = db.session.query(
+            AgentMemory.id, AgentMemory.memory_type, AgentMemory.content, AgentMemory.significance,
+            AgentMemory.occurrences, AgentMemory.timestamp, AgentMemory.last_seen
+        ).filter(AgentMemory.agent_id == agent_id).all()
+        for row in rows:
+            keys[memory_key(row[1], row[2])] = row[0]
+            records[row[0]] = _MemoryRecord(*row)
+        self._keys[agent_id] = keys
+        self._records[agent_id] = records
+        self._counts[agent_id] = len(rows)
+        if len(rows) > self.limit:
+            self._overflow.add(agent_id)
+        return keys
+
+    def remember(self, agent_id, memory_type, content, significance):
+        """Добавляет воспоминание или усиливает уже существующее (без commit)"""
+        now = datetime.utcnow()
+        with self._lock:
+            keys = self._load_agent(agent_id)
+            self._dirty.add(agent_id)
+            key = memory_key(memory_type, content)
+            memory_id = keys.get(key)
+            memory = db.session.get(AgentMemory, memory_id) if memory_id else None
+
+            if memory:
+                memory.occurrences = (memory.occurrences or 1) + 1
+                memory.significance = max(memory.significance or 0.0, significance)
+                memory.content = content
+                memory.last_seen = now
+                self._records[agent_id][memory.id] = self._record_of(memory)
+                self.stats['merged'] += 1
+                return memory
+
+            memory = AgentMemory(
+                agent_id=agent_id,
+                memory_type=memory_type,
+                content=content,
+                significance=significance,
+                occurrences=1,
+                timestamp=now,
+                last_seen=now
+            )
+            db.session.add(memory)
+            db.session.flush()
+            keys[key] = memory.id
+            self._records[agent_id][memory.id] = self._record_of(memory)
+            self._counts[agent_id] += 1
+            if self._counts[agent_id] > self.limit:
+                self._overflow.add(agent_id)
+            self.stats['inserted'] += 1
+            return memory
+
+    def compact(self, agent_ids=None):
+        """
+        Уплотнение: слияние дубликатов и вытеснение до бюджета (без commit).
+        agent_ids=None - только агенты, превысившие лимит.
+        """
+        with self._lock:
+            targets = set(agent_ids) if agent_ids is not None else set(self._overflow)
+            evicted = 0
+            now = datetime.utcnow()
+            for agent_id in targets:
+                self._dirty.add(agent_id)
+                memories = AgentMemory.query.filter_by(agent_id=agent_id).all()
+
+                # Слияние дубликатов (остались от старых версий без счетчика)
+                merged = {}
+                for memory in memories:
+                    key = memory_key(memory.memory_type, memory.content)
+                    keep = merged.get(key)
+                    if keep is None:
+                        merged[key] = memory
+                        continue
+                    newer, older = (memory, keep) if (memory.last_seen or memory.timestamp) > (keep.last_seen or keep.timestamp) else (keep, memory)
+                    newer.occurrences = (newer.occurrences or 1) + (older.occurrences or 1)
+                    newer.significance = max(newer.significance or 0.0, older.significance or 0.0)
+                    merged[key] = newer
+                    db.session.delete(older)
+                    evicted += 1
+
+                # Вытеснение наименее ценных сверх бюджета
+                survivors = sorted(merged.values(), key=lambda m: self.score(m, now), reverse=True)
+                for memory in survivors[self.budget:]:
+                    db.session.delete(memory)
+                    evicted += 1
+                kept = survivors[:self.budget]
+
+                self._keys[agent_id] = {memory_key(m.memory_type, m.content): m.id for m in kept}
+                self._records[agent_id] = {m.id: self._record_of(m) for m in kept}
+                self._counts[agent_id] = len(kept)
+                self._overflow.discard(agent_id)
+
+            self.stats['evicted'] += evicted
+            return evicted
+
+    def _record_of(self, memory):
+        return _MemoryRecord(
+            memory.id, memory.memory_type, memory.content, memory.significance,
+            memory.occurrences, memory.timestamp, memory.last_seen
+        )
+
+    def recall(self, agent_id, query=None, k=3):
+        """
+        Top-k воспоминаний агента по совокупности значимости, давности и релевантности запросу.
+        Работает по индексу в памяти: после первой загрузки агента запросов к БД нет.
+        """
+        started = time.perf_counter()
+        with self._lock:
+            self._load_agent(agent_id)
+            records = list(self._records[agent_id].values())
+
+        now = datetime.utcnow()
+        query_terms = text_terms(query) if query else None
+
+        def combined(record):
+            value = self.score(record, now)
+            if query_terms and record.terms:
+                overlap = len(query_terms & record.terms) / float(len(query_terms | record.terms))
+                value += 0.5 * overlap
+            return value
+
+        best = heapq.nlargest(k, records, key=combined)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats['recalls'] += 1
+        self.stats['recall_avg_ms'] = 0.9 * self.stats['recall_avg_ms'] + 0.1 * elapsed_ms
+        return [record.content for record in best]
+
+    def compact_all(self):
+        """Полное уплотнение всех агентов (при запуске, для уже накопленных таблиц)"""
+        agent_ids = [row[0] for row in db.session.query(AgentMemory.agent_id).distinct().all()]
+        return self.compact(agent_ids)
+
+    def forget_agent(self, agent_id):
+        with self._lock:
+            self._keys.pop(agent_id, None)
+            self._records.pop(agent_id, None)
+            self._counts.pop(agent_id, None)
+            self._overflow.discard(agent_id)
+
+    def committed(self):
+        """Изменения записаны в БД - индекс в памяти им соответствует"""
+        with self._lock:
+            self._dirty.clear()
+
+    def rolled_back(self):
+        """Транзакция откатилась: индекс агентов, измененных после commit, перечитывается из БД"""
+        with self._lock:
+            agent_ids, self._dirty = self._dirty, set()
+        for agent_id in agent_ids:
+            self.forget_agent(agent_id)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['agents_over_limit'] = len(self._overflow)
+        stats['budget'] = self.budget
+        return stats
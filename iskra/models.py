@@ -60,7 +60,13 @@ class AgentMemory(db.Model):
     memory_type = db.Column(db.String(50))
     content = db.Column(db.Text)
     significance = db.Column(db.Float, default=0.5)
+    occurrences = db.Column(db.Integer, default=1)  # Сколько раз наблюдение повторялось
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow)  # Последнее повторение
+    
+    __table_args__ = (
+        db.Index('ix_agent_memory_agent_last_seen', 'agent_id', 'last_seen'),
+    )
     
     # Relationship
     agent = db.relationship('Agent', backref=db.backref('memories', lazy=True))
@@ -79,7 +85,9 @@ class Dialogue(db.Model):
     response = db.Column(db.Text)  # Новое поле для ответа
     response_id = db.Column(db.Integer)  # ID ответного сообщения
     response_to = db.Column(db.Integer)  # ID сообщения, на которое отвечаем
+    conversation_id = db.Column(db.String(100), index=True)  # Групповой разговор (у парных диалогов - None)
     dialogue_type = db.Column(db.String(50))
+    source = db.Column(db.String(100))  # Бэкенд, написавший реплику (None - неизвестно или заготовка)
     world_cycle = db.Column(db.Integer)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -99,6 +107,7 @@ class UserAgentChat(db.Model):
     response = db.Column(db.Text)
     sender_type = db.Column(db.String(20))  # 'user' или 'agent'
     conversation_id = db.Column(db.String(100))  # для группировки сообщений в диалоге
+    task_id = db.Column(db.String(100))  # задача GigaChat, генерирующая ответ
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     response_received = db.Column(db.Boolean, default=False)
     
@@ -113,6 +122,7 @@ class AgentThought(db.Model):
     agent_name = db.Column(db.String(100))
     thought = db.Column(db.Text)
     thought_type = db.Column(db.String(50))
+    source = db.Column(db.String(100))  # Бэкенд, написавший мысль (None - неизвестно)
     world_cycle = db.Column(db.Integer)
     significance = db.Column(db.Float, default=0.5)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -144,4 +154,68 @@ class Event(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
-        return f'<Event {self.id}>'
\ No newline at end of file
+        return f'<Event {self.id}>'
+
+class WorldLogEntry(db.Model):
+    """Дельта состояния мира за один цикл (сжатый JSON)"""
+    __tablename__ = 'world_log'
+    id = db.Column(db.Integer, primary_key=True)
+    cycle = db.Column(db.Integer, index=True, nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<WorldLogEntry cycle={self.cycle}>'
+
+class WorldSnapshot(db.Model):
+    """Полный снимок состояния мира (сжатый JSON)"""
+    __tablename__ = 'world_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    cycle = db.Column(db.Integer, index=True, unique=True, nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<WorldSnapshot cycle={self.cycle}>'
+
+
+# Колонки и индексы, добавленные в модели после первых версий: db.create_all() не меняет
+# существующие таблицы, поэтому базы прежних версий дополняются при запуске (upgrade_schema)
+# таблица -> [(колонка, тип, SQL заполнения старых строк или None)]
+SCHEMA_COLUMNS = {
+    'agent_memory': [
+        ('occurrences', 'INTEGER DEFAULT 1', None),
+        ('last_seen', 'DATETIME', "UPDATE agent_memory SET last_seen = timestamp WHERE last_seen IS NULL"),
+    ],
+    'user_agent_chat': [
+        ('task_id', 'VARCHAR(100)', None),
+    ],
+    'dialogue': [
+        ('conversation_id', 'VARCHAR(100)', None),
+        ('source', 'VARCHAR(100)', None),
+    ],
+    'agent_thought': [
+        ('source', 'VARCHAR(100)', None),
+    ],
+}
+# (имя индекса, таблица, колонки)
+SCHEMA_INDEXES = [
+    ('ix_agent_memory_agent_last_seen', 'agent_memory', 'agent_id, last_seen'),
+    ('ix_dialogue_conversation_id', 'dialogue', 'conversation_id'),
+]
+
+def upgrade_schema():
+    """Добавляет недостающие колонки и индексы (вызывается после db.create_all(), нужен контекст приложения)"""
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table, columns in SCHEMA_COLUMNS.items():
+            existing = {column['name'] for column in inspector.get_columns(table)}
+            for column, kind, backfill in columns:
+                if column in existing:
+                    continue
+                conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+                if backfill:
+                    conn.exec_driver_sql(backfill)
+                print(f"🔧 Схема БД обновлена: {table}.{column}")
+        for name, table, columns in SCHEMA_INDEXES:
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
@@ -0,0 +1,111 @@
+# presence.py - Эфемерные индикаторы "печатает..." и "ожидание" (только память, без БД)
+
+import os
+import json
+import time
+import threading
+
+
+class PresenceStore:
+    """
+    Кто из агентов сейчас печатает ответ или ждет GigaChat.
+    Записи живут до явного снятия или до истечения ttl; каждое изменение увеличивает version,
+    и подписчики (SSE) просыпаются без опроса. В режиме отдельного процесса симуляции
+    снимок дублируется в файл mirror_path для веб-воркеров.
+    """
+
+    def __init__(self, ttl=60, mirror_path=None):
+        self.ttl = ttl
+        self.mirror_path = mirror_path
+        self.version = 0
+        self._items = {}  # ключ (обычно task_id) -> запись
+        self._changed = threading.Condition()
+        self.stats = {'set': 0, 'cleared': 0, 'expired': 0}
+
+    def set(self, key, state, agent_name, target_name=None, ttl=None, **info):
+        """state: 'typing' (печатает ответ) или 'pending' (ждет генерации сообщения)"""
+        now = time.time()
+        with self._changed:
+            self._items[key] = dict(
+                info,
+                state=state,
+                agent=agent_name,
+                target=target_name,
+                since=now,
+                expires=now + (ttl or self.ttl)
+            )
+            self.stats['set'] += 1
+            self._bump()
+
+    def clear(self, key):
+        with self._changed:
+            if self._items.pop(key, None) is None:
+                return False
+            self.stats['cleared'] += 1
+            self._bump()
+            return True
+
+    def _expire(self, now):
+        expired = [key for key, item in self._items.items() if item['expires'] <= now]
+        for key in expired:
+            del self._items[key]
+        if expired:
+            self.stats['expired'] += len(expired)
+            self._bump()
+
+    def _bump(self):
+        self.version += 1
+        self._changed.notify_all()
+        if self.mirror_path:
+            self._write_mirror()
+
+    def _snapshot(self):
+        items = sorted(self._items.values(), key=lambda item: item['since'])
+        return {'version': self.version, 'items': [dict(item) for item in items]}
+
+    def snapshot(self):
+        """Текущие индикаторы: {'version', 'items'}"""
+        with self._changed:
+            self._expire(time.time())
+            return self._snapshot()
+
+    def wait(self, version, timeout):
+        """Ждет изменения после version (до timeout секунд) и возвращает снимок"""
+        deadline = time.time() + timeout
+        with self._changed:
+            while True:
+                now = time.time()
+                self._expire(now)
+                if self.version != version or now >= deadline:
+                    return self._snapshot()
+                # Просыпаемся и к ближайшему истечению записи
+                wake = min([deadline] + [item['expires'] for item in self._items.values()])
+                self._changed.wait(max(0.05, wake - now))
+
+    def _write_mirror(self):
+        tmp_path = self.mirror_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._snapshot(), f, ensure_ascii=False)
+            os.replace(tmp_path, self.mirror_path)
+        except OSError as e:
+            print(f"❌ Не удалось записать индикаторы присутствия: {e}")
+
+    @staticmethod
+    def read_mirror(path):
+        """Снимок, записанный другим процессом (просроченные записи отбрасываются); None, если файла нет"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        snapshot['items'] = [item for item in snapshot.get('items', []) if item.get('expires', 0) > now]
+        return snapshot
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_stats(self):
+        with self._changed:
+            return dict(self.stats, active=len(self._items), version=self.version)
@@ -0,0 +1,119 @@
+# prompt_builder.py - Сборка промптов с бюджетом токенов и учетом размеров
+
+import re
+import threading
+
+_TOKENS = re.compile(r'\w+|[^\w\s]')
+
+
+def estimate_tokens(text):
+    """
+    Локальная оценка числа токенов без токенизатора модели:
+    слово - примерно 1 токен на каждые 4 символа, знак препинания - 1 токен.
+    """
+    if not text:
+        return 0
+    total = 0
+    for token in _TOKENS.findall(text):
+        total += (len(token) + 3) // 4 if token[0].isalnum() or token[0] == '_' else 1
+    return total
+
+
+def static_section(text):
+    """Неизменяемая часть промпта: текст и число токенов считаются один раз"""
+    return {'text': text, 'tokens': estimate_tokens(text)}
+
+
+def lines_section(header, lines, trim=None, bullet=''):
+    """
+    Часть промпта из строк (история, воспоминания и т.п.).
+    trim - приоритет урезания: меньшее значение урезается первым (None - не урезается).
+    """
+    return {'header': header, 'lines': [f"{bullet}{line}" for line in lines], 'trim': trim}
+
+
+class PromptBuilder:
+    """Собирает промпт из частей и укладывает его в бюджет токенов для типа задачи"""
+
+    def __init__(self, budgets, default_budget=800):
+        self.budgets = budgets
+        self.default_budget = default_budget
+
+    def _render(self, section):
+        if 'text' in section:
+            return section['text']
+        if not section['lines']:
+            return ""
+        return section['header'] + "\n" + "\n".join(section['lines']) + "\n"
+
+    def _tokens(self, section):
+        if 'tokens' in section:
+            return section['tokens']
+        return estimate_tokens(self._render(section))
+
+    def build(self, task_type, sections, reserved=0):
+        """
+        Возвращает (текст, оценка токенов, число удаленных строк).
+        reserved - токены, уже занятые другими частями запроса (например, пользовательским вводом).
+        При превышении бюджета сначала удаляются самые старые строки частей с наименьшим trim.
+        """
+        budget = self.budgets.get(task_type, self.default_budget) - reserved
+        sections = [dict(s, lines=list(s['lines'])) if 'lines' in s else s for s in sections]
+        sizes = [self._tokens(s) for s in sections]
+        total = sum(sizes)
+        trimmed = 0
+
+        while total > budget:
+            candidates = [i for i, s in enumerate(sections) if s.get('trim') is not None and s['lines']]
+            if not candidates:
+                break
+            index = min(candidates, key=lambda i: sections[i]['trim'])
+            sections[index]['lines'].pop(0)
+            trimmed += 1
+            new_size = self._tokens(sections[index])
+            total += new_size - sizes[index]
+            sizes[index] = new_size
+
+        text = "\n".join(part for part in (self._render(s) for s in sections) if part)
+        return text, total, trimmed
+
+
+class PromptStats:
+    """Размеры промптов и ответов по типам задач"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, task_type, prompt_tokens, completion_tokens, latency, trimmed=0, success=True):
+        with self._lock:
+            stats = self._stats.setdefault(task_type, {
+                'requests': 0,
+                'failures': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'max_prompt_tokens': 0,
+                'trimmed_lines': 0,
+                'latency_total': 0.0
+            })
+            stats['requests'] += 1
+            if not success:
+                stats['failures'] += 1
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+            stats['max_prompt_tokens'] = max(stats['max_prompt_tokens'], prompt_tokens)
+            stats['trimmed_lines'] += trimmed
+            stats['latency_total'] += latency
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for task_type, stats in self._stats.items():
+                requests = stats['requests'] or 1
+                result[task_type] = dict(
+                    stats,
+                    avg_prompt_tokens=round(stats['prompt_tokens'] / requests, 1),
+                    avg_completion_tokens=round(stats['completion_tokens'] / requests, 1),
+                    avg_latency=round(stats['latency_total'] / requests, 3)
+                )
+            return result
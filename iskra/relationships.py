@@ -0,0 +1,181 @@
+# relationships.py - Кэш отношений между агентами в памяти
+
+import time
+import heapq
+import threading
+
+from models import db, Relationship
+
+# NumPy ускоряет выборку top-k, но не обязателен
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+class RelationshipMatrix:
+    """
+    Разреженная матрица отношений, индексированная целыми номерами агентов.
+    Обновления O(1) в памяти, запись в таблицу relationship - пачкой через flush();
+    пары перестают считаться измененными только после committed() (после commit транзакции).
+    """
+
+    def __init__(self):
+        self._index = {}  # имя агента -> номер
+        self._names = []  # номер -> имя агента
+        self._values = {}  # (i, j), i < j -> значение отношения
+        self._neighbors = {}  # i -> {j: значение} для быстрых запросов соседей
+        self._row_ids = {}  # (i, j) -> id строки в таблице relationship
+        self._dirty = set()  # пары, не записанные в БД окончательно (до committed())
+        self._flushed = {}  # пара -> значение, записанное flush() в текущую транзакцию
+        self._pending_ids = {}  # пара -> id строки, вставленной в текущей транзакции
+        self._lock = threading.RLock()
+        self.loaded_at = None
+
+    def _index_of(self, name):
+        index = self._index.get(name)
+        if index is None:
+            index = len(self._names)
+            self._index[name] = index
+            self._names.append(name)
+        return index
+
+    def _key(self, name1, name2):
+        i, j = self._index_of(name1), self._index_of(name2)
+        return (i, j) if i < j else (j, i)
+
+    def _set(self, key, value):
+        i, j = key
+        self._values[key] = value
+        self._neighbors.setdefault(i, {})[j] = value
+        self._neighbors.setdefault(j, {})[i] = value
+
+    def load(self):
+        """Загружает все отношения из БД (нужен контекст приложения)"""
+        with self._lock:
+            self._values.clear()
+            self._neighbors.clear()
+            self._row_ids.clear()
+            self._dirty.clear()
+            self._flushed.clear()
+            self._pending_ids.clear()
+            for rel in Relationship.query.all():
+                key = self._key(rel.agent1, rel.agent2)
+                self._set(key, rel.relationship_value)
+                self._row_ids[key] = rel.id
+            self.loaded_at = time.time()
+
+    def refresh(self, max_age):
+        """Перезагружает кэш из БД, если он старше max_age секунд (для веб-воркеров)"""
+        if self.loaded_at is None or time.time() - self.loaded_at > max_age:
+            self.load()
+
+    def get(self, name1, name2):
+        with self._lock:
+            return self._values.get(self._key(name1, name2), 0.0)
+
+    def update(self, name1, name2, change):
+        """Изменяет отношение на change с ограничением [-1, 1]"""
+        with self._lock:
+            key = self._key(name1, name2)
+            value = max(-1.0, min(1.0, self._values.get(key, 0.0) + change))
+            self._set(key, value)
+            self._dirty.add(key)
+            return value
+
+    def decay(self, factor):
+        """Пакетное затухание всех отношений к нейтральному значению"""
+        with self._lock:
+            for key, value in self._values.items():
+                decayed = value * factor
+                if decayed != value:
+                    self._set(key, decayed)
+                    self._dirty.add(key)
+
+    def top_k(self, name, k=5):
+        """k самых близких агентов для name: список (имя, значение) по убыванию"""
+        with self._lock:
+            index = self._index.get(name)
+            if index is None or index not in self._neighbors:
+                return []
+            neighbors = self._neighbors[index]
+            ids = list(neighbors.keys())
+            if NUMPY_AVAILABLE and len(ids) > k:
+                values = np.fromiter(neighbors.values(), dtype=float, count=len(ids))
+                top = np.argpartition(-values, k)[:k]
+                best = sorted(((ids[t], float(values[t])) for t in top), key=lambda p: -p[1])
+            else:
+                best = heapq.nlargest(k, neighbors.items(), key=lambda p: p[1])
+            return [(self._names[j], value) for j, value in best]
+
+    def links(self):
+        """Все связи для графа: список словарей source/target/value"""
+        with self._lock:
+            links = []
+            for (i, j), value in self._values.items():
+                source, target = sorted([self._names[i], self._names[j]])
+                links.append({'source': source, 'target': target, 'value': value})
+            return links
+
+    def as_pairs(self):
+        """Отношения в виде {'имя1|имя2': значение} (имена отсортированы)"""
+        with self._lock:
+            pairs = {}
+            for (i, j), value in self._values.items():
+                name1, name2 = sorted([self._names[i], self._names[j]])
+                pairs[f"{name1}|{name2}"] = value
+            return pairs
+
+    def __len__(self):
+        return len(self._values)
+
+    def flush(self):
+        """
+        Пакетная запись измененных отношений в таблицу relationship (без commit).
+        После db.session.commit() нужно вызвать committed(), после rollback() - rolled_back().
+        """
+        with self._lock:
+            if not self._dirty:
+                return 0
+            updates = []
+            inserts = []
+            new_keys = []
+            for key in self._dirty:
+                value = self._values[key]
+                self._flushed[key] = value
+                # Строка могла быть вставлена прошлым flush() в этой же транзакции
+                row_id = self._row_ids.get(key) or self._pending_ids.get(key)
+                if row_id is not None:
+                    updates.append({'id': row_id, 'relationship_value': value})
+                else:
+                    name1, name2 = sorted([self._names[key[0]], self._names[key[1]]])
+                    inserts.append({'agent1': name1, 'agent2': name2, 'relationship_value': value})
+                    new_keys.append(key)
+            count = len(self._dirty)
+
+        if updates:
+            db.session.bulk_update_mappings(Relationship, updates)
+        if inserts:
+            db.session.bulk_insert_mappings(Relationship, inserts, return_defaults=True)
+            with self._lock:
+                for key, row in zip(new_keys, inserts):
+                    self._pending_ids[key] = row.get('id')
+        return count
+
+    def committed(self):
+        """Транзакция с записанными flush() отношениями сохранена: пары больше не требуют записи"""
+        with self._lock:
+            self._row_ids.update(self._pending_ids)
+            for key, value in self._flushed.items():
+                # Пара, измененная после flush(), остается в очереди на запись
+                if self._values.get(key) == value:
+                    self._dirty.discard(key)
+            self._flushed.clear()
+            self._pending_ids.clear()
+
+    def rolled_back(self):
+        """Транзакция откачена: вставленных строк нет, пары будут записаны следующим flush()"""
+        with self._lock:
+            self._flushed.clear()
+            self._pending_ids.clear()
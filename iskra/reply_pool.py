@@ -0,0 +1,97 @@
+# reply_pool.py - Заранее сгенерированные приветствия агентов для первых ответов людям
+
+import re
+import time
+import threading
+from collections import deque
+
+# Сообщение, на которое уместно ответить готовым приветствием
+_GREETING = re.compile(
+    r'^\W*(привет\w*|здравствуй\w*|здорово|хай|салют|добр\w+\s+(утро|день|вечер)|йо|hi|hello|hey)\b',
+    re.IGNORECASE
+)
+
+
+def is_greeting(message):
+    """Короткое приветствие без вопроса по существу"""
+    text = (message or '').strip()
+    return bool(_GREETING.match(text)) and len(text.split()) <= 6
+
+
+class ReplyPool:
+    """
+    Готовые приветствия агентов, сгенерированные, пока очередь GigaChat простаивает.
+    Запас ведется отдельно для каждого (агент, настроение, тип): настроение агентов меняется
+    почти каждый цикл, и приветствие выдается, только когда агент снова в том настроении,
+    в котором его написал. Приветствия старше max_age и запасы прежнего типа агента сбрасываются.
+    """
+
+    def __init__(self, size=2, max_age=900):
+        """size - приветствий в запасе на каждое настроение агента"""
+        self.size = size
+        self.max_age = max_age
+        self._pools = {}  # (agent_id, настроение, тип) -> deque((время, текст))
+        self._in_flight = {}  # тот же ключ -> запрошено, но еще не получено
+        self._lock = threading.Lock()
+        self.stats = {'generated': 0, 'served': 0, 'misses': 0, 'invalidated': 0}
+
+    def _replies(self, key):
+        replies = self._pools.setdefault(key, deque())
+        now = time.time()
+        while replies and now - replies[0][0] > self.max_age:
+            replies.popleft()
+            self.stats['invalidated'] += 1
+        return replies
+
+    def deficit(self, agent):
+        """Сколько приветствий не хватает агенту в текущем настроении (с учетом уже запрошенных)"""
+        key = (agent.id, agent.mood, agent.type)
+        with self._lock:
+            return max(0, self.size - len(self._replies(key)) - self._in_flight.get(key, 0))
+
+    def reserve(self, agent_id, mood, agent_type):
+        key = (agent_id, mood, agent_type)
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def release(self, agent_id, mood, agent_type):
+        key = (agent_id, mood, agent_type)
+        with self._lock:
+            count = self._in_flight.get(key, 0) - 1
+            if count > 0:
+                self._in_flight[key] = count
+            else:
+                self._in_flight.pop(key, None)
+
+    def add(self, agent_id, mood, agent_type, text):
+        """Готовое приветствие для настроения, в котором оно запрашивалось"""
+        self.release(agent_id, mood, agent_type)
+        if not text:
+            return False
+        with self._lock:
+            self._replies((agent_id, mood, agent_type)).append((time.time(), text))
+            self.stats['generated'] += 1
+            return True
+
+    def take(self, agent):
+        """Свежее приветствие под текущее настроение агента (None, если запас пуст)"""
+        with self._lock:
+            replies = self._replies((agent.id, agent.mood, agent.type))
+            if not replies:
+                self.stats['misses'] += 1
+                return None
+            self.stats['served'] += 1
+            return replies.popleft()[1]
+
+    def sync(self, agents):
+        """Сбрасывает запасы исчезнувших агентов и запасы, написанные для прежнего типа агента"""
+        types = {agent.id: agent.type for agent in agents}
+        with self._lock:
+            for key in list(self._pools):
+                if types.get(key[0]) != key[2]:
+                    self.stats['invalidated'] += len(self._pools.pop(key))
+
+    def get_stats(self):
+        with self._lock:
+            ready = sum(len(replies) for replies in self._pools.values())
+            return dict(self.stats, ready=ready, in_flight=sum(self._in_flight.values()), size=self.size)
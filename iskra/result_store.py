@@ -0,0 +1,97 @@
+# result_store.py - Ограниченное хранилище результатов задач GigaChat
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class ResultStore:
+    """
+    Результаты задач с временем жизни и ограничением размера.
+    Невостребованные результаты вытесняются, так что память не растет со временем работы.
+    """
+
+    def __init__(self, ttl=300, max_size=1000, orphan_grace=30):
+        """
+        ttl: сколько секунд хранится результат, который никто не забрал
+        max_size: максимум результатов (при переполнении вытесняются самые старые)
+        orphan_grace: через сколько секунд результат без ожидающего считается брошенным
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.orphan_grace = orphan_grace
+        self._items = OrderedDict()  # task_id -> (время сохранения, результат) в порядке сохранения
+        self._ready = threading.Condition()
+        self.stats = {'stored': 0, 'delivered': 0, 'expired': 0, 'evicted': 0, 'orphaned': 0}
+
+    def put(self, task_id, value):
+        with self._ready:
+            self._items.pop(task_id, None)
+            self._items[task_id] = (time.time(), value)
+            self.stats['stored'] += 1
+            self._expire()
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.stats['evicted'] += 1
+            self._ready.notify_all()
+
+    def _expire(self, now=None):
+        """Удаляет просроченные результаты (самые старые - в начале словаря)"""
+        deadline = (now or time.time()) - self.ttl
+        while self._items:
+            task_id, (stored_at, _) = next(iter(self._items.items()))
+            if stored_at > deadline:
+                break
+            del self._items[task_id]
+            self.stats['expired'] += 1
+
+    def pop(self, task_id):
+        """Забирает результат (None, если его нет)"""
+        with self._ready:
+            item = self._items.pop(task_id, None)
+            if item is None:
+                return None
+            self.stats['delivered'] += 1
+            return item[1]
+
+    def wait(self, task_id, timeout):
+        """Ждет результат до timeout секунд и забирает его"""
+        deadline = time.time() + timeout
+        with self._ready:
+            while task_id not in self._items:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._ready.wait(remaining)
+            self.stats['delivered'] += 1
+            return self._items.pop(task_id)[1]
+
+    def sweep(self, live_task_ids=None):
+        """
+        Удаляет просроченные результаты, а если передан набор ожидаемых задач -
+        и брошенные: не ожидаемые никем дольше orphan_grace секунд.
+        """
+        now = time.time()
+        with self._ready:
+            self._expire(now)
+            if live_task_ids is None:
+                return 0
+            live = set(live_task_ids)
+            orphans = [
+                task_id for task_id, (stored_at, _) in self._items.items()
+                if task_id not in live and now - stored_at > self.orphan_grace
+            ]
+            for task_id in orphans:
+                del self._items[task_id]
+            self.stats['orphaned'] += len(orphans)
+            return len(orphans)
+
+    def __contains__(self, task_id):
+        return task_id in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_stats(self):
+        with self._ready:
+            return dict(self.stats, size=len(self._items), max_size=self.max_size, ttl=self.ttl)
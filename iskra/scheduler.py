@@ -0,0 +1,131 @@
+# scheduler.py - Планировщик тиков симуляции с фиксированным шагом
+
+import time
+import threading
+
+
+class TickScheduler:
+    """
+    Планировщик симуляции с фиксированной частотой тиков.
+    Измеряет длительность тика, отключает необязательную работу при превышении бюджета
+    и считает пропущенные (dropped) и упрощенные (degraded) тики.
+    """
+
+    def __init__(self, tick_rate=0.2, budget_ratio=0.8, max_lag_ticks=3):
+        """
+        tick_rate: целевая частота тиков в секунду (0.2 = один тик в 5 секунд)
+        budget_ratio: доля интервала тика, после которой необязательная работа пропускается
+        max_lag_ticks: на сколько тиков можно отстать, прежде чем тики будут пропущены
+        """
+        self.tick_interval = 1.0 / tick_rate
+        self.budget = self.tick_interval * budget_ratio
+        self.max_lag_ticks = max_lag_ticks
+
+        self._stop_event = threading.Event()
+        self._next_tick = None
+        self._tick_start = None
+        self._degrade_next = False
+        self._degraded = False
+
+        self.stats = {
+            'ticks': 0,
+            'dropped_ticks': 0,
+            'degraded_ticks': 0,
+            'overruns': 0,
+            'throttled_requests': 0,
+            'last_tick_duration': 0.0,
+            'avg_tick_duration': 0.0,
+            'max_tick_duration': 0.0,
+        }
+
+    def begin_tick(self):
+        """Отмечает начало тика"""
+        self._tick_start = time.monotonic()
+        if self._next_tick is None:
+            self._next_tick = self._tick_start
+        # Если прошлый тик вышел за бюджет - этот тик сразу упрощенный
+        self._degraded = self._degrade_next
+
+    def elapsed(self):
+        """Сколько секунд прошло с начала текущего тика"""
+        if self._tick_start is None:
+            return 0.0
+        return time.monotonic() - self._tick_start
+
+    def over_budget(self):
+        """Превышен ли бюджет времени текущего тика"""
+        return self.elapsed() > self.budget
+
+    def allow_optional(self):
+        """Можно ли выполнять необязательную работу (воспоминания, рефлексии, события мира)"""
+        if self._degraded or self.over_budget():
+            self._degraded = True
+            return False
+        return True
+
+    def llm_throttle(self, queue_size, low_water, high_water):
+        """
+        Коэффициент [0..1] для вероятности инициативных запросов к LLM.
+        Ниже low_water - без ограничений, выше high_water - запросы не отправляются.
+        """
+        if queue_size <= low_water:
+            return 1.0
+        if queue_size >= high_water:
+            return 0.0
+        return 1.0 - (queue_size - low_water) / float(high_water - low_water)
+
+    def note_throttled(self):
+        """Учет запроса к LLM, отложенного из-за переполнения очереди"""
+        self.stats['throttled_requests'] += 1
+
+    def end_tick(self):
+        """Отмечает конец тика, обновляет статистику и вычисляет время следующего тика"""
+        now = time.monotonic()
+        duration = now - self._tick_start
+
+        stats = self.stats
+        stats['ticks'] += 1
+        stats['last_tick_duration'] = duration
+        stats['max_tick_duration'] = max(stats['max_tick_duration'], duration)
+        # Экспоненциальное скользящее среднее длительности тика
+        if stats['ticks'] == 1:
+            stats['avg_tick_duration'] = duration
+        else:
+            stats['avg_tick_duration'] = 0.9 * stats['avg_tick_duration'] + 0.1 * duration
+
+        if self._degraded:
+            stats['degraded_ticks'] += 1
+        if duration > self.tick_interval:
+            stats['overruns'] += 1
+        self._degrade_next = duration > self.budget
+
+        # Фиксированный шаг: следующий тик отсчитывается от расписания, а не от конца тика
+        self._next_tick += self.tick_interval
+        lag = now - self._next_tick
+        if lag > self.tick_interval * self.max_lag_ticks:
+            # Сильно отстали - не пытаемся догнать, пропускаем тики
+            dropped = int(lag // self.tick_interval)
+            stats['dropped_ticks'] += dropped
+            self._next_tick += dropped * self.tick_interval
+
+    def wait(self):
+        """Ожидание до следующего тика по расписанию"""
+        if self._next_tick is None:
+            self._next_tick = time.monotonic()
+        delay = self._next_tick - time.monotonic()
+        if delay > 0:
+            self._stop_event.wait(delay)
+
+    def backoff(self, seconds):
+        """Пауза после ошибки; расписание сдвигается, чтобы не навёрстывать тики пачкой"""
+        self._stop_event.wait(seconds)
+        self._next_tick = time.monotonic()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['tick_interval'] = self.tick_interval
+        stats['tick_budget'] = self.budget
+        return stats
@@ -0,0 +1,320 @@
+# sharding.py - Вынос физики агентов в отдельные процессы
+#
+# Шарды считают только энергию, движение, настроение и согласуют новые разговоры.
+# Ответы на сообщения, продолжения разговоров, запросы к GigaChat и запись в БД
+# остаются в потоке симуляции, поэтому пропускная способность по диалогам
+# с числом ядер не растет: шарды лишь разгружают этот поток от физики.
+
+import random
+import multiprocessing
+
+WORLD_BOUNDS = 10.0
+REGULAR_MOODS = ['любопытный', 'нейтральный', 'сфокусированный']
+
+
+def advance_agent_state(state, rng):
+    """
+    Один шаг физики агента: энергия, случайное движение и настроение.
+    state - словарь с полями energy, x, y, z, mood; изменяется на месте.
+    """
+    state['energy'] += rng.uniform(-0.05, 0.05)
+    state['energy'] = max(0.1, min(1.0, state['energy']))
+
+    for axis in ('x', 'y', 'z'):
+        value = state[axis] + rng.uniform(-0.5, 0.5)
+        state[axis] = max(-WORLD_BOUNDS, min(WORLD_BOUNDS, value))
+
+    if state['energy'] < 0.3:
+        state['mood'] = 'уставший'
+    elif state['energy'] > 0.8:
+        state['mood'] = 'возбужденный'
+    else:
+        state['mood'] = rng.choice(REGULAR_MOODS)
+    return state
+
+
+def _distance2(a, b):
+    return (a['x'] - b['x']) ** 2 + (a['y'] - b['y']) ** 2 + (a['z'] - b['z']) ** 2
+
+
+def _shard_worker(shard_id, conn, seed, talk_chance, memory_chance):
+    """Процесс шарда: владеет срезом агентов и обрабатывает команды координатора"""
+    rng = random.Random(seed)
+    agents = {}  # agent_id -> состояние
+    busy = set()  # агенты, уже занятые разговором на текущем цикле
+
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            break
+
+        if command == 'load':
+            for state in payload:
+                agents[state['id']] = state
+            conn.send(('ok', len(agents)))
+
+        elif command == 'drop':
+            for agent_id in payload:
+                agents.pop(agent_id, None)
+            conn.send(('ok', len(agents)))
+
+        elif command == 'tick':
+            # Фаза 1: обновление состояния своих агентов и намерения начать разговор
+            cycle = payload['cycle']
+            directory = payload['directory']  # agent_id -> (shard_id, x, y, z) для всех агентов мира
+            for agent_id, fields in payload['overrides'].items():
+                if agent_id in agents:
+                    agents[agent_id].update(fields)
+            busy.clear()
+            updates = []
+            proposals = []
+            for agent_id, state in agents.items():
+                advance_agent_state(state, rng)
+                updates.append({
+                    'id': agent_id,
+                    'energy': state['energy'],
+                    'x': state['x'],
+                    'y': state['y'],
+                    'z': state['z'],
+                    'mood': state['mood'],
+                    'remember': rng.random() < memory_chance
+                })
+                if payload['allow_talk'] and rng.random() < talk_chance:
+                    target_id = _pick_partner(agent_id, state, directory, rng)
+                    if target_id is not None:
+                        proposals.append((agent_id, target_id))
+            conn.send(('tick', {'cycle': cycle, 'updates': updates, 'proposals': proposals}))
+
+        elif command == 'inbox':
+            # Фаза 2: входящие приглашения к разговору (в т.ч. из других шардов)
+            accepted = []
+            for sender_id, target_id in payload:
+                state = agents.get(target_id)
+                if state is None or target_id in busy or sender_id in busy:
+                    continue
+                if state['energy'] < 0.2:
+                    continue  # Уставший агент отклоняет приглашение
+                busy.add(target_id)
+                busy.add(sender_id)
+                accepted.append((sender_id, target_id))
+            conn.send(('inbox', accepted))
+
+        elif command == 'stop':
+            break
+
+    conn.close()
+
+
+def _pick_partner(agent_id, state, directory, rng):
+    """Выбор собеседника: ближайший из нескольких случайных кандидатов по всему миру"""
+    candidates = [other_id for other_id in directory if other_id != agent_id]
+    if not candidates:
+        return None
+    sample = rng.sample(candidates, min(3, len(candidates)))
+    return min(sample, key=lambda other_id: _distance2(state, {
+        'x': directory[other_id][1],
+        'y': directory[other_id][2],
+        'z': directory[other_id][3]
+    }))
+
+
+class ShardCoordinator:
+    """
+    Координатор шардов: распределяет агентов по процессам, проводит барьер цикла мира
+    и маршрутизирует приглашения к диалогу между шардами. Только физика и согласование
+    новых разговоров - остальная работа цикла выполняется вызывающим потоком.
+    """
+
+    def __init__(self, num_shards, talk_chance=0.016, memory_chance=0.3, reply_timeout=10.0):
+        self.num_shards = num_shards
+        self.talk_chance = talk_chance
+        self.memory_chance = memory_chance
+        self.reply_timeout = reply_timeout
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._conns = []
+        self._processes = []
+        self.owner = {}  # agent_id -> shard_id
+        self.positions = {}  # agent_id -> (x, y, z) по итогам последнего цикла
+        self._overrides = {}  # agent_id -> поля, измененные координатором вне шарда
+        self.stats = {'cycles': 0, 'cross_shard_messages': 0, 'accepted_dialogues': 0,
+                      'conflicting_dialogues': 0, 'restarts': 0}
+
+    def _spawn(self, shard_id):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_shard_worker,
+            args=(shard_id, child_conn, random.randrange(2 ** 31), self.talk_chance, self.memory_chance),
+            name=f'iskra-shard-{shard_id}'
+        )
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return parent_conn, process
+
+    def start(self):
+        for shard_id in range(self.num_shards):
+            conn, process = self._spawn(shard_id)
+            self._conns.append(conn)
+            self._processes.append(process)
+        print(f"🧩 Запущено шардов симуляции: {self.num_shards}")
+
+    def _restart(self, shard_id, reason):
+        """
+        Замена зависшего или упавшего шарда новым процессом. Его агенты забываются
+        и загружаются заново из БД при следующем sync_agents (состояние - на момент последней записи).
+        """
+        print(f"⚠️ Шард {shard_id} перезапускается: {reason}")
+        try:
+            self._conns[shard_id].close()
+        except OSError:
+            pass
+        process = self._processes[shard_id]
+        if process.is_alive():
+            process.terminate()
+            process.join(timeout=2)
+            if process.is_alive():
+                process.kill()  # Остановленный процесс SIGTERM не обрабатывает
+        process.join(timeout=2)
+        self._conns[shard_id], self._processes[shard_id] = self._spawn(shard_id)
+
+        for agent_id in [a for a, owner in self.owner.items() if owner == shard_id]:
+            del self.owner[agent_id]
+            self.positions.pop(agent_id, None)
+            self._overrides.pop(agent_id, None)
+        self.stats['restarts'] += 1
+
+    def stop(self):
+        for conn in self._conns:
+            try:
+                conn.send(('stop', None))
+                conn.close()
+            except (OSError, EOFError):
+                pass
+        for process in self._processes:
+            process.join(timeout=2)
+        self._conns = []
+        self._processes = []
+
+    def _recv(self, shard_id):
+        conn = self._conns[shard_id]
+        if not conn.poll(self.reply_timeout):
+            raise RuntimeError(f"Шард {shard_id} не ответил за {self.reply_timeout}с")
+        return conn.recv()
+
+    def _broadcast(self, messages):
+        """
+        Отправляет каждому шарду свое сообщение и ждет ответы всех (барьер).
+        Упавший или не ответивший за reply_timeout шард перезапускается и в ответах отсутствует.
+        """
+        sent = []
+        for shard_id, message in messages.items():
+            try:
+                self._conns[shard_id].send(message)
+                sent.append(shard_id)
+            except (OSError, EOFError) as e:
+                self._restart(shard_id, e)
+
+        replies = {}
+        for shard_id in sent:
+            try:
+                replies[shard_id] = self._recv(shard_id)
+            except (RuntimeError, OSError, EOFError) as e:
+                self._restart(shard_id, e)
+        return replies
+
+    def sync_agents(self, agents):
+        """Синхронизирует набор агентов в шардах с текущими строками БД"""
+        current = {agent.id: agent for agent in agents}
+        loads = {}
+        for agent_id, agent in current.items():
+            if agent_id not in self.owner:
+                shard_id = agent_id % self.num_shards
+                self.owner[agent_id] = shard_id
+                loads.setdefault(shard_id, []).append({
+                    'id': agent.id,
+                    'energy': agent.energy,
+                    'x': agent.position_x,
+                    'y': agent.position_y,
+                    'z': agent.position_z,
+                    'mood': agent.mood
+                })
+                self.positions[agent_id] = (agent.position_x, agent.position_y, agent.position_z)
+
+        drops = {}
+        for agent_id in [a for a in self.owner if a not in current]:
+            drops.setdefault(self.owner.pop(agent_id), []).append(agent_id)
+            self.positions.pop(agent_id, None)
+
+        if loads:
+            self._broadcast({shard_id: ('load', batch) for shard_id, batch in loads.items()})
+        if drops:
+            self._broadcast({shard_id: ('drop', batch) for shard_id, batch in drops.items()})
+
+    def override(self, agent_id, **fields):
+        """Передать шарду изменения состояния агента, сделанные вне него (например, событием мира)"""
+        self._overrides.setdefault(agent_id, {}).update(fields)
+
+    def step(self, cycle, allow_talk=True):
+        """
+        Один цикл мира на всех шардах.
+        Возвращает (updates, accepted): обновления состояния агентов и согласованные пары для диалога.
+        """
+        directory = {
+            agent_id: (self.owner[agent_id],) + self.positions[agent_id]
+            for agent_id in self.owner
+        }
+        replies = self._broadcast({
+            shard_id: ('tick', {
+                'cycle': cycle,
+                'directory': directory,
+                'allow_talk': allow_talk,
+                'overrides': {a: f for a, f in self._overrides.items() if self.owner.get(a) == shard_id}
+            })
+            for shard_id in range(self.num_shards)
+        })
+        self._overrides = {}
+
+        updates = []
+        inboxes = {}
+        for shard_id, (kind, payload) in replies.items():
+            if kind != 'tick' or payload['cycle'] != cycle:
+                self._restart(shard_id, f"рассинхронизирован на цикле {cycle}")
+                continue
+            updates.extend(payload['updates'])
+            for sender_id, target_id in payload['proposals']:
+                target_shard = self.owner.get(target_id)
+                if target_shard is None:
+                    continue
+                if target_shard != shard_id:
+                    self.stats['cross_shard_messages'] += 1
+                inboxes.setdefault(target_shard, []).append((sender_id, target_id))
+
+        for update in updates:
+            if update['id'] in self.owner:
+                self.positions[update['id']] = (update['x'], update['y'], update['z'])
+
+        # Шард знает о занятости только своих агентов: агент, принятый в одном шарде, мог принять
+        # приглашение и в другом. Повторно в одном цикле агент в разговор не попадает.
+        accepted = []
+        engaged = set()
+        if inboxes:
+            for kind, pairs in self._broadcast({s: ('inbox', msgs) for s, msgs in inboxes.items()}).values():
+                for sender_id, target_id in pairs:
+                    if sender_id in engaged or target_id in engaged:
+                        self.stats['conflicting_dialogues'] += 1
+                        continue
+                    engaged.update((sender_id, target_id))
+                    accepted.append((sender_id, target_id))
+
+        self.stats['cycles'] += 1
+        self.stats['accepted_dialogues'] += len(accepted)
+        return updates, accepted
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['shards'] = self.num_shards
+        stats['agents'] = len(self.owner)
+        stats['alive'] = sum(1 for p in self._processes if p.is_alive())
+        return stats
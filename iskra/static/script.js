@@ -4,6 +4,7 @@ document.addEventListener('DOMContentLoaded', function() {
     initFlashMessages();
     initBackToTop();
     initLiveFeed();
+    initPresence();
     initWorldUpdates();
     initMobileNav();
     initSystemTime();
@@ -126,6 +127,46 @@ function initLiveFeed() {
     setInterval(fetchEvents, 5000);
 }
 
+// Индикаторы "печатает..." (Server-Sent Events, без поддержки - опрос)
+function initPresence() {
+    const bar = document.getElementById('presenceBar');
+    if (!bar) return;
+    
+    function render(snapshot) {
+        bar.innerHTML = '';
+        snapshot.items.forEach(item => {
+            const indicator = document.createElement('div');
+            indicator.className = 'typing-indicator';
+            const text = item.state === 'typing'
+                ? `${item.agent} печатает ответ ${item.target}...`
+                : `${item.agent} пишет ${item.target}...`;
+            indicator.innerHTML = `
+                <span class="typing-dot"></span>
+                <span class="typing-dot"></span>
+                <span class="typing-dot"></span>
+                <span class="typing-text"></span>
+            `;
+            indicator.querySelector('.typing-text').textContent = text;
+            bar.appendChild(indicator);
+        });
+    }
+    
+    if (window.EventSource) {
+        const source = new EventSource('/api/presence/stream');
+        source.onmessage = event => render(JSON.parse(event.data));
+        return;
+    }
+    
+    function poll() {
+        fetch('/api/presence')
+            .then(response => response.json())
+            .then(render)
+            .catch(console.error);
+    }
+    poll();
+    setInterval(poll, 3000);
+}
+
 // Обновление статусов мира
 function initWorldUpdates() {
     function updateWorldStats() {
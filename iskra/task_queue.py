@@ -0,0 +1,452 @@
+# task_queue.py - Очередь задач GigaChat в SQLite: переживает перезапуск процесса
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from queue import Empty
+from datetime import datetime
+
+# Состояния задачи
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    return str(value)
+
+
+def _object_hook(value):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=_default)
+
+
+def loads(payload):
+    return json.loads(payload, object_hook=_object_hook) if payload else None
+
+
+class DurableTaskQueue:
+    """
+    Очередь задач со состояниями queued / running / done / failed.
+    Обработчик берет задачу в аренду на lease_seconds; задачи, чья аренда истекла (обработчик
+    упал или процесс перезапущен), возвращаются в очередь, пока не исчерпано max_attempts.
+    Завершение идемпотентно: повторный результат той же задачи игнорируется.
+    Задача с ключом (key) не ставится, пока в очереди или в работе есть задача с тем же ключом;
+    задача со сроком (expires_at), не взятая в работу до срока, отбрасывается (failed, 'expired').
+    Интерфейс put/get/task_done/qsize/join совместим с queue.Queue.
+    """
+
+    def __init__(self, path=None, lease_seconds=120, max_attempts=3, retention=3600):
+        """
+        path: файл SQLite (None - только память, без восстановления после перезапуска)
+        retention: сколько секунд хранятся завершенные задачи, которые никто не забрал
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._lock = threading.RLock()
+        self._available = threading.Condition(self._lock)
+        self._finished = threading.Condition(self._lock)  # Задача обработана (для join)
+        self.stats = {'enqueued': 0, 'claimed': 0, 'completed': 0, 'duplicates': 0,
+                      'failed': 0, 'requeued': 0, 'recovered': 0, 'coalesced': 0, 'expired': 0,
+                      'released': 0}
+
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS llm_task (
+            task_id TEXT PRIMARY KEY,
+            task_type TEXT,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL,
+            parent_id TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL,
+            result TEXT,
+            source TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            dedupe_key TEXT,
+            expires_at REAL
+        )""")
+        # Файлы очереди прежних версий - без ключей, сроков задач и бэкенда результата
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(llm_task)")}
+        for column, kind in (('dedupe_key', 'TEXT'), ('expires_at', 'REAL'), ('source', 'TEXT')):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE llm_task ADD COLUMN {column} {kind}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_llm_task_state ON llm_task (state, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_llm_task_key ON llm_task (dedupe_key)")
+        # Задачи, результата которых ждет симуляция (метаданные AgentSimulator.pending_dialogues)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS llm_pending (
+            task_id TEXT PRIMARY KEY,
+            meta TEXT NOT NULL
+        )""")
+        self._db.commit()
+
+    def put(self, item, key=None, expires_at=None):
+        """
+        Ставит задачу (task_id, prompt_data) в очередь; существующая задача ставится заново.
+        key: задача не ставится (False), если задача с этим ключом уже в очереди или в работе
+        expires_at: время (time.time()), после которого невзятая задача не нужна
+        """
+        task_id, payload = item
+        now = time.time()
+        with self._available:
+            if key is not None:
+                self._expire(now)
+                active = self._db.execute(
+                    "SELECT 1 FROM llm_task WHERE dedupe_key = ? AND state IN (?, ?) LIMIT 1", (key, QUEUED, RUNNING)
+                ).fetchone()
+                if active:
+                    self.stats['coalesced'] += 1
+                    return False
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_task (task_id, task_type, payload, state, parent_id, attempts, "
+                "created_at, updated_at, dedupe_key, expires_at) VALUES (?, ?, ?, ?, NULL, 0, ?, ?, ?, ?)",
+                (task_id, payload.get('type'), dumps(payload), QUEUED, now, now, key, expires_at)
+            )
+            self._db.commit()
+            self.stats['enqueued'] += 1
+            self._available.notify()
+            return True
+
+    def add_children(self, parent_id, children):
+        """
+        Задачи, результат которых придет вместе с родительской (например, рефлексии из пакета).
+        Обработчики их не берут; put() той же задачи превращает ее в обычную.
+        Если родительская задача провалится или будет забрана без раскладки результата,
+        оставшиеся в очереди дочерние задачи становятся обычными (см. _release_children).
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO llm_task (task_id, task_type, payload, state, parent_id, attempts, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                [(task_id, payload.get('type'), dumps(payload), QUEUED, parent_id, now, now)
+                 for task_id, payload in children]
+            )
+            self._db.commit()
+
+    def _release_children(self, parent_ids, now):
+        """Дочерние задачи родителя, который уже не даст результата, - в обычную очередь"""
+        released = 0
+        for parent_id in parent_ids:
+            released += self._db.execute(
+                "UPDATE llm_task SET parent_id = NULL, updated_at = ? WHERE parent_id = ? AND state = ?",
+                (now, parent_id, QUEUED)
+            ).rowcount
+        if released:
+            self.stats['released'] += released
+            self._available.notify_all()
+        return released
+
+    def _expire(self, now):
+        """Задачи, не взятые в работу до своего срока, - в failed"""
+        expiring = [row[0] for row in self._db.execute(
+            "SELECT task_id FROM llm_task WHERE state = ? AND expires_at IS NOT NULL AND expires_at < ?",
+            (QUEUED, now)
+        )]
+        expired = self._db.execute(
+            "UPDATE llm_task SET state = ?, error = 'expired', updated_at = ? "
+            "WHERE state = ? AND expires_at IS NOT NULL AND expires_at < ?",
+            (FAILED, now, QUEUED, now)
+        ).rowcount
+        if expired:
+            self._release_children(expiring, now)
+            self._db.commit()
+            self.stats['expired'] += expired
+            self._finished.notify_all()
+        return expired
+
+    def _claim(self):
+        self._expire(time.time())
+        row = self._db.execute(
+            "SELECT task_id, payload, attempts FROM llm_task WHERE state = ? AND parent_id IS NULL "
+            "ORDER BY created_at LIMIT 1", (QUEUED,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        self._db.execute(
+            "UPDATE llm_task SET state = ?, attempts = ?, lease_until = ?, updated_at = ? WHERE task_id = ?",
+            (RUNNING, row[2] + 1, now + self.lease_seconds, now, row[0])
+        )
+        self._db.commit()
+        self.stats['claimed'] += 1
+        return row[0], loads(row[1])
+
+    def get(self, block=True, timeout=None):
+        """Берет в аренду самую старую задачу из очереди; Empty, если за timeout задач не появилось"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._available:
+            while True:
+                item = self._claim()
+                if item is not None:
+                    return item
+                remaining = None if deadline is None else deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Empty
+                self._available.wait(remaining)
+
+    def task_done(self):
+        """Обработчик закончил с задачей (результат фиксируется в complete()/fail()) - будит join()"""
+        with self._finished:
+            self._finished.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Ждет, пока в очереди и в работе не останется задач; в отличие от queue.Queue.join
+        принимает timeout и возвращает False, если очередь за это время не опустела.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._finished:
+            while True:
+                self._expire(time.time())
+                active = self._db.execute(
+                    "SELECT COUNT(*) FROM llm_task WHERE (state = ? AND parent_id IS NULL) OR state = ?",
+                    (QUEUED, RUNNING)
+                ).fetchone()[0]
+                if not active:
+                    return True
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                # Ожидание ограничено: задачи могут вернуться в очередь по истечении аренды без task_done()
+                self._finished.wait(1.0 if remaining is None else min(1.0, remaining))
+
+    def qsize(self):
+        with self._lock:
+            self._expire(time.time())
+            return self._db.execute(
+                "SELECT COUNT(*) FROM llm_task WHERE state = ? AND parent_id IS NULL", (QUEUED,)
+            ).fetchone()[0]
+
+    def complete(self, task_id, result, source=None):
+        """
+        Сохраняет результат; False, если задача уже завершена (повторное завершение) или неизвестна.
+        source: имя бэкенда, написавшего результат
+        """
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE llm_task SET state = ?, result = ?, source = ?, lease_until = NULL, updated_at = ? "
+                "WHERE task_id = ? AND state IN (?, ?)",
+                (DONE, result, source, time.time(), task_id, QUEUED, RUNNING)
+            ).rowcount
+            self._db.commit()
+            self.stats['completed' if updated else 'duplicates'] += 1
+            return bool(updated)
+
+    def fail(self, task_id, error, retry=True):
+        """
+        Ошибка обработки: задача возвращается в очередь, пока не исчерпаны попытки
+        (или сразу помечается failed при retry=False). Возвращает новое состояние.
+        """
+        with self._available:
+            row = self._db.execute(
+                "SELECT attempts FROM llm_task WHERE task_id = ? AND state = ?", (task_id, RUNNING)
+            ).fetchone()
+            if row is None:
+                return None
+            state = QUEUED if retry and row[0] < self.max_attempts else FAILED
+            now = time.time()
+            self._db.execute(
+                "UPDATE llm_task SET state = ?, error = ?, lease_until = NULL, updated_at = ? WHERE task_id = ?",
+                (state, str(error)[:500], now, task_id)
+            )
+            if state == FAILED:
+                self._release_children([task_id], now)
+            self._db.commit()
+            if state == QUEUED:
+                self.stats['requeued'] += 1
+                self._available.notify()
+            else:
+                self.stats['failed'] += 1
+            return state
+
+    def state(self, task_id):
+        with self._lock:
+            row = self._db.execute("SELECT state FROM llm_task WHERE task_id = ?", (task_id,)).fetchone()
+            return row[0] if row else None
+
+    def result(self, task_id):
+        """Сохраненный результат завершенной задачи (None, если задача не завершена)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM llm_task WHERE task_id = ? AND state = ?", (task_id, DONE)
+            ).fetchone()
+            return row[0] if row else None
+
+    def source(self, task_id):
+        """Имя бэкенда, написавшего результат завершенной задачи (None - неизвестно)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT source FROM llm_task WHERE task_id = ? AND state = ?", (task_id, DONE)
+            ).fetchone()
+            return row[0] if row else None
+
+    def requeue_expired(self, now=None):
+        """Задачи с истекшей арендой - обратно в очередь (или в failed, если попытки исчерпаны)"""
+        now = now or time.time()
+        with self._available:
+            exhausted = [row[0] for row in self._db.execute(
+                "SELECT task_id FROM llm_task WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (RUNNING, now, self.max_attempts)
+            )]
+            failed = self._db.execute(
+                "UPDATE llm_task SET state = ?, error = 'lease expired', lease_until = NULL, updated_at = ? "
+                "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, now, RUNNING, now, self.max_attempts)
+            ).rowcount
+            self._release_children(exhausted, min(now, time.time()))
+            requeued = self._db.execute(
+                "UPDATE llm_task SET state = ?, lease_until = NULL, updated_at = ? "
+                "WHERE state = ? AND lease_until < ?",
+                (QUEUED, now, RUNNING, now)
+            ).rowcount
+            self._db.commit()
+            self.stats['failed'] += failed
+            self.stats['requeued'] += requeued
+            if requeued:
+                self._available.notify_all()
+            return requeued
+
+    def recover(self):
+        """
+        Восстановление при запуске: задачи, которые выполнялись в прошлом процессе, возвращаются
+        в очередь; возвращает [(task_id, результат, payload)] завершенных, но не забранных задач.
+        """
+        with self._lock:
+            # Прошлый процесс уже не работает - его аренды недействительны
+            requeued = self.requeue_expired(now=float('inf'))
+            rows = self._db.execute(
+                "SELECT task_id, result, payload FROM llm_task WHERE state = ?", (DONE,)
+            ).fetchall()
+            queued = self.qsize()
+        self.stats['recovered'] += requeued
+        if requeued or rows or queued:
+            print(f"♻️ Очередь GigaChat: в очереди {queued} (из них прерванных {requeued}), готовых результатов {len(rows)}")
+        return [(task_id, result, loads(payload)) for task_id, result, payload in rows]
+
+    def consume(self, task_id):
+        """Результат забран и сохранен потребителем - задача больше не нужна"""
+        with self._available:
+            # Дочерние задачи, которые потребитель не разложил, выполняются отдельно
+            self._release_children([task_id], time.time())
+            self._db.execute("DELETE FROM llm_task WHERE task_id = ?", (task_id,))
+            self._db.execute("DELETE FROM llm_pending WHERE task_id = ?", (task_id,))
+            self._db.commit()
+
+    def purge(self):
+        """Удаляет давно завершенные задачи, которые никто не забрал"""
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM llm_task WHERE state IN (?, ?) AND updated_at < ?",
+                (DONE, FAILED, time.time() - self.retention)
+            ).rowcount
+            self._db.commit()
+            return deleted
+
+    def set_pending(self, task_id, meta):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO llm_pending (task_id, meta) VALUES (?, ?)", (task_id, dumps(meta)))
+            self._db.commit()
+
+    def drop_pending(self, task_id):
+        with self._lock:
+            self._db.execute("DELETE FROM llm_pending WHERE task_id = ?", (task_id,))
+            self._db.commit()
+
+    def pending(self):
+        with self._lock:
+            return {task_id: loads(meta) for task_id, meta in self._db.execute("SELECT task_id, meta FROM llm_pending")}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_stats(self):
+        with self._lock:
+            states = dict(self._db.execute("SELECT state, COUNT(*) FROM llm_task GROUP BY state").fetchall())
+            waiting = self._db.execute("SELECT COUNT(*) FROM llm_pending").fetchone()[0]
+        return dict(self.stats, states=states, pending=waiting, durable=bool(self.path))
+
+
+class PendingTasks(dict):
+    """
+    Ожидающие задачи симуляции (task_id -> метаданные), которые дублируются в очередь задач:
+    после перезапуска restore() возвращает их, и симуляция дожидается результатов, а не отвечает заготовками.
+    """
+
+    def __init__(self, store):
+        super().__init__()
+        self._store = store
+
+    def restore(self):
+        self.update(self._store.pending())
+        return len(self)
+
+    def __setitem__(self, task_id, meta):
+        super().__setitem__(task_id, meta)
+        self._store.set_pending(task_id, meta)
+
+    def __delitem__(self, task_id):
+        super().__delitem__(task_id)
+        self._store.drop_pending(task_id)
+
+    def pop(self, task_id, *default):
+        self._store.drop_pending(task_id)
+        return super().pop(task_id, *default)
+
+
+if __name__ == '__main__':
+    # Самопроверка: python task_queue.py
+    queue = DurableTaskQueue(max_attempts=2)
+    children = [('reflection_1', {'type': 'reflection'}), ('reflection_2', {'type': 'reflection'})]
+
+    # Пакет, исчерпавший попытки, отпускает дочерние задачи в обычную очередь
+    queue.put(('batch_1', {'type': 'reflection_batch'}))
+    queue.add_children('batch_1', children)
+    assert queue.qsize() == 1
+    for attempt in range(2):
+        task_id, _ = queue.get(block=False)
+        assert task_id == 'batch_1'
+        queue.fail(task_id, 'error')
+    assert queue.state('batch_1') == FAILED
+    assert queue.qsize() == 2
+    assert sorted(queue.get(block=False)[0] for _ in range(2)) == ['reflection_1', 'reflection_2']
+
+    # То же, если аренда пакета истекла на последней попытке
+    queue = DurableTaskQueue(max_attempts=1)
+    queue.put(('batch_2', {'type': 'reflection_batch'}))
+    queue.add_children('batch_2', children)
+    queue.get(block=False)
+    queue.requeue_expired(now=time.time() + queue.lease_seconds + 1)
+    assert queue.state('batch_2') == FAILED and queue.qsize() == 2
+
+    # Пакет забран, а одна рефлексия не разобрана и осталась дочерней - она тоже выполняется отдельно
+    queue = DurableTaskQueue()
+    queue.put(('batch_3', {'type': 'reflection_batch'}))
+    queue.add_children('batch_3', children)
+    queue.get(block=False)
+    queue.complete('reflection_1', 'мысль')
+    queue.consume('batch_3')
+    assert queue.get(block=False)[0] == 'reflection_2'
+    assert queue.join(timeout=0) is False
+    queue.complete('reflection_2', 'мысль')
+    assert queue.join(timeout=0) is True
+    print(f"Проверка очереди пройдена: {queue.get_stats()}")
@@ -0,0 +1,151 @@
+# tracing.py - Трассировка запросов людей: HTTP -> очередь GigaChat -> модель -> БД -> опрос ответа
+
+import os
+import json
+import time
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+# Этапы в порядке прохождения запроса (для отображения)
+STAGES = ['http.send', 'claim.wait', 'queue.wait', 'llm.call', 'result.wait', 'db.write', 'delivery', 'auto_reply']
+
+
+class Tracer:
+    """
+    Отрезки (spans) обработки запроса, связанные общим trace_id.
+    trace_id передается вместе с задачей (prompt_data['trace_id']) и метаданными ожидания,
+    поэтому отрезки пишут и веб-воркеры, и процесс симуляции. Каждый отрезок - строка JSON
+    в файле path (общем для процессов); без файла отрезки хранятся только в памяти.
+    """
+
+    def __init__(self, path=None, max_bytes=2 * 1024 * 1024, max_spans=5000, enabled=True):
+        """max_bytes: размер файла, после которого он переименовывается в <path>.1 и начинается заново"""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._spans = deque(maxlen=max_spans)
+        self._marks = OrderedDict()  # trace_id -> {метка: время} (начало этапов, которые закончатся позже)
+        self._lock = threading.Lock()
+        self.stats = {'spans': 0, 'write_errors': 0}
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def record(self, trace_id, stage, start, end=None, **attrs):
+        """Отрезок этапа stage с start по end (time.time()); без trace_id ничего не пишется"""
+        if not trace_id or not self.enabled:
+            return
+        end = end or time.time()
+        span = dict(attrs, trace_id=trace_id, stage=stage, start=round(start, 4),
+                    duration=round(max(0.0, end - start), 4), pid=os.getpid())
+        with self._lock:
+            self._spans.append(span)
+            self.stats['spans'] += 1
+            if self.path:
+                self._write(span)
+
+    @contextmanager
+    def span(self, trace_id, stage, **attrs):
+        """Отрезок на время блока; в блоке можно дополнить attrs"""
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            self.record(trace_id, stage, start, **attrs)
+
+    def mark(self, trace_id, name, at=None):
+        """Запоминает время события, от которого позже считается этап (record_since)"""
+        if not trace_id or not self.enabled:
+            return
+        with self._lock:
+            self._marks.setdefault(trace_id, {})[name] = at or time.time()
+            self._marks.move_to_end(trace_id)
+            while len(self._marks) > 1000:
+                self._marks.popitem(last=False)
+
+    def record_since(self, trace_id, stage, name, **attrs):
+        """Отрезок от метки name до текущего момента (если метка была)"""
+        with self._lock:
+            start = self._marks.get(trace_id, {}).pop(name, None)
+        if start is not None:
+            self.record(trace_id, stage, start, **attrs)
+
+    def _write(self, span):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(span, ensure_ascii=False) + '\n')
+        except OSError as e:
+            self.stats['write_errors'] += 1
+            print(f"❌ Не удалось записать трассировку: {e}")
+
+    def _read_spans(self):
+        if not self.path:
+            with self._lock:
+                return list(self._spans)
+        spans = []
+        for path in (self.path + '.1', self.path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            spans.append(json.loads(line))
+                        except ValueError:
+                            continue  # Строка, недописанная другим процессом
+            except OSError:
+                continue
+        return spans
+
+    def traces(self, limit=50):
+        """
+        Последние трассы: [{trace_id, start, total, stages: {этап: секунды}, spans}],
+        total - от начала первого до конца последнего отрезка.
+        """
+        grouped = {}
+        for span in self._read_spans():
+            grouped.setdefault(span['trace_id'], []).append(span)
+
+        traces = []
+        for trace_id, spans in grouped.items():
+            spans.sort(key=lambda s: s['start'])
+            stages = {}
+            for span in spans:
+                stages[span['stage']] = round(stages.get(span['stage'], 0.0) + span['duration'], 4)
+            start = spans[0]['start']
+            end = max(s['start'] + s['duration'] for s in spans)
+            traces.append({
+                'trace_id': trace_id,
+                'start': start,
+                'total': round(end - start, 4),
+                'stages': stages,
+                'spans': spans
+            })
+        traces.sort(key=lambda t: t['start'], reverse=True)
+        return traces[:limit]
+
+    @staticmethod
+    def breakdown(traces):
+        """Задержка по этапам среди трасс: {этап: {count, avg, p95, max}}"""
+        durations = {}
+        for trace in traces:
+            for stage, duration in trace['stages'].items():
+                durations.setdefault(stage, []).append(duration)
+            durations.setdefault('total', []).append(trace['total'])
+
+        result = {}
+        for stage in STAGES + sorted(set(durations) - set(STAGES) - {'total'}) + ['total']:
+            values = sorted(durations.get(stage, []))
+            if not values:
+                continue
+            result[stage] = {
+                'count': len(values),
+                'avg': round(sum(values) / len(values), 3),
+                'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+                'max': round(values[-1], 3)
+            }
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, buffered=len(self._spans), marks=len(self._marks), file=self.path)
@@ -0,0 +1,246 @@
+# vector_index.py - Локальный векторный поиск по воспоминаниям, диалогам и мыслям агентов
+
+import os
+import re
+import json
+import zlib
+import threading
+
+from models import db, AgentMemory, Dialogue, AgentThought
+
+# Векторный индекс работает только с NumPy
+try:
+    import numpy as np
+    VECTOR_SEARCH_AVAILABLE = True
+except ImportError:
+    print("⚠️ NumPy not installed. Vector search disabled.")
+    VECTOR_SEARCH_AVAILABLE = False
+
+_SPACES = re.compile(r'\s+')
+
+
+class HashingVectorizer:
+    """Эмбеддинг без обучения и внешних сервисов: хэширование символьных n-грамм"""
+
+    def __init__(self, dim=512, ngram_range=(2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def transform(self, text):
+        """Нормированный вектор текста (нулевой для пустого текста)"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = ' ' + _SPACES.sub(' ', (text or '').lower()).strip() + ' '
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(text) - n + 1):
+                # crc32 стабилен между процессами (в отличие от hash())
+                h = zlib.crc32(text[i:i + n].encode('utf-8'))
+                vector[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class VectorIndex:
+    """
+    Индекс векторов в memory-mapped файле (<path>.f32) с метаданными в <path>.meta.jsonl.
+    Поддерживает инкрементальное добавление и косинусный top-k поиск. Удаленные элементы
+    (remove) остаются в файлах, но перечисляются в <path>.deleted.jsonl и в поиск не попадают.
+    """
+
+    def __init__(self, path, dim=512, initial_capacity=1024):
+        if not VECTOR_SEARCH_AVAILABLE:
+            raise RuntimeError("Для векторного поиска нужен NumPy")
+        self.vectors_path = path + '.f32'
+        self.meta_path = path + '.meta.jsonl'
+        self.deleted_path = path + '.deleted.jsonl'
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self.vectorizer = HashingVectorizer(dim)
+        self._lock = threading.RLock()
+        self._open()
+
+    def _open(self):
+        self._meta = []
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding='utf-8') as f:
+                self._meta = [json.loads(line) for line in f if line.strip()]
+        self._meta_size = os.path.getsize(self.meta_path) if os.path.exists(self.meta_path) else 0
+        self._keys = {(m['kind'], m['id']) for m in self._meta}
+        self.max_ids = {}
+        for m in self._meta:
+            self.max_ids[m['kind']] = max(self.max_ids.get(m['kind'], 0), m['id'])
+        self._deleted = set()
+        if os.path.exists(self.deleted_path):
+            with open(self.deleted_path, encoding='utf-8') as f:
+                self._deleted = {tuple(json.loads(line)) for line in f if line.strip()}
+        self._deleted_size = os.path.getsize(self.deleted_path) if os.path.exists(self.deleted_path) else 0
+        self._filters = None
+
+        row_bytes = self.dim * 4
+        existing = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        capacity = max(self.initial_capacity, existing, len(self._meta))
+        self._resize_file(capacity)
+
+    def _resize_file(self, capacity):
+        with open(self.vectors_path, 'ab') as f:
+            if f.tell() < capacity * self.dim * 4:
+                f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def __len__(self):
+        return len(self._meta) - len(self._deleted)
+
+    def add_many(self, items):
+        """
+        Добавляет элементы (kind, item_id, agent_id, text); уже проиндексированные пропускаются.
+        Возвращает число добавленных.
+        """
+        with self._lock:
+            fresh = [item for item in items if (item[0], item[1]) not in self._keys and item[3]]
+            if not fresh:
+                return 0
+            needed = len(self._meta) + len(fresh)
+            if needed > self.capacity:
+                self._vectors.flush()
+                self._resize_file(max(needed, self.capacity * 2))
+
+            lines = []
+            for offset, (kind, item_id, agent_id, text) in enumerate(fresh):
+                self._vectors[len(self._meta) + offset] = self.vectorizer.transform(text)
+                lines.append({'kind': kind, 'id': item_id, 'agent_id': agent_id, 'text': text[:500]})
+            # Сначала векторы на диск, затем метаданные - читатели не увидят пустых строк
+            self._vectors.flush()
+            with open(self.meta_path, 'a', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(json.dumps(line, ensure_ascii=False) + '\n')
+            self._meta_size = os.path.getsize(self.meta_path)
+
+            for line in lines:
+                self._meta.append(line)
+                self._keys.add((line['kind'], line['id']))
+                self.max_ids[line['kind']] = max(self.max_ids.get(line['kind'], 0), line['id'])
+            self._filters = None
+            return len(lines)
+
+    def add(self, kind, item_id, agent_id, text):
+        return self.add_many([(kind, item_id, agent_id, text)]) == 1
+
+    def advance(self, kind, item_id):
+        """Строки до item_id прочитаны (в том числе пропущенные без текста) - следующая выборка начнется после него"""
+        with self._lock:
+            self.max_ids[kind] = max(self.max_ids.get(kind, 0), item_id)
+
+    def indexed_ids(self, kind):
+        """id элементов вида kind, доступных поиску"""
+        with self._lock:
+            return {item_id for k, item_id in self._keys if k == kind and (k, item_id) not in self._deleted}
+
+    def remove(self, kind, item_ids):
+        """Исключает элементы из поиска (строки удалены из БД); возвращает число исключенных"""
+        with self._lock:
+            removed = [(kind, item_id) for item_id in item_ids
+                       if (kind, item_id) in self._keys and (kind, item_id) not in self._deleted]
+            if not removed:
+                return 0
+            with open(self.deleted_path, 'a', encoding='utf-8') as f:
+                for key in removed:
+                    f.write(json.dumps(key) + '\n')
+            self._deleted_size = os.path.getsize(self.deleted_path)
+            self._deleted.update(removed)
+            self._filters = None
+            return len(removed)
+
+    def _filter_arrays(self):
+        if self._filters is None:
+            self._filters = (
+                np.array([m['kind'] for m in self._meta], dtype=object),
+                np.array([m['agent_id'] if m['agent_id'] is not None else -1 for m in self._meta], dtype=np.int64),
+                np.array([(m['kind'], m['id']) not in self._deleted for m in self._meta], dtype=bool)
+            )
+        return self._filters
+
+    def search(self, text, k=5, kind=None, agent_id=None, min_score=0.0):
+        """Косинусный top-k: список словарей kind/id/agent_id/text/score по убыванию сходства"""
+        query = self.vectorizer.transform(text)
+        with self._lock:
+            count = len(self._meta)
+            if count == 0 or not query.any():
+                return []
+            scores = np.asarray(self._vectors[:count]) @ query
+
+            kinds, agent_ids, alive = self._filter_arrays()
+            mask = (scores >= min_score) & alive
+            if kind is not None:
+                mask &= kinds == kind
+            if agent_id is not None:
+                mask &= agent_ids == agent_id
+            candidates = np.nonzero(mask)[0]
+            if len(candidates) == 0:
+                return []
+            if len(candidates) > k:
+                top = candidates[np.argpartition(-scores[candidates], k)[:k]]
+            else:
+                top = candidates
+            top = top[np.argsort(-scores[top])]
+
+            results = []
+            for row in top:
+                item = dict(self._meta[row])
+                item['score'] = round(float(scores[row]), 4)
+                results.append(item)
+            return results
+
+    def refresh(self):
+        """Перечитывает индекс, если его дописал другой процесс"""
+        with self._lock:
+            size = os.path.getsize(self.meta_path) if os.path.exists(self.meta_path) else 0
+            deleted = os.path.getsize(self.deleted_path) if os.path.exists(self.deleted_path) else 0
+            if size != self._meta_size or deleted != self._deleted_size:
+                self._open()
+
+
+def index_new_rows(index, limit=500):
+    """
+    Добавляет в индекс новые воспоминания, реплики диалогов и мысли (нужен контекст приложения).
+    Возвращает число прочитанных строк: строки без текста не индексируются, но и не читаются повторно.
+    """
+    read = 0
+
+    memories = AgentMemory.query.filter(
+        AgentMemory.id > index.max_ids.get('memory', 0)
+    ).order_by(AgentMemory.id.asc()).limit(limit).all()
+    index.add_many([('memory', m.id, m.agent_id, m.content) for m in memories])
+    if memories:
+        index.advance('memory', memories[-1].id)
+    read += len(memories)
+
+    dialogues = Dialogue.query.filter(
+        (Dialogue.id > index.max_ids.get('dialogue', 0)) &
+        (Dialogue.dialogue_type == 'ai_response')
+    ).order_by(Dialogue.id.asc()).limit(limit).all()
+    index.add_many([('dialogue', d.id, d.agent1_id, d.message) for d in dialogues])
+    if dialogues:
+        index.advance('dialogue', dialogues[-1].id)
+    read += len(dialogues)
+
+    thoughts = AgentThought.query.filter(
+        AgentThought.id > index.max_ids.get('thought', 0)
+    ).order_by(AgentThought.id.asc()).limit(limit).all()
+    index.add_many([('thought', t.id, t.agent_id, t.thought) for t in thoughts])
+    if thoughts:
+        index.advance('thought', thoughts[-1].id)
+    read += len(thoughts)
+
+    return read
+
+
+def prune_deleted(index):
+    """Исключает из поиска воспоминания, удаленные уплотнением MemoryStore (нужен контекст приложения)"""
+    indexed = index.indexed_ids('memory')
+    if not indexed:
+        return 0
+    live = {row[0] for row in db.session.query(AgentMemory.id)}
+    return index.remove('memory', indexed - live)
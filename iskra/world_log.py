@@ -0,0 +1,191 @@
+# world_log.py - Журнал изменений мира (event sourcing) с периодическими снимками
+
+import json
+import zlib
+
+from models import db, Agent, WorldState, Relationship, WorldLogEntry, WorldSnapshot
+
+AGENT_FIELDS = ('name', 'type', 'mood', 'energy', 'x', 'y', 'z')
+
+
+def _encode(data):
+    """Компактная сериализация: JSON без пробелов + zlib"""
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def _decode(payload):
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def capture_state(world, agents, relationships):
+    """
+    Снимок состояния мира в виде словаря (числа округлены для компактности).
+    relationships - словарь {'имя1|имя2': значение}
+    """
+    return {
+        'cycle': world.cycle,
+        'complexity': round(world.complexity, 4),
+        'agents': {
+            str(a.id): {
+                'name': a.name,
+                'type': a.type,
+                'mood': a.mood,
+                'energy': round(a.energy, 3),
+                'x': round(a.position_x, 3),
+                'y': round(a.position_y, 3),
+                'z': round(a.position_z, 3)
+            } for a in agents
+        },
+        'relationships': {key: round(value, 3) for key, value in relationships.items()}
+    }
+
+
+def diff_states(old, new):
+    """Дельта между двумя состояниями: только изменившиеся поля"""
+    delta = {'cycle': new['cycle']}
+    if new['complexity'] != old['complexity']:
+        delta['complexity'] = new['complexity']
+
+    changed = {}
+    for agent_id, fields in new['agents'].items():
+        previous = old['agents'].get(agent_id)
+        if previous is None:
+            changed[agent_id] = fields
+            continue
+        diff = {k: v for k, v in fields.items() if previous.get(k) != v}
+        if diff:
+            changed[agent_id] = diff
+    if changed:
+        delta['agents'] = changed
+
+    removed = [agent_id for agent_id in old['agents'] if agent_id not in new['agents']]
+    if removed:
+        delta['removed'] = removed
+
+    rels = {k: v for k, v in new['relationships'].items() if old['relationships'].get(k) != v}
+    if rels:
+        delta['relationships'] = rels
+    return delta
+
+
+def apply_delta(state, delta):
+    """Применяет дельту к состоянию (на месте)"""
+    state['cycle'] = delta['cycle']
+    if 'complexity' in delta:
+        state['complexity'] = delta['complexity']
+    for agent_id, fields in delta.get('agents', {}).items():
+        state['agents'].setdefault(agent_id, {}).update(fields)
+    for agent_id in delta.get('removed', []):
+        state['agents'].pop(agent_id, None)
+    state['relationships'].update(delta.get('relationships', {}))
+    return state
+
+
+class WorldLog:
+    """
+    Append-only журнал мира: дельта на каждый цикл и полный снимок каждые snapshot_interval циклов.
+    Восстановление любого цикла стоит не больше snapshot_interval применений дельт.
+    """
+
+    def __init__(self, snapshot_interval=50, retain_snapshots=20):
+        self.snapshot_interval = snapshot_interval
+        self.retain_snapshots = retain_snapshots
+        self._last_state = None  # Последнее записанное состояние (для вычисления дельт)
+
+    def record(self, world, agents, relationships=None):
+        """
+        Записывает изменения текущего цикла (в текущую транзакцию, без commit).
+        relationships - {'имя1|имя2': значение}; по умолчанию читаются из таблицы relationship.
+        """
+        if relationships is None:
+            relationships = {f"{r.agent1}|{r.agent2}": r.relationship_value for r in Relationship.query.all()}
+        state = capture_state(world, agents, relationships)
+
+        if self._last_state is None or self._last_state['cycle'] >= state['cycle']:
+            # Первый цикл после запуска (или журнал отстал) - начинаем со снимка
+            self._write_snapshot(state)
+        else:
+            db.session.add(WorldLogEntry(
+                cycle=state['cycle'],
+                payload=_encode(diff_states(self._last_state, state))
+            ))
+            if state['cycle'] % self.snapshot_interval == 0:
+                self._write_snapshot(state)
+
+        self._last_state = state
+
+    def _write_snapshot(self, state):
+        existing = WorldSnapshot.query.filter_by(cycle=state['cycle']).first()
+        if existing:
+            existing.payload = _encode(state)
+        else:
+            db.session.add(WorldSnapshot(cycle=state['cycle'], payload=_encode(state)))
+        self._compact()
+
+    def _compact(self):
+        """Удаляет снимки и дельты старше окна хранения"""
+        oldest = WorldSnapshot.query.order_by(WorldSnapshot.cycle.desc()).offset(self.retain_snapshots - 1).first()
+        if oldest:
+            WorldSnapshot.query.filter(WorldSnapshot.cycle < oldest.cycle).delete()
+            WorldLogEntry.query.filter(WorldLogEntry.cycle <= oldest.cycle).delete()
+
+    def state_at(self, cycle):
+        """Восстанавливает состояние мира на цикле cycle (None, если журнал его не покрывает)"""
+        snapshot = WorldSnapshot.query.filter(WorldSnapshot.cycle <= cycle).order_by(
+            WorldSnapshot.cycle.desc()
+        ).first()
+        if not snapshot:
+            return None
+
+        state = _decode(snapshot.payload)
+        entries = WorldLogEntry.query.filter(
+            (WorldLogEntry.cycle > snapshot.cycle) & (WorldLogEntry.cycle <= cycle)
+        ).order_by(WorldLogEntry.cycle.asc()).all()
+        for entry in entries:
+            apply_delta(state, _decode(entry.payload))
+
+        if state['cycle'] != cycle:
+            return None  # Цикл вне записанного диапазона
+        return state
+
+    def latest_state(self):
+        """Последнее записанное состояние мира"""
+        last = WorldLogEntry.query.order_by(WorldLogEntry.cycle.desc()).first()
+        snapshot = WorldSnapshot.query.order_by(WorldSnapshot.cycle.desc()).first()
+        if not snapshot:
+            return None
+        cycle = max(snapshot.cycle, last.cycle if last else 0)
+        return self.state_at(cycle)
+
+    def restore(self):
+        """
+        Быстрый старт: поднимает последнее состояние из журнала.
+        Если таблицы агентов/мира пусты (например, после потери БД), восстанавливает их из снимка.
+        """
+        state = self.latest_state()
+        if state is None:
+            return None
+
+        if WorldState.query.first() is None:
+            db.session.add(WorldState(cycle=state['cycle'], complexity=state['complexity']))
+
+        if Agent.query.count() == 0:
+            for agent_id, fields in state['agents'].items():
+                db.session.add(Agent(
+                    id=int(agent_id),
+                    name=fields['name'],
+                    type=fields['type'],
+                    mood=fields['mood'],
+                    energy=fields['energy'],
+                    position_x=fields['x'],
+                    position_y=fields['y'],
+                    position_z=fields['z']
+                ))
+            if Relationship.query.count() == 0:
+                for key, value in state['relationships'].items():
+                    name1, name2 = key.split('|', 1)
+                    db.session.add(Relationship(agent1=name1, agent2=name2, relationship_value=value))
+
+        db.session.commit()
+        self._last_state = state
+        return state